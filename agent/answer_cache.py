@@ -0,0 +1,127 @@
+# answer_cache.py
+"""
+Semantic answer cache สำหรับคำถามสุขภาพที่ถามซ้ำบ่อย เช่น "HbA1c 6.1 เป็นเบาหวานไหม"
+key = embedding ของคำถามที่ normalize แล้ว + ชุด ID ของ chunk ที่ retrieve ได้
+คำตอบที่เก็บเป็นคำตอบที่ผ่าน output guardrail แล้ว จึงส่งให้ user ได้ทันที
+
+ใช้เฉพาะบทสนทนา turn เดียวที่ไม่มี summary เพราะคำตอบของ turn ถัดๆ ไปขึ้นกับบริบทก่อนหน้า
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from . import metrics
+from .rag_utils import embedding_function
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# ต้องคล้ายกันมาก ตัวเลขต่างกันนิดเดียว ("LDL 160" vs "LDL 190") ความหมายก็ต่าง
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.97"))
+
+POLITE_PARTICLES = re.compile(r"(ครับ|ค่ะ|คะ|นะคะ|นะครับ|จ้า|จ้ะ|หน่อย)+$")
+
+_lock = threading.Lock()
+# entry_id -> (chunk_ids, embedding, numbers, answer, created_at) เรียงจากใช้ล่าสุดไว้ท้าย (LRU)
+_entries: OrderedDict = OrderedDict()
+_next_id = 0
+
+
+def normalize_question(text: str) -> str:
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    text = re.sub(r"[?？!！.。,]+", "", text).strip()
+    return POLITE_PARTICLES.sub("", text).strip()
+
+
+def _numbers(text: str) -> tuple[str, ...]:
+    # ค่าแลปต้องตรงกันเป๊ะ embedding แยก "6.1" กับ "6.5" ได้ไม่ดีพอ
+    return tuple(re.findall(r"\d+(?:\.\d+)?", text))
+
+
+def is_cacheable(state: dict) -> bool:
+    """ข้าม cache เมื่อมี summary หรือมีบทสนทนาก่อนหน้า"""
+    if not ANSWER_CACHE_ENABLED or state.get("summary"):
+        return False
+    return sum(1 for m in state["messages"] if m.type in ("human", "ai")) == 1
+
+
+def make_key(question: str, chunk_ids: list[str]) -> dict:
+    normalized = normalize_question(question)
+    embedding = embedding_function.embed_query(normalized)
+    return {
+        "chunk_ids": sorted(chunk_ids),
+        "embedding": list(embedding),
+        "numbers": list(_numbers(normalized)),
+    }
+
+
+def lookup(key: dict) -> str | None:
+    start = time.perf_counter()
+    query = np.asarray(key["embedding"], dtype=np.float32)
+    chunk_ids = tuple(key["chunk_ids"])
+    numbers = tuple(key["numbers"])
+    now = time.time()
+    best_id, best_score = None, ANSWER_CACHE_THRESHOLD
+
+    with _lock:
+        for entry_id, (entry_chunks, embedding, entry_numbers, _, created_at) in list(_entries.items()):
+            if now - created_at > ANSWER_CACHE_TTL_SECONDS:
+                del _entries[entry_id]
+                continue
+            if entry_chunks != chunk_ids or entry_numbers != numbers:
+                continue
+            score = float(embedding @ query)
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+
+        answer = None
+        if best_id is not None:
+            _entries.move_to_end(best_id)
+            answer = _entries[best_id][3]
+
+    metrics.record("answer_cache_lookup_ms", (time.perf_counter() - start) * 1000)
+    metrics.incr("answer_cache_hits" if answer is not None else "answer_cache_misses")
+    if answer is not None:
+        print(f"[Answer Cache] HIT (similarity {best_score:.3f})")
+    return answer
+
+
+def store(key: dict, answer: str) -> None:
+    global _next_id
+    entry = (
+        tuple(key["chunk_ids"]),
+        np.asarray(key["embedding"], dtype=np.float32),
+        tuple(key["numbers"]),
+        answer,
+        time.time(),
+    )
+    with _lock:
+        _entries[_next_id] = entry
+        _next_id += 1
+        while len(_entries) > ANSWER_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def clear() -> None:
+    with _lock:
+        _entries.clear()
+
+
+def report() -> dict:
+    hits = metrics.counter("answer_cache_hits")
+    misses = metrics.counter("answer_cache_misses")
+    total = hits + misses
+    return {
+        "size": len(_entries),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 3) if total else 0.0,
+        "mean_lookup_ms": round(metrics.mean("answer_cache_lookup_ms"), 2),
+    }
+
+
+metrics.register_report("answer_cache", report)
@@ -0,0 +1,180 @@
+# context_budget.py
+"""
+ประกอบ context ก่อนส่งให้ LLM ภายใต้งบ token
+- รวม chunk ที่ต่อกัน/ซ้อนกันจากหัวข้อเดียวกัน (build_vector_db ใช้ chunk_overlap=250 จึงซ้ำกันได้ถึง 1/4)
+- ตัดประโยคที่ซ้ำกันข้าม chunk
+- เติมตามลำดับคะแนนจนเต็ม CONTEXT_TOKEN_BUDGET
+ความยาว prompt มีผลตรงกับ latency และค่าใช้จ่ายของ generation
+"""
+import math
+import os
+import re
+
+from langchain_core.documents import Document
+
+from . import metrics
+from .vector_index import render_chunk
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500"))
+# ส่วนที่ซ้อนกันต้องยาวอย่างน้อยเท่านี้ถึงจะถือว่าเป็น chunk ต่อกัน (กันบังเอิญตรงกันสั้นๆ)
+MIN_OVERLAP_CHARS = 40
+MAX_OVERLAP_CHARS = 400
+# ประโยคสั้นกว่านี้ (เช่น "|" หรือหัวตาราง) ไม่นับว่าซ้ำ
+MIN_DEDUPE_CHARS = 20
+# chunk ที่ถูกตัดต้องเหลือเนื้อหาอย่างน้อยเท่านี้ (ไม่นับหัว "จาก: โรค - หัวข้อ") ไม่อย่างนั้นไม่ใส่เลย
+MIN_CONTENT_TOKENS = 30
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+# metadata ที่ data/MarkdownHeaderTextSplitter.py คำนวณไว้จาก page_content เดิม ใช้ไม่ได้ถ้าเนื้อหาถูกแก้
+PRECOMPUTED_KEYS = ("Rendered", "Tokens")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    ประมาณจำนวน token ของ Gemini โดยไม่ต้องเรียก API:
+    ภาษาอังกฤษ/ตัวเลข ~4 ตัวอักษรต่อ token, ภาษาไทย ~2 ตัวอักษรต่อ token
+    """
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2)
+
+
+def chunk_tokens(doc: Document) -> int:
+    """token ของ chunk ใน context (ใช้ค่าที่คำนวณไว้ตอน ingestion ถ้ามี)"""
+    tokens = doc.metadata.get("Tokens")
+    return int(tokens) if tokens is not None else estimate_tokens(render_chunk(doc))
+
+
+def _display_metadata(doc: Document) -> dict:
+    return {key: value for key, value in doc.metadata.items() if key not in PRECOMPUTED_KEYS}
+
+
+def _merge_overlap(first: str, second: str) -> str | None:
+    """ถ้าท้าย first ตรงกับต้น second (หรืออันหนึ่งอยู่ในอีกอัน) คืนข้อความที่รวมแล้ว"""
+    if second in first:
+        return first
+    if first in second:
+        return second
+    head = second[:MIN_OVERLAP_CHARS]
+    start = first.rfind(head, max(0, len(first) - MAX_OVERLAP_CHARS))
+    if len(head) == MIN_OVERLAP_CHARS and start >= 0 and second.startswith(first[start:]):
+        return first[:start] + second
+    return None
+
+
+def merge_chunks(documents: list[Document]) -> list[Document]:
+    """
+    รวม chunk ที่มาจาก SourceFile/Topic เดียวกันและข้อความต่อกัน
+    ลำดับผลลัพธ์ยึดอันดับที่ดีที่สุดของ chunk ในกลุ่ม
+    """
+    blocks: list[tuple[tuple, str, Document]] = []
+    for doc in documents:
+        group = (doc.metadata.get("SourceFile"), doc.metadata.get("Topic"))
+        text = doc.page_content
+        for i, (block_group, block_text, block_doc) in enumerate(blocks):
+            if block_group != group:
+                continue
+            merged = _merge_overlap(block_text, text) or _merge_overlap(text, block_text)
+            if merged is not None:
+                blocks[i] = (block_group, merged, block_doc)
+                break
+        else:
+            blocks.append((group, text, doc))
+
+    merged_docs = []
+    for _, text, doc in blocks:
+        if text == doc.page_content:
+            merged_docs.append(doc)
+        else:
+            merged_docs.append(Document(id=doc.id, page_content=text, metadata=_display_metadata(doc)))
+    return merged_docs
+
+
+def dedupe_sentences(text: str, seen: set[str]) -> str:
+    """ตัดประโยคที่เคยเห็นแล้ว ถ้าไม่มีประโยคไหนซ้ำคืน text เดิม (ใช้ Rendered/Tokens ที่คำนวณไว้ได้)"""
+    kept, dropped = [], False
+    for sentence in SENTENCE_SPLIT.split(text):
+        key = " ".join(sentence.split())
+        if not key:
+            continue
+        if len(key) >= MIN_DEDUPE_CHARS:
+            if key in seen:
+                dropped = True
+                continue
+            seen.add(key)
+        kept.append(sentence.strip())
+    return "\n".join(kept) if dropped else text
+
+
+def _truncate_to_budget(text: str, budget: int) -> str:
+    kept, used = [], 0
+    for sentence in text.split("\n"):
+        tokens = estimate_tokens(sentence)
+        if used + tokens > budget:
+            break
+        kept.append(sentence)
+        used += tokens
+    return "\n".join(kept)
+
+
+def assemble_context(documents: list[Document], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    documents ต้องเรียงตามคะแนนมาก่อน (ผลจาก retrieval)
+    คืน context รูปแบบเดียวกับ rag_utils.format_context แต่สั้นลง
+    """
+    if not documents:
+        return ""
+
+    raw_tokens = sum(chunk_tokens(doc) for doc in documents)
+    seen: set[str] = set()
+    parts, used = [], 0
+    for doc in merge_chunks(documents):
+        content = dedupe_sentences(doc.page_content, seen)
+        if not content:
+            continue
+        if content == doc.page_content and doc.metadata.get("Rendered"):
+            # chunk ไม่ถูกแก้: ใช้ข้อความและจำนวน token ที่ render ไว้ตอน ingestion
+            block, tokens = doc.metadata["Rendered"], chunk_tokens(doc)
+        else:
+            block = render_chunk(Document(page_content=content, metadata=_display_metadata(doc)))
+            tokens = estimate_tokens(block)
+        remaining = budget - used
+        if tokens > remaining:
+            # chunk แรกตัดให้พอดีงบ ที่เหลือข้ามไปเลยเพื่อไม่ให้ได้ประโยคครึ่งๆ กลางๆ หลายก้อน
+            if parts:
+                break
+            content_budget = remaining - (tokens - estimate_tokens(content))
+            if content_budget < MIN_CONTENT_TOKENS:
+                # งบที่เหลือพอแค่หัวของ chunk ได้ block ที่มีแต่หัวไม่มีเนื้อหา
+                break
+            content = _truncate_to_budget(content, content_budget)
+            if not content.strip():
+                # บรรทัดแรกของ chunk ยาวเกินงบเอง
+                break
+            block = render_chunk(Document(page_content=content, metadata=_display_metadata(doc)))
+            tokens = estimate_tokens(block)
+        parts.append(f"[ข้อมูลที่ {len(parts) + 1} {block}\n\n")
+        used += tokens
+
+    context = "".join(parts)
+    sent_tokens = used
+    metrics.incr("context_requests")
+    metrics.incr("context_tokens_raw", raw_tokens)
+    metrics.incr("context_tokens_sent", sent_tokens)
+    print(f"[Context] {len(documents)} chunks -> {len(parts)} blocks, ~{sent_tokens} tokens (saved ~{max(0, raw_tokens - sent_tokens)})")
+    return context
+
+
+def report() -> dict:
+    requests = metrics.counter("context_requests")
+    raw = metrics.counter("context_tokens_raw")
+    sent = metrics.counter("context_tokens_sent")
+    return {
+        "requests": requests,
+        "budget_tokens": CONTEXT_TOKEN_BUDGET,
+        "mean_raw_tokens": round(raw / requests, 1) if requests else 0.0,
+        "mean_sent_tokens": round(sent / requests, 1) if requests else 0.0,
+        "mean_saved_tokens": round(max(0, raw - sent) / requests, 1) if requests else 0.0,
+    }
+
+
+metrics.register_report("context_budget", report)
@@ -0,0 +1,127 @@
+# conversation_store.py
+"""
+ที่เก็บสรุปบทสนทนาแบบถาวร (SQLite) สำหรับ Open WebUI ที่ส่งประวัติแชททั้งหมดมาใหม่ทุก turn
+
+แต่ละข้อความได้ ID แบบ deterministic = hash ต่อกันเป็นโซ่ของ (role, content) ตั้งแต่ข้อความแรก
+โดยโซ่เริ่มจาก ID ของบทสนทนา/ผู้ใช้ (conversation_id) ผู้ใช้สองคนที่เปิดบทสนทนาด้วยข้อความเดียวกันจึงได้ ID คนละชุด
+ID ของข้อความที่ i จึงเป็น fingerprint ของ prefix ทั้งหมดจนถึงข้อความนั้นด้วย
+เราเก็บสรุปโดยใช้ ID ของข้อความสุดท้ายที่ถูกสรุปเป็น key
+รอบถัดไปแค่หา ID ที่ยาวที่สุดที่มีในตาราง ก็ได้สรุปเดิม + จำนวนข้อความที่ไม่ต้องสรุปซ้ำ
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.environ.get(
+    "CONVERSATION_DB_PATH",
+    os.path.join(BASE_DIR, "data", "conversation_memory.sqlite3")
+)
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+@contextmanager
+def _connect():
+    """เปิด connection ใหม่ทุกครั้ง (ใช้ได้จากหลาย thread) commit เมื่อจบแล้วปิดทิ้ง"""
+    global _initialized
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    try:
+        if not _initialized:
+            with _init_lock:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS summaries (
+                        message_id TEXT PRIMARY KEY,
+                        summary TEXT NOT NULL,
+                        summarized_ids TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                    """
+                )
+                _initialized = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def message_fingerprint(previous: str, role: str, content: str) -> str:
+    digest = hashlib.sha256(f"{previous}\x1f{role}\x1f{content}".encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def assign_message_ids(messages: list, conversation_id: str = "") -> list:
+    """ใส่ ID แบบ deterministic ให้ทุกข้อความ (ข้อความเดิมในบทสนทนาเดิมได้ ID เดิมทุก request)"""
+    previous = message_fingerprint("", "conversation", conversation_id) if conversation_id else ""
+    for message in messages:
+        previous = message_fingerprint(previous, message.type, str(message.content))
+        message.id = previous
+    return messages
+
+
+def load_summary(messages: list) -> tuple[str, list[str]]:
+    """
+    หาสรุปล่าสุดที่ครอบคลุม prefix ของบทสนทนานี้
+    คืนค่า (summary, ID ของข้อความที่สรุปไปแล้ว) ถ้าไม่เจอคืน ("", [])
+    """
+    ids = [m.id for m in messages if m.id]
+    if not ids:
+        return "", []
+
+    placeholders = ",".join("?" for _ in ids)
+    try:
+        with _connect() as conn:
+            rows = conn.execute(
+                f"SELECT message_id, summary, summarized_ids FROM summaries WHERE message_id IN ({placeholders})",
+                ids
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error loading conversation summary: {e}")
+        return "", []
+
+    if not rows:
+        return "", []
+
+    # เลือก prefix ที่ยาวที่สุด = ข้อความสุดท้ายที่สรุปแล้วอยู่ลึกที่สุดในบทสนทนา
+    position = {message_id: i for i, message_id in enumerate(ids)}
+    _, summary, summarized_ids = max(rows, key=lambda row: position[row[0]])
+    return summary, json.loads(summarized_ids)
+
+
+def save_summary(summary: str, summarized_ids: list[str]) -> None:
+    """บันทึกสรุป โดยใช้ ID ของข้อความสุดท้ายที่ถูกสรุปเป็น key"""
+    if not summarized_ids:
+        return
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (message_id, summary, summarized_ids, updated_at) VALUES (?, ?, ?, ?)",
+                (summarized_ids[-1], summary, json.dumps(summarized_ids), time.time())
+            )
+    except sqlite3.Error as e:
+        print(f"Error saving conversation summary: {e}")
+
+
+def restore_state(messages: list, conversation_id: str = "") -> dict:
+    """
+    เตรียม state เริ่มต้นจากประวัติที่ Open WebUI ส่งมา:
+    ตัดข้อความที่เคยสรุปแล้วออก และใส่ summary เดิมกลับเข้าไป
+    เป็นงาน SQLite แบบ sync ผู้เรียกจาก async code ต้องรันผ่าน asyncio.to_thread
+    """
+    assign_message_ids(messages, conversation_id)
+    summary, summarized_ids = load_summary(messages)
+    if summarized_ids:
+        done = set(summarized_ids)
+        messages = [m for m in messages if m.id not in done]
+        print(f"[Memory] Restored summary covering {len(summarized_ids)} messages. Remaining: {len(messages)}")
+    return {
+        "messages": messages,
+        "summary": summary,
+        "summarized_ids": summarized_ids
+    }
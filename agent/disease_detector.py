@@ -0,0 +1,134 @@
+# disease_detector.py
+"""
+ตรวจว่าคำถามเกี่ยวกับโรคไหน เพื่อค้นเฉพาะ shard (ไฟล์คู่มือ) ของโรคนั้น
+ลดจำนวน vector ที่ต้องสแกน และกัน chunk ของโรคอื่นปนเข้ามาใน prompt (เช่น เบาหวานปนในคำตอบเรื่องไต)
+
+ลำดับการตัดสิน: ค่าแลปจาก lab_engine -> keyword lexicon -> nearest prototype บน embedding
+ถ้าไม่มั่นใจเลยคืน [] = ค้นทั้ง collection เหมือนเดิม
+"""
+import threading
+import time
+
+import numpy as np
+
+from . import lab_engine, metrics
+from .input_classifier import _compile_lexicon, _normalize
+from .rag_utils import embedding_function
+
+# ชื่อ shard = ชื่อไฟล์คู่มือ (metadata SourceFile ที่ build_vector_db ใส่ไว้)
+DISEASE_SHARDS = {
+    "diabetes": "diabetes_knowledge.md",
+    "hypertension": "hypertension_knowledge.md",
+    "dyslipidemia": "dyslipidemia_knowledge.md",
+    "kidney": "kidney_knowledge.md",
+}
+
+DISEASE_KEYWORDS = {
+    "diabetes": [
+        "เบาหวาน", "น้ำตาลในเลือด", "น้ำตาลสะสม", "ระดับน้ำตาล", "อินซูลิน", "น้ำตาลต่ำ", "น้ำตาลสูง",
+        "hba1c", "a1c", "fbs", "fpg", "glucose", "diabetes", "insulin", "hypoglycemia",
+    ],
+    "hypertension": [
+        "ความดันโลหิต", "ความดันสูง", "ความดันต่ำ", "ความดัน", "วัดความดัน", "มม.ปรอท",
+        "hypertension", "blood pressure", "mmhg",
+    ],
+    "dyslipidemia": [
+        "ไขมันในเลือด", "ไขมันสูง", "ไขมันเลว", "ไขมันดี", "คอเลสเตอรอล", "ไตรกลีเซอไรด์", "แอลดีแอล",
+        "ldl", "hdl", "cholesterol", "triglyceride", "dyslipidemia", "statin",
+    ],
+    "kidney": [
+        "โรคไต", "ไตเรื้อรัง", "ไตวาย", "ไตเสื่อม", "ค่าไต", "การกรองของไต", "ฟอกไต", "ครีเอตินิน",
+        "ไข่ขาวในปัสสาวะ", "โปรตีนในปัสสาวะ", "โพแทสเซียม",
+        "egfr", "gfr", "ckd", "creatinine", "uacr", "acr", "kidney", "dialysis", "potassium",
+    ],
+}
+
+DISEASE_PROTOTYPES = {
+    "diabetes": [
+        "โรคเบาหวาน ระดับน้ำตาลในเลือดสูง การควบคุมน้ำตาล",
+        "อาการของเบาหวาน ปัสสาวะบ่อย กระหายน้ำ น้ำหนักลด",
+        "ภาวะน้ำตาลต่ำ ใจสั่น เหงื่อออก หน้ามืด",
+    ],
+    "hypertension": [
+        "โรคความดันโลหิตสูง การวัดความดันที่บ้าน",
+        "ปวดศีรษะ เวียนหัว ความดันขึ้น ลดเค็ม",
+    ],
+    "dyslipidemia": [
+        "ไขมันในเลือดผิดปกติ คอเลสเตอรอลสูง ไขมันเลว",
+        "ความเสี่ยงโรคหัวใจและหลอดเลือดจากไขมันสูง อาหารไขมันอิ่มตัว",
+    ],
+    "kidney": [
+        "โรคไตเรื้อรัง ค่าการทำงานของไต การกรองของไต",
+        "อาหารสำหรับผู้ป่วยโรคไต จำกัดโปรตีน โพแทสเซียม ฟอสฟอรัส",
+        "ขาบวม ปัสสาวะเป็นฟอง ไตเสื่อม",
+    ],
+}
+
+# embedding ต้องคล้าย prototype อย่างน้อยเท่านี้ และโรคที่ได้ต้องห่างจากอันดับหนึ่งไม่เกิน margin
+EMBEDDING_MIN_SCORE = 0.45
+EMBEDDING_MARGIN = 0.05
+
+_patterns = {disease: _compile_lexicon(keywords) for disease, keywords in DISEASE_KEYWORDS.items()}
+
+_lock = threading.Lock()
+_prototype_vectors: dict[str, np.ndarray] | None = None
+
+
+def _prototypes() -> dict[str, np.ndarray]:
+    global _prototype_vectors
+    if _prototype_vectors is None:
+        with _lock:
+            if _prototype_vectors is None:
+                _prototype_vectors = {
+                    disease: np.asarray(embedding_function.embed_documents(examples), dtype=np.float32)
+                    for disease, examples in DISEASE_PROTOTYPES.items()
+                }
+    return _prototype_vectors
+
+
+def detect_diseases(text: str, labs: list[dict] | None = None) -> tuple[list[str], str]:
+    """คืนค่า (รายชื่อโรค, วิธีที่ใช้ตัดสิน) รายชื่อว่าง = ไม่จำกัด shard"""
+    shard_files = set(lab_engine.lab_source_files(labs or []))
+    diseases = [disease for disease, filename in DISEASE_SHARDS.items() if filename in shard_files]
+
+    normalized = _normalize(text)
+    diseases += [
+        disease for disease, pattern in _patterns.items()
+        if disease not in diseases and pattern.search(normalized)
+    ]
+    if diseases:
+        return diseases, "lab" if labs else "lexicon"
+
+    query = np.asarray(embedding_function.embed_query(text), dtype=np.float32)
+    scores = {disease: float((vectors @ query).max()) for disease, vectors in _prototypes().items()}
+    best = max(scores.values())
+    if best < EMBEDDING_MIN_SCORE:
+        return [], "none"
+    return [disease for disease, score in scores.items() if score >= best - EMBEDDING_MARGIN], "embedding"
+
+
+def detect_shards(text: str, labs: list[dict] | None = None) -> list[str]:
+    """ไฟล์คู่มือ (SourceFile) ที่ต้องค้น ถ้าครอบคลุมทุกโรคหรือไม่แน่ใจคืน [] เพื่อค้นทั้งหมด"""
+    start = time.perf_counter()
+    diseases, method = detect_diseases(text, labs)
+    metrics.record("disease_detect_ms", (time.perf_counter() - start) * 1000)
+    metrics.incr(f"disease_detect_{method}")
+    metrics.incr("disease_shards_searched", len(diseases) or len(DISEASE_SHARDS))
+    if len(diseases) == len(DISEASE_SHARDS):
+        return []
+    return [DISEASE_SHARDS[disease] for disease in diseases]
+
+
+def report() -> dict:
+    methods = {method: metrics.counter(f"disease_detect_{method}") for method in ("lab", "lexicon", "embedding", "none")}
+    total = sum(methods.values())
+    return {
+        "total": total,
+        "methods": methods,
+        "unfiltered_rate": round(methods["none"] / total, 3) if total else 0.0,
+        "mean_shards_searched": round(metrics.counter("disease_shards_searched") / total, 2) if total else 0.0,
+        "mean_detect_ms": round(metrics.mean("disease_detect_ms"), 2),
+    }
+
+
+metrics.register_report("disease_detector", report)
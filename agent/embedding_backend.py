@@ -0,0 +1,206 @@
+# embedding_backend.py
+"""
+เลือก backend ของ embedding model (paraphrase-multilingual-MiniLM-L12-v2) ที่ใช้ทั้งตอน query (rag_utils)
+และตอน build index (data/MarkdownHeaderTextSplitter.py)
+- "torch" (ค่าเริ่มต้น): HuggingFaceEmbeddings แบบ fp32 เหมือนเดิม
+- "onnx": โมเดลที่ export เป็น ONNX และ quantize เป็น int8 รันด้วย ONNX Runtime (เร็วกว่าและกิน RAM น้อยกว่าบน CPU)
+
+ต้องติดตั้งเพิ่มเฉพาะเมื่อใช้ onnx (ดูบรรทัด optional ใน requirements.txt): pip install "optimum[onnxruntime]"
+    python -m agent.embedding_backend export      # export + quantize ไปที่ data/onnx_minilm
+    python -m agent.embedding_backend parity      # เทียบกับ vector fp32 ใน index (cosine >= 0.99)
+    python -m agent.embedding_backend benchmark   # throughput / latency / memory ของทั้งสอง backend
+"""
+import json
+import os
+import platform
+import sys
+import time
+
+from langchain_core.embeddings import Embeddings
+
+from .index_store import current_paths
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+ONNX_MODEL_DIR = os.path.join(BASE_DIR, "data", "onnx_minilm")
+QUANTIZED_FILE = "model_quantized.onnx"
+# sentence-transformers ตัดที่ 128 token สำหรับโมเดลนี้ ต้องตรงกันเพื่อให้ vector เท่ากัน
+MAX_SEQ_LENGTH = 128
+
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+PARITY_THRESHOLD = 0.99
+
+
+class OnnxEmbeddings(Embeddings):
+    """MiniLM แบบ int8 บน ONNX Runtime: mean pooling + L2 normalize เหมือน sentence-transformers"""
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, file_name: str = QUANTIZED_FILE,
+                 batch_size: int = 32, threads: int | None = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, file_name), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+
+    def _encode(self, texts: list[str]):
+        import numpy as np
+
+        encoded = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np"
+        )
+        feeds = {}
+        for name in self.input_names:
+            if name in encoded:
+                feeds[name] = encoded[name].astype(np.int64)
+            elif name == "token_type_ids":
+                feeds[name] = np.zeros_like(encoded["input_ids"], dtype=np.int64)
+        hidden = self.session.run(None, feeds)[0]  # last_hidden_state (batch, tokens, dim)
+
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._encode(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def load_torch_model() -> Embeddings:
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    # บังคับ CPU เหมือนเดิมเพื่อแก้บั๊ก Mac
+    return HuggingFaceEmbeddings(
+        model_name=MODEL_NAME,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+
+
+def load_embedding_model(backend: str | None = None, fallback: bool = True) -> Embeddings:
+    """
+    โหลด embedding model ตาม EMBEDDING_BACKEND ถ้า onnx ใช้ไม่ได้จะกลับไปใช้ torch
+    fallback=False ให้ error แทน (benchmark/parity ต้องวัด backend ที่ขอจริงๆ)
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "onnx":
+        try:
+            model = OnnxEmbeddings()
+            print(f"[Embedding] Using int8 ONNX model from {ONNX_MODEL_DIR}")
+            return model
+        except (ImportError, FileNotFoundError, OSError) as e:
+            if not fallback:
+                raise RuntimeError(
+                    f"ONNX embedding unavailable ({e}); pip install \"optimum[onnxruntime]\" "
+                    "and run python -m agent.embedding_backend export"
+                ) from e
+            print(f"WARNING: ONNX embedding unavailable ({e}), falling back to torch")
+    return load_torch_model()
+
+
+def export_onnx(out_dir: str = ONNX_MODEL_DIR) -> str:
+    """export MiniLM เป็น ONNX แล้ว quantize น้ำหนักเป็น int8 แบบ dynamic"""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True)
+    model.save_pretrained(out_dir)
+    AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(out_dir)
+
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    else:
+        config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    ORTQuantizer.from_pretrained(model).quantize(save_dir=out_dir, quantization_config=config)
+    return os.path.join(out_dir, QUANTIZED_FILE)
+
+
+def parity_check(sample_size: int = 500) -> dict:
+    """เทียบ vector จาก ONNX int8 กับ vector fp32 ที่เก็บใน Chroma สำหรับ chunk เดียวกัน"""
+    import numpy as np
+    from langchain_chroma import Chroma
+
+    # ไม่ import rag_utils เพราะจะโหลดโมเดล torch ติดมาด้วย
+    data = Chroma(persist_directory=current_paths().chroma_dir).get(
+        include=["embeddings", "documents"], limit=sample_size
+    )
+    reference = np.asarray(data["embeddings"], dtype=np.float32)
+    reference /= np.linalg.norm(reference, axis=1, keepdims=True)
+    onnx_vectors = np.asarray(OnnxEmbeddings().embed_documents(data["documents"]), dtype=np.float32)
+
+    cosine = (reference * onnx_vectors).sum(axis=1)
+    return {
+        "samples": len(cosine),
+        "min_cosine": round(float(cosine.min()), 4),
+        "mean_cosine": round(float(cosine.mean()), 4),
+        "below_threshold": int((cosine < PARITY_THRESHOLD).sum()),
+        "passed": bool(cosine.min() >= PARITY_THRESHOLD),
+    }
+
+
+def _benchmark_backend(backend: str, queries: list[str], documents: list[str]) -> dict:
+    from .vector_index import _latency_summary, _rss_mb
+
+    rss_before = _rss_mb()
+    start = time.perf_counter()
+    model = load_embedding_model(backend, fallback=False)
+    load_s = time.perf_counter() - start
+    model.embed_query(queries[0])  # warm-up
+
+    latencies = []
+    for query in queries * 5:
+        start = time.perf_counter()
+        model.embed_query(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    model.embed_documents(documents)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "load_s": round(load_s, 2),
+        "query_latency": _latency_summary(latencies),
+        "throughput_texts_per_s": round(len(documents) / elapsed, 1),
+        "peak_rss_delta_mb": round(_rss_mb() - rss_before, 1),
+    }
+
+
+def benchmark(sample_size: int = 256) -> dict:
+    """
+    ค่า peak RSS วัดจาก process เดียวกัน backend ที่รันทีหลังจะดูเหมือนกินน้อยกว่าจริง
+    ถ้าต้องการตัวเลขแม่นให้รันแยก process: python -m agent.embedding_backend benchmark onnx
+    """
+    from langchain_chroma import Chroma
+
+    from .vector_index import BENCHMARK_QUERIES
+
+    documents = Chroma(persist_directory=current_paths().chroma_dir).get(
+        include=["documents"], limit=sample_size
+    )["documents"]
+    backends = [arg for arg in sys.argv[2:] if arg in ("torch", "onnx")] or ["onnx", "torch"]
+    return {backend: _benchmark_backend(backend, BENCHMARK_QUERIES, documents) for backend in backends}
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "export"
+    if command == "export":
+        print(f"Saved quantized model to {export_onnx()}")
+    elif command == "parity":
+        print(json.dumps(parity_check(), indent=2))
+    elif command == "benchmark":
+        print(json.dumps(benchmark(), indent=2))
+    else:
+        print("usage: python -m agent.embedding_backend [export | parity | benchmark [torch|onnx]]")
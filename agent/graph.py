@@ -1,6 +1,10 @@
 from dotenv import load_dotenv 
 import os
+import re
 import json 
+import time
+import inspect
+import asyncio
 import tempfile
 from langchain_core.messages import BaseMessage, RemoveMessage # The foundational class for all message types in LangGraph
 from langchain_core.messages import ToolMessage # Passes data back to LLM after it calls a tool such as the content and the tool_call_id
@@ -8,11 +12,15 @@ from langchain_core.messages import SystemMessage # Message for providing instru
 # from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_google_vertexai import ChatVertexAI
 from langchain_core.tools import tool
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.config import get_stream_writer
 from langgraph.graph.message import add_messages
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 from .state import AgentState
-from .rag_utils import retrieve_context
+from .rag_utils import RETRIEVAL_K, RETRIEVAL_TIMEOUT_SECONDS, _with_timeout, aretrieve_with_context, chunk_id, run_retrieval
+from . import answer_cache, conversation_store, disease_detector, input_classifier, intent_router, lab_engine, metrics, output_safety
 import uuid
 
 load_dotenv()
@@ -73,6 +81,38 @@ chat_model = ChatVertexAI(
 )
 
 
+# ----- Streaming helpers -----
+
+# จบประโยคเมื่อขึ้นบรรทัดใหม่ หรือเจอ . ? ! ตามด้วยช่องว่าง
+# (ไม่ตัดหลังตัวเลข เช่น "1. " ของ bullet หรือ "6.5 ")
+# ภาษาไทยไม่มีเครื่องหมายจบประโยค ใช้ช่องว่างระหว่างอักษรไทยสองตัวแทน (ช่องว่างก่อนตัวเลข/คำอังกฤษเป็นช่องว่างกลางประโยค)
+SENTENCE_BOUNDARY = re.compile(r"\n+|(?<=[^\d\s][.!?])\s+|(?<=[\u0e00-\u0e7f])[ \t]+(?=[\u0e00-\u0e7f])")
+# ช่องว่างในภาษาไทยใช้คั่นวลีด้วย ตัดที่ช่องว่างเฉพาะเมื่อประโยคยาวพอ ไม่ให้ตรวจ guardrail ทีละวลีสั้นๆ
+MIN_SENTENCE_CHARS = int(os.environ.get("STREAM_MIN_SENTENCE_CHARS", "40"))
+# จำนวนประโยคที่ตรวจ output guardrail พร้อมกันระหว่าง stream
+STREAM_GUARD_CONCURRENCY = int(os.environ.get("STREAM_GUARD_CONCURRENCY", "4"))
+
+
+def is_streaming(config: RunnableConfig | None) -> bool:
+    """โหมด stream เปิดด้วย config={"configurable": {"stream_output": True}}"""
+    return bool((config or {}).get("configurable", {}).get("stream_output"))
+
+
+def pop_sentences(buffer: str) -> tuple[list[str], str]:
+    """
+    ตัด buffer ออกเป็นประโยคที่จบแล้ว (รวมตัวคั่นท้ายประโยคไว้ด้วยเพื่อคง format)
+    กับข้อความที่ยังพิมพ์ไม่จบซึ่งต้องรอ token ถัดไป
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(buffer):
+        if "\n" not in match.group(0) and len(buffer[start:match.start()].strip()) < MIN_SENTENCE_CHARS:
+            continue
+        sentences.append(buffer[start:match.end()])
+        start = match.end()
+    return sentences, buffer[start:]
+
+
 # ----- Function -----
 
 def input_node(state: AgentState):
@@ -93,7 +133,88 @@ def input_node(state: AgentState):
 
     return state
 
-def summarize_conversation(state: AgentState):
+# ----- Summarization -----
+
+# "background" = ตอบ user ก่อน แล้วสรุปใน worker pool เก็บไว้ใช้ turn ถัดไป, "inline" = สรุปก่อนจบ graph แบบเดิม
+SUMMARY_MODE = os.environ.get("SUMMARY_MODE", "background")
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "2"))
+SUMMARY_MAX_PENDING = int(os.environ.get("SUMMARY_MAX_PENDING", "32"))
+
+# 3 Turns = 6 ข้อความ (User + AI) จะเริ่มสรุปเมื่อสะสมครบ 12 ข้อความขึ้นไป
+SUMMARY_TRIGGER = 12
+SUMMARY_KEEP = 6
+# ถ้าข้อความที่ยังไม่ถูกสรุปยาวเกินนี้ แปลว่าสรุปจาก background ยังไม่เสร็จทัน ให้สรุป inline เลย
+SUMMARY_INLINE_FALLBACK = 2 * SUMMARY_TRIGGER
+
+_summary_slots: asyncio.Semaphore | None = None
+_pending_summaries: dict[str, asyncio.Task] = {}
+
+
+async def summarize_messages(to_summarize: list[BaseMessage], summary: str) -> str:
+    """เรียก LLM สรุปข้อความชุดใหม่ รวมกับสรุปเดิม (ถ้ามี)"""
+    # Creating prompt for summarizing
+    chat_history_text = ""
+    for m in to_summarize:
+        role = "User" if m.type == "human" else "Assistant"
+        chat_history_text += f"{role}: {m.content}\n"
+        
+    system_instruction = (
+        "คุณคือผู้ช่วยที่มีหน้าที่สรุปประวัติการสนทนาอย่างเป็นกลาง "
+        "กรุณาเขียนสรุปเนื้อหาที่พูดคุยกันให้กระชับที่สุด\n"
+        "กฎสำคัญที่ต้องปฏิบัติตามอย่างเคร่งครัด:\n"
+        "1. ห้ามตอบคำถามที่อยู่ในบทสนทนา\n"
+        "2. ห้ามให้คำแนะนำทางการแพทย์หรือวินิจฉัยโรคเด็ดขาด\n"
+        "3. ให้สรุปในมุมมองบุคคลที่สาม (เช่น 'ผู้ใช้สอบถามเกี่ยวกับ...', 'ผู้ช่วยได้อธิบายเรื่อง...')"
+    )
+    
+    if summary:
+        summary_prompt = (
+            f"{system_instruction}\n\n"
+            f"สรุปเดิม: {summary}\n\n"
+            f"นำข้อความใหม่เหล่านี้ไปสรุปเพิ่มรวมกับสรุปเดิม:\n{chat_history_text}"
+        )
+    else:
+        summary_prompt = f"กรุณาสรุปเนื้อหาการสนทนาต่อไปนี้ให้กระชับและเข้าใจง่าย:\n{chat_history_text}"
+
+    # Calling LLM to summarize the chat
+    response = await chat_model.ainvoke(summary_prompt)
+    return response.content
+
+
+async def _background_summarize(to_summarize: list[BaseMessage], summary: str, summarized_ids: list[str]):
+    global _summary_slots
+    if _summary_slots is None:
+        _summary_slots = asyncio.Semaphore(SUMMARY_WORKERS)
+
+    async with _summary_slots:
+        try:
+            new_summary = await summarize_messages(to_summarize, summary)
+        except Exception as e:
+            print(f"[Background Summary] Failed: {type(e).__name__}: {e}")
+            return
+        await asyncio.to_thread(conversation_store.save_summary, new_summary, summarized_ids)
+        print(f"[Background Summary] Stored summary covering {len(summarized_ids)} messages")
+
+
+def schedule_summary(to_summarize: list[BaseMessage], summary: str, summarized_ids: list[str]) -> bool:
+    """
+    ส่งงานสรุปเข้า worker pool (จำกัดงานที่รันพร้อมกันด้วย semaphore และจำกัดคิว)
+    คืน False ถ้าคิวเต็ม ให้ผู้เรียก fallback ไปสรุป inline
+    """
+    key = summarized_ids[-1]
+    if key in _pending_summaries:
+        # prefix เดียวกันกำลังถูกสรุปอยู่แล้วจาก request ก่อนหน้า
+        return True
+    if len(_pending_summaries) >= SUMMARY_MAX_PENDING:
+        return False
+
+    task = asyncio.create_task(_background_summarize(to_summarize, summary, summarized_ids))
+    _pending_summaries[key] = task
+    task.add_done_callback(lambda _: _pending_summaries.pop(key, None))
+    return True
+
+
+async def summarize_conversation(state: AgentState):
     """
     Summarizing both user and AI conversation, and keeping only 3 latest chat messages
     """
@@ -105,47 +226,38 @@ def summarize_conversation(state: AgentState):
     print(f"[Memory Check] Current number of messages in state: {len(messages)}")
     print("="*50)
 
-    # 3 Turns = 6 ข้อความ (User + AI) จะเริ่มสรุปเมื่อสะสมครบ 12 ข้อความขึ้นไป
-    if len(messages) > 12:
+    if len(messages) > SUMMARY_TRIGGER:
         # Extracting: keeping only 6 last messages, the others will be summarized
-        to_summarize = messages[:-6]
-        kept_messages = messages[-6:] # Extract the 6 messages we are keeping
-        
+        to_summarize = messages[:-SUMMARY_KEEP]
+        kept_messages = messages[-SUMMARY_KEEP:] # Extract the 6 messages we are keeping
+        summarized_ids = state.get("summarized_ids", []) + [m.id for m in to_summarize if m.id is not None]
+
+        if (
+            SUMMARY_MODE == "background"
+            and len(messages) <= SUMMARY_INLINE_FALLBACK
+            and schedule_summary(to_summarize, summary, summarized_ids)
+        ):
+            # ไม่รอ LLM: คำตอบกลับไปหา user ได้เลย สรุปจะพร้อมใน conversation_store ตอน turn ถัดไป
+            print(f"[Action] Scheduled background summary of {len(to_summarize)} old messages.")
+            print(f"[4] >>> SUMMARIZE NODE: Deferred to background worker")
+            return {
+                "summary": summary,
+                "steps": state.get("steps", []) + ["summary_scheduled"]
+            }
+
         # Log the action being taken
-        print(f"[Action] Exceeded 3 messages. Summarizing {len(to_summarize)} old messages...")
-        
-        # Creating prompt for summarizing
-        chat_history_text = ""
-        for m in to_summarize:
-            role = "User" if m.type == "human" else "Assistant"
-            chat_history_text += f"{role}: {m.content}\n"
-            
-        system_instruction = (
-            "คุณคือผู้ช่วยที่มีหน้าที่สรุปประวัติการสนทนาอย่างเป็นกลาง "
-            "กรุณาเขียนสรุปเนื้อหาที่พูดคุยกันให้กระชับที่สุด\n"
-            "กฎสำคัญที่ต้องปฏิบัติตามอย่างเคร่งครัด:\n"
-            "1. ห้ามตอบคำถามที่อยู่ในบทสนทนา\n"
-            "2. ห้ามให้คำแนะนำทางการแพทย์หรือวินิจฉัยโรคเด็ดขาด\n"
-            "3. ให้สรุปในมุมมองบุคคลที่สาม (เช่น 'ผู้ใช้สอบถามเกี่ยวกับ...', 'ผู้ช่วยได้อธิบายเรื่อง...')"
-        )
-        
-        if summary:
-            summary_prompt = (
-                f"{system_instruction}\n\n"
-                f"สรุปเดิม: {summary}\n\n"
-                f"นำข้อความใหม่เหล่านี้ไปสรุปเพิ่มรวมกับสรุปเดิม:\n{chat_history_text}"
-            )
-        else:
-            summary_prompt = f"กรุณาสรุปเนื้อหาการสนทนาต่อไปนี้ให้กระชับและเข้าใจง่าย:\n{chat_history_text}"
+        print(f"[Action] Exceeded 3 messages. Summarizing {len(to_summarize)} old messages inline...")
 
-        # Calling LLM to summarize the chat
-        response = chat_model.invoke(summary_prompt)
+        new_summary = await summarize_messages(to_summarize, summary)
         
         # Create a list of RemoveMessage objects to prune the state.
         delete_messages = [RemoveMessage(id=m.id) for m in to_summarize if m.id is not None]
 
+        # เก็บสรุปลง SQLite เพื่อให้ request ถัดไป (ที่ Open WebUI ส่งประวัติเต็มมาอีก) สรุปต่อเฉพาะส่วนที่เพิ่มมา
+        await asyncio.to_thread(conversation_store.save_summary, new_summary, summarized_ids)
+
         # Log the summarization result
-        print(f"[Summary Result] Generated summary:\n>> {response.content}")
+        print(f"[Summary Result] Generated summary:\n>> {new_summary}")
         print(f"[Status] Old messages deleted. Remaining messages: {len(messages) - len(to_summarize)}")
         
         # Log the exact 3 messages that are being kept
@@ -157,8 +269,10 @@ def summarize_conversation(state: AgentState):
         print("="*50 + "\n")
 
         return {
-            "summary": response.content,
-            "messages": delete_messages
+            "summary": new_summary,
+            "summarized_ids": summarized_ids,
+            "messages": delete_messages,
+            "steps": state.get("steps", []) + ["summary_inline"]
         }
     
     # Log when no summarization is needed
@@ -174,19 +288,8 @@ def summarize_conversation(state: AgentState):
     
     return {"summary": summary}
 
-def guardrail_input_node(state: AgentState):
-    """
-    ตรวจสอบ input ของ user ก่อนเข้าระบบหลัก
-    - ALLOW: คำถามสุขภาพ, แปรผลแลป, การทักทาย, บริบทอื่นๆที่เกี่ยวข้อง
-    - BLOCK: ไม่เกี่ยวกับสุขภาพเลย เช่น เกม, การเมือง, ความบันเทิง
-    """
-    state["current_node"] = "guardrail_input"
-    state["steps"].append("guardrail_input")
-
-    last_user_message = state["messages"][-1].content
-
-    print(f"[1.5] 🛡️ INPUT GUARDRAIL: Checking relevance...")
-
+async def llm_input_guard(last_user_message: str) -> tuple[str, str]:
+    """ให้ intent_model ตัดสิน ALLOW/BLOCK สำหรับข้อความที่ classifier แบบ local ไม่มั่นใจ"""
     guard_prompt = (
         "คุณคือระบบกรองคำถามของแอปพลิเคชันสุขภาพ\n"
         "หน้าที่: ตัดสินว่าข้อความของผู้ใช้ควรได้รับการประมวลผลต่อหรือไม่\n\n"
@@ -207,7 +310,7 @@ def guardrail_input_node(state: AgentState):
         f"ข้อความของผู้ใช้: {last_user_message}"
     )
 
-    result = intent_model.invoke(guard_prompt).content.strip()
+    result = (await intent_model.ainvoke(guard_prompt)).content.strip()
 
     # Parse JSON จาก LLM
     try:
@@ -221,6 +324,33 @@ def guardrail_input_node(state: AgentState):
         action = "ALLOW"
         reason = "parse error - defaulting to allow"
 
+    return action, reason
+
+
+async def guardrail_input_node(state: AgentState):
+    """
+    ตรวจสอบ input ของ user ก่อนเข้าระบบหลัก
+    - ALLOW: คำถามสุขภาพ, แปรผลแลป, การทักทาย, บริบทอื่นๆที่เกี่ยวข้อง
+    - BLOCK: ไม่เกี่ยวกับสุขภาพเลย เช่น เกม, การเมือง, ความบันเทิง
+    """
+    state["current_node"] = "guardrail_input"
+    state["steps"].append("guardrail_input")
+
+    last_user_message = state["messages"][-1].content
+
+    print(f"[1.5] 🛡️ INPUT GUARDRAIL: Checking relevance...")
+
+    # ด่านแรก: lexicon + embedding แบบ local ถ้ามั่นใจก็ไม่ต้องเรียก LLM
+    action, reason = await asyncio.to_thread(input_classifier.classify, last_user_message)
+
+    if action is None:
+        start = time.perf_counter()
+        action, reason = await llm_input_guard(last_user_message)
+        metrics.record("guardrail_input_llm_ms", (time.perf_counter() - start) * 1000)
+        metrics.incr("guardrail_input_llm_calls")
+    else:
+        metrics.incr("guardrail_input_local_decided")
+
     if action == "BLOCK":
         print(f"    🚫 BLOCKED: {reason}")
         state["steps"].append("guardrail_input_blocked")
@@ -255,18 +385,51 @@ def route_after_input_guardrail(state: AgentState):
         return "blocked"
     return "continue"
 
-def guardrail_output_node(state: AgentState):
+async def guardrail_output_node(state: AgentState):
     """
     ตรวจสอบ output ก่อนส่งให้ user
     """
     state["current_node"] = "guardrail_output"
     state["steps"].append("guardrail_output")
 
+    if state.get("output_checked"):
+        # โหมด stream ตรวจทีละประโยคไปแล้วใน call_model ไม่ต้องตรวจซ้ำทั้งก้อน
+        print("[3] 🛡️ OUTPUT GUARDRAIL: Already checked sentence by sentence while streaming")
+        if state.get("answer_cache_key"):
+            answer_cache.store(state["answer_cache_key"], state["messages"][-1].content)
+        return {
+            "steps": state.get("steps", []) + ["guardrail_streamed"]
+        }
+
     last_ai_message = state["messages"][-1].content
 
     print(f"[3] 🛡️ OUTPUT GUARDRAIL: Checking safety rules...")
 
-    guard_prompt = (
+    revised, modified = await check_output_text(last_ai_message)
+
+    if state.get("answer_cache_key"):
+        # เก็บคำตอบหลังผ่าน guardrail แล้ว ครั้งหน้าจะข้ามทั้ง generate และ guardrail
+        answer_cache.store(state["answer_cache_key"], revised)
+
+    if modified:
+        print(f"    ⚠️ MODIFIED: Response was adjusted by guardrail")
+        new_message = AIMessage(content=revised, id=state["messages"][-1].id)
+        
+        # ส่งกลับไปให้ LangGraph ทำการ Overwrite ข้อความเดิมตาม ID เอง
+        return {
+            "messages": [new_message],
+            "steps": state.get("steps", []) + ["guardrail_modified"]
+        }
+    else:
+        print("    ✅ PASSED: Response is safe")
+        return {
+            "steps": state.get("steps", []) + ["guardrail_passed"]
+        }
+
+
+def output_guard_prompt(text: str, hits: list[str] | None = None) -> str:
+    flagged = f"จุดที่ระบบคัดกรองเบื้องต้นพบ: {', '.join(hits)}\n\n" if hits else ""
+    return (
         "คุณคือหัวหน้าพยาบาลผู้ตรวจทานข้อความ (Safety Editor)\n"
         "ตรวจสอบคำตอบของ AI ตามกฎด้านล่าง แล้วตอบเป็น JSON เท่านั้น\n\n"
         "--- กฎการตรวจสอบ ---\n"
@@ -278,10 +441,34 @@ def guardrail_output_node(state: AgentState):
         '{"action": "PASSED", "revised_content": null}\n'
         "ถ้าไม่ผ่าน: "
         '{"action": "MODIFIED", "revised_content": "ข้อความที่แก้ไขแล้วทั้งหมด"}\n\n'
-        f"ข้อความที่ต้องตรวจ:\n{last_ai_message}"
+        f"{flagged}"
+        f"ข้อความที่ต้องตรวจ:\n{text}"
     )
 
-    result = chat_model.invoke(guard_prompt).content.strip()
+
+async def check_output_text(text: str, model=None) -> tuple[str, bool]:
+    """
+    ตรวจข้อความตามกฎ output guardrail
+    คืนค่า (ข้อความที่ส่งให้ user ได้, ถูกแก้ไขหรือไม่)
+    """
+    # ด่านแรก: rule-based pre-screen ถ้าไม่ติดกฎก็ไม่ต้องเรียก LLM (ดู output_safety.needs_llm_review)
+    start = time.perf_counter()
+    hits = output_safety.prescreen(text)
+    review = output_safety.needs_llm_review(text, hits)
+    metrics.record("guardrail_output_prescreen_ms", (time.perf_counter() - start) * 1000)
+    if not review:
+        metrics.incr("guardrail_output_prescreen_passed")
+        return text, False
+
+    if hits:
+        print(f"    🔎 PRE-SCREEN FLAGGED: {', '.join(hits)}")
+    else:
+        metrics.incr("guardrail_output_topic_reviews")
+    model = model or chat_model
+    start = time.perf_counter()
+    result = (await model.ainvoke(output_guard_prompt(text, hits))).content.strip()
+    metrics.record("guardrail_output_llm_ms", (time.perf_counter() - start) * 1000)
+    metrics.incr("guardrail_output_llm_calls")
 
     try:
         clean = result.replace("```json", "").replace("```", "").strip()
@@ -294,20 +481,106 @@ def guardrail_output_node(state: AgentState):
         revised = None
 
     if action == "MODIFIED" and revised:
-        print(f"    ⚠️ MODIFIED: Response was adjusted by guardrail")
-        from langchain_core.messages import AIMessage
-        new_message = AIMessage(content=revised, id=state["messages"][-1].id)
-        
-        # ส่งกลับไปให้ LangGraph ทำการ Overwrite ข้อความเดิมตาม ID เอง
-        return {
-            "messages": [new_message],
-            "steps": state.get("steps", []) + ["guardrail_modified"]
-        }
-    else:
-        print("    ✅ PASSED: Response is safe")
-        return {
-            "steps": state.get("steps", []) + ["guardrail_passed"]
-        }
+        return revised, True
+    return text, False
+
+
+_stream_guard_slots: asyncio.Semaphore | None = None
+
+
+async def check_output_sentence(sentence: str) -> str:
+    """
+    ตรวจประโยค (หรือกลุ่มประโยคที่ติดกัน) ระหว่าง stream ด้วย chat_model ตัวเดียวกับโหมดไม่ stream
+    หลายกลุ่มรันพร้อมกันได้ไม่เกิน STREAM_GUARD_CONCURRENCY
+    คงช่องว่าง/ขึ้นบรรทัดท้ายประโยคเดิมไว้ เพราะ LLM มักตัดทิ้งตอนแก้ข้อความ
+    """
+    global _stream_guard_slots
+    if not sentence.strip():
+        return sentence
+    if _stream_guard_slots is None:
+        _stream_guard_slots = asyncio.Semaphore(STREAM_GUARD_CONCURRENCY)
+
+    trailing = sentence[len(sentence.rstrip()):]
+    async with _stream_guard_slots:
+        revised, modified = await check_output_text(sentence.rstrip())
+    if modified:
+        print(f"    ⚠️ MODIFIED (stream): {sentence.strip()} -> {revised.strip()}")
+        return revised.strip() + trailing
+    return sentence
+
+
+async def stream_checked_response(prompt_messages: list[BaseMessage], gate: asyncio.Event | None = None) -> AIMessage:
+    """
+    Stream คำตอบจาก chat_model แล้วส่งออกทีละประโยคที่ผ่าน output guardrail แล้ว
+    ผ่าน stream writer ของ LangGraph (รับได้ด้วย stream_mode="custom")
+
+    การ generate กับการตรวจรันซ้อนกัน: ประโยคเริ่มถูกตรวจทันทีที่พิมพ์จบ หลายประโยคตรวจพร้อมกันได้
+    แต่ส่งออกตามลำดับเดิมเสมอ ประโยคที่ต้องให้ LLM ตรวจและอยู่ติดกันจะรวมเป็นคำขอเดียว
+    gate ใช้ในโหมด speculative: generate/ตรวจไปก่อนได้ แต่ยังไม่ส่งให้ user จนกว่า input guardrail จะ ALLOW
+    """
+    writer = get_stream_writer()
+    queue: asyncio.Queue = asyncio.Queue()
+    checks: list[asyncio.Task] = []
+    aggregate = None
+
+    flagged = ""  # ประโยคติดกันที่ pre-screen ส่งต่อให้ LLM รอตรวจรวมกัน
+
+    def start_check(sentence: str) -> asyncio.Task:
+        task = asyncio.create_task(check_output_sentence(sentence))
+        checks.append(task)
+        return task
+
+    async def flush_flagged():
+        nonlocal flagged
+        if flagged:
+            await queue.put(start_check(flagged))
+            flagged = ""
+
+    async def submit(sentence: str):
+        nonlocal flagged
+        if output_safety.needs_llm_review(sentence, output_safety.prescreen(sentence)):
+            flagged += sentence
+            return
+        await flush_flagged()
+        await queue.put(start_check(sentence))
+
+    async def produce():
+        nonlocal aggregate
+        buffer = ""
+        try:
+            async for chunk in chat_model.astream(prompt_messages):
+                aggregate = chunk if aggregate is None else aggregate + chunk
+                if isinstance(chunk.content, str):
+                    buffer += chunk.content
+                sentences, buffer = pop_sentences(buffer)
+                for sentence in sentences:
+                    await submit(sentence)
+            if buffer:
+                await submit(buffer)
+            await flush_flagged()
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    emitted = []
+    try:
+        while (check := await queue.get()) is not None:
+            checked = await check
+            if gate is not None and not gate.is_set():
+                await gate.wait()
+            writer({"content": checked})
+            emitted.append(checked)
+        await producer
+    finally:
+        pending = [task for task in [producer, *checks] if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return AIMessage(
+        content="".join(emitted).strip(),
+        usage_metadata=getattr(aggregate, "usage_metadata", None)
+    )
 
 # ----- Conditional -----
 def should_continue(state: AgentState):
@@ -332,7 +605,7 @@ def core_identity() -> str:
         "ใช้คำลงท้ายว่า 'ครับ'\n"
     )
  
-def lab_prompt(context: str, summary_context: str) -> str:
+def lab_prompt(context: str, summary_context: str, lab_context: str = "") -> str:
     return (
         core_identity()
         + "\nบทบาทของคุณ:\n"
@@ -347,6 +620,7 @@ def lab_prompt(context: str, summary_context: str) -> str:
         "- ภาวะที่เกี่ยวข้องกับการทำงานของตับ\n\n"
         f"{summary_context}\n"
         f"### ข้อมูลอ้างอิงจากคู่มือสุขภาพ:\n{context}\n\n"
+        f"{lab_context}"
         "หลักการตอบ:\n"
         "1. ถ้าผู้ใช้ถามทั่วไป ให้ตอบจากความรู้เบื้องต้น โดยอ้างอิงคู่มือด้านบนถ้าเกี่ยวข้อง\n"
         "2. ถ้าผู้ใช้ส่งค่าแลปมา ให้ตีความโดยเทียบกับข้อมูลอ้างอิงด้านบน และใช้คำว่า 'แนวโน้ม' หรือ 'ความเสี่ยงเบื้องต้น' เท่านั้น\n"
@@ -364,6 +638,19 @@ def lab_prompt(context: str, summary_context: str) -> str:
         "ให้ถามข้อมูลเพิ่มเติมที่จำเป็น เช่น อายุ น้ำหนัก โรคประจำตัว\n"
     )
  
+def lab_context_prompt(labs: list[dict], red_flags: list[str]) -> str:
+    """ผลแปลค่าแลปจาก lab_engine (deterministic) ให้ LLM ใช้แทนการเทียบตัวเลขเอง"""
+    if not labs:
+        return ""
+    text = f"### ผลเทียบค่าแลปกับเกณฑ์ในคู่มือ (คำนวณแล้ว ใช้ตามนี้):\n{lab_engine.format_lab_summary(labs)}\n\n"
+    if red_flags:
+        text += (
+            "### ข้อควรระวังเร่งด่วน:\n"
+            "ค่าแลปบางค่าเข้าเกณฑ์ที่ควรพบแพทย์โดยเร็ว ให้ขึ้นต้นคำตอบด้วยคำแนะนำนี้อย่างสุภาพ ไม่ทำให้ตกใจ:\n"
+            + "\n".join(f"- {flag}" for flag in red_flags) + "\n\n"
+        )
+    return text
+
 def no_context_prompt() -> str:
     return (
         core_identity()
@@ -372,7 +659,7 @@ def no_context_prompt() -> str:
         "หากมีผลแลปในหัวข้อเหล่านี้ ยินดีช่วยแปลผลให้ครับ\n"
     )
     
-def call_model(state: AgentState):
+async def call_model(state: AgentState, config: RunnableConfig):
     """
     Node สำหรับตอบคำถาม: ดึง Context มาใส่ใน Prompt จริงๆ
     """
@@ -380,8 +667,38 @@ def call_model(state: AgentState):
     summary = state.get("summary", "")
     last_user_message = messages[-1].content 
     
-    # 1. ดึงข้อมูลจาก Vector DB (Markdown)
-    context = retrieve_context(last_user_message)
+    labs = state.get("labs") or []
+    red_flags = state.get("red_flags") or []
+
+    # 1. ดึงข้อมูลจาก Vector DB (Markdown) เฉพาะคู่มือของโรคที่เกี่ยวข้อง (จากค่าแลป / keyword / embedding)
+    # การเลือก shard อาจต้อง embed คำถาม จึงจำกัดเวลาเหมือน retrieval ถ้าเกินเวลาค้นทุก shard ([])
+    shards = await _with_timeout(
+        run_retrieval(disease_detector.detect_shards, last_user_message, labs),
+        [], RETRIEVAL_TIMEOUT_SECONDS, note="searching all shards"
+    )
+    print(f"[1.8] 🗂️ SHARDS: {shards or 'all'}")
+    # context รวม chunk ที่ซ้อนกัน ตัดประโยคซ้ำ และจำกัดจำนวน token แล้ว (ดู context_budget) / ได้จาก cache ถ้าเคยค้น
+    documents, context = await aretrieve_with_context(last_user_message, shards, k=RETRIEVAL_K)
+
+    # 1.5 Semantic answer cache: คำถามเดิม + chunk ชุดเดิม = ใช้คำตอบที่ผ่าน guardrail แล้วได้เลย
+    cache_key = None
+    if answer_cache.is_cacheable(state):
+        cache_key = await asyncio.to_thread(
+            answer_cache.make_key, last_user_message, [chunk_id(doc) for doc in documents]
+        )
+        cached_answer = answer_cache.lookup(cache_key)
+        if cached_answer is not None:
+            if is_streaming(config):
+                # โหมด speculative: คำตอบจาก cache ก็ต้องรอ input guardrail ALLOW ก่อนเหมือนคำตอบที่ generate
+                gate = config.get("configurable", {}).get("output_gate")
+                if gate is not None and not gate.is_set():
+                    await gate.wait()
+                get_stream_writer()({"content": cached_answer})
+            return {
+                "messages": [AIMessage(content=cached_answer)],
+                "output_checked": True,
+                "steps": state.get("steps", []) + ["retrieval", "answer_cache_hit"]
+            }
     
     # Adding smurrized chat to the System Message
     summary_context = f"\n\nสรุปบริบทการสนทนาก่อนหน้านี้: {summary}" if summary else ""
@@ -389,42 +706,181 @@ def call_model(state: AgentState):
     print("=== CONTEXT ===", context)
     
     # 2. เลือก prompt ตามว่ามี context หรือไม่
-    system_prompt = lab_prompt(context, summary_context) if context else no_context_prompt()
+    lab_context = lab_context_prompt(labs, red_flags)
+    system_prompt = lab_prompt(context, summary_context, lab_context) if context or lab_context else no_context_prompt()
 
     # 3. ส่งคำสั่งที่มี "ข้อมูลอ้างอิง (Context)" ไปให้ Gemini
     print(f"[2] >>> AGENT NODE: Generating response...")
-    response = chat_model.invoke([SystemMessage(content=system_prompt)] + messages)
+    prompt_messages = [SystemMessage(content=system_prompt)] + messages
+
+    if is_streaming(config):
+        gate = config.get("configurable", {}).get("output_gate")
+        response = await stream_checked_response(prompt_messages, gate=gate)
+        return {
+            "messages": [response],
+            "output_checked": True,
+            "answer_cache_key": cache_key,
+            "steps": state.get("steps", []) + ["retrieval", "generate_stream"]
+        }
+
+    response = await chat_model.ainvoke(prompt_messages)
     
     return {
         "messages": [response], 
+        "answer_cache_key": cache_key,
         "steps": state.get("steps", []) + ["retrieval", "generate"]
     }
 
+async def speculative_agent_node(state: AgentState, config: RunnableConfig):
+    """
+    รัน input guardrail คู่กับ call_model (retrieval + generate) พร้อมกัน
+    guardrail แทบทุกครั้งตอบ ALLOW จึงไม่ต้องรอให้เสร็จก่อนค่อยเริ่มตอบ
+    ถ้า BLOCK จะยกเลิกงาน generate ทิ้ง และในโหมด stream จะไม่มีประโยคไหนหลุดออกไปก่อน (ดู output_gate)
+    """
+    base_steps = list(state.get("steps", []))
+    gate = asyncio.Event()
+    agent_config = {
+        **config,
+        "configurable": {**config.get("configurable", {}), "output_gate": gate}
+    }
+
+    start = time.perf_counter()
+    guard_task = asyncio.create_task(_timed_call("guardrail_input", guardrail_input_node, {**state, "steps": list(base_steps)}))
+    agent_task = asyncio.create_task(_timed_call("our_agent", call_model, {**state, "steps": list(base_steps)}, agent_config))
+
+    try:
+        guard_result, guard_ms = await guard_task
+    except BaseException:
+        await _cancel_and_wait(agent_task)
+        raise
+
+    if guard_result.get("blocked"):
+        await _cancel_and_wait(agent_task)
+        metrics.incr("speculative_cancelled")
+        print(f"[Speculative] Input blocked after {guard_ms:.0f} ms, generation cancelled")
+        return guard_result
+
+    gate.set()
+    agent_result, agent_ms = await agent_task
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    # เวลาที่ได้คืนเทียบกับรันต่อกัน = เวลารวมของสองงาน - เวลาจริงที่รอ
+    saved_ms = max(0.0, guard_ms + agent_ms - wall_ms)
+    metrics.record("speculative_saved_ms", saved_ms)
+    print(f"[Speculative] guardrail {guard_ms:.0f} ms | agent {agent_ms:.0f} ms | wall {wall_ms:.0f} ms | saved {saved_ms:.0f} ms")
+
+    return {
+        **guard_result,
+        **agent_result,
+        "steps": guard_result["steps"] + agent_result["steps"][len(base_steps):] + ["speculative"]
+    }
+
+
+async def _cancel_and_wait(task: asyncio.Task) -> None:
+    """ยกเลิกงานแล้วรอให้จบจริง (งานที่ยกเลิกแล้วไม่ค้าง และ exception ของมันไม่หลุดเป็น "never retrieved")"""
+    task.cancel()
+    # gather คืน CancelledError ของงานเป็นผลลัพธ์ แต่ถ้าตัว node เองถูกยกเลิกระหว่างรอจะยังส่งต่อขึ้นไป
+    (result,) = await asyncio.gather(task, return_exceptions=True)
+    if isinstance(result, Exception):
+        print(f"[Speculative] Cancelled generation ended with {type(result).__name__}: {result}")
+
+
+def route_after_speculative(state: AgentState):
+    if state.get("blocked", False):
+        return "blocked"
+    return should_continue(state)
+
+
+async def _timed_call(name: str, fn, state, config=None):
+    start = time.perf_counter()
+    if config is None:
+        result = fn(state)
+    else:
+        result = fn(state, config)
+    if asyncio.iscoroutine(result):
+        result = await result
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    metrics.record(f"node_{name}_ms", elapsed_ms)
+    return result, elapsed_ms
+
+
+def timed_node(name: str, fn):
+    """ห่อ node ให้บันทึกเวลาแต่ละ node ลง metrics (node_<name>_ms)"""
+    if "config" in inspect.signature(fn).parameters:
+        async def wrapped(state: AgentState, config: RunnableConfig):
+            result, _ = await _timed_call(name, fn, state, config)
+            return result
+    else:
+        async def wrapped(state: AgentState):
+            result, _ = await _timed_call(name, fn, state)
+            return result
+    wrapped.__name__ = fn.__name__
+    return wrapped
+
+
+# "sequential" = input -> lab -> intent -> guardrail_input -> our_agent แบบเดิม, "parallel" = รัน guardrail คู่กับ agent แบบ speculative
+GRAPH_TOPOLOGY = os.environ.get("GRAPH_TOPOLOGY", "sequential")
+
+
 # ----- Generate graph -----
-def build_graph():
+def build_graph(topology: str | None = None):
+    topology = topology or GRAPH_TOPOLOGY
     graph = StateGraph(AgentState)
 
     # ----- add nodes -----
-    graph.add_node("input", input_node)
-    graph.add_node("guardrail_input", guardrail_input_node)
-    graph.add_node("our_agent", call_model)
-    graph.add_node("guardrail_output", guardrail_output_node)
-    graph.add_node("summarize", summarize_conversation)
+    graph.add_node("input", timed_node("input", input_node))
+    graph.add_node("lab", timed_node("lab", lab_engine.lab_node))
+    graph.add_node("intent", timed_node("intent", intent_router.intent_node))
+    graph.add_node("template_reply", timed_node("template_reply", intent_router.template_reply_node))
+    graph.add_node("our_agent", timed_node("our_agent", call_model))
+    graph.add_node("guardrail_output", timed_node("guardrail_output", guardrail_output_node))
+    graph.add_node("summarize", timed_node("summarize", summarize_conversation))
 
     tool_node = ToolNode(tools=tools)
     graph.add_node("tools", tool_node)
 
     graph.set_entry_point("input")
-    graph.add_edge("input", "guardrail_input")
-
-    graph.add_conditional_edges(
-        "guardrail_input",
-        route_after_input_guardrail,
-        {
-            "blocked": END,
-            "continue": "our_agent"
-        }
-    )
+    graph.add_edge("input", "lab")
+    graph.add_edge("lab", "intent")
+    graph.add_edge("template_reply", END)
+
+    if topology == "parallel":
+        graph.add_node("speculative_agent", timed_node("speculative_agent", speculative_agent_node))
+        graph.add_conditional_edges(
+            "intent",
+            intent_router.route_after_intent,
+            {
+                "template": "template_reply",
+                "agent": "speculative_agent"
+            }
+        )
+        graph.add_conditional_edges(
+            "speculative_agent",
+            route_after_speculative,
+            {
+                "blocked": END,
+                "continue": "tools",
+                "end": "guardrail_output"
+            }
+        )
+    else:
+        graph.add_node("guardrail_input", timed_node("guardrail_input", guardrail_input_node))
+        graph.add_conditional_edges(
+            "intent",
+            intent_router.route_after_intent,
+            {
+                "template": "template_reply",
+                "agent": "guardrail_input"
+            }
+        )
+        graph.add_conditional_edges(
+            "guardrail_input",
+            route_after_input_guardrail,
+            {
+                "blocked": END,
+                "continue": "our_agent"
+            }
+        )
 
     graph.add_conditional_edges(
         "our_agent",
@@ -0,0 +1,119 @@
+# index_store.py
+"""
+ที่เก็บ index แบบมีเวอร์ชัน: ทุกครั้งที่ build จะเขียนลงโฟลเดอร์ใหม่ data/indexes/<version>/
+แล้วค่อยสลับ pointer (data/indexes/current.json) แบบ atomic ด้วย os.replace
+backend ที่เปิด index เดิมอยู่จึงไม่เห็น store ที่เขียนไม่เสร็จ และสลับไปเวอร์ชันใหม่ได้โดยไม่ต้อง restart (ดู rag_utils.reload_index)
+
+โครงสร้างของแต่ละเวอร์ชัน:
+    chroma/             Chroma persist directory
+    bm25_index.json     BM25 inverted index (lexical_index.py)
+    vector_index/       NumPy export (vector_index.py) เขียนตอน build ก่อน publish
+    ingest_state.json   hash ของไฟล์คู่มือ/chunk ที่อยู่ใน index (build ครั้งถัดไป embed เฉพาะส่วนที่เปลี่ยน)
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_ROOT = os.path.join(BASE_DIR, "data", "indexes")
+MANIFEST_PATH = os.path.join(INDEX_ROOT, "current.json")
+
+# ก่อนมีเวอร์ชัน: build เขียนที่ data/chroma_db_health แต่ store ที่ commit ไว้อยู่ที่ root ของ repo
+LEGACY_CHROMA_DIRS = [
+    os.path.join(BASE_DIR, "data", "chroma_db_health"),
+    os.path.join(BASE_DIR, "chroma_db_health"),
+]
+LEGACY_VERSION = "legacy"
+
+# เก็บเวอร์ชันเก่าไว้เผื่อ rollback (แก้ current.json ให้ชี้กลับ)
+KEEP_VERSIONS = int(os.environ.get("INDEX_KEEP_VERSIONS", "3"))
+
+
+@dataclass(frozen=True)
+class IndexPaths:
+    version: str
+    chroma_dir: str
+    bm25_path: str
+    vector_dir: str
+    state_path: str
+
+
+def version_paths(version: str) -> IndexPaths:
+    root = os.path.join(INDEX_ROOT, version)
+    return IndexPaths(
+        version=version,
+        chroma_dir=os.path.join(root, "chroma"),
+        bm25_path=os.path.join(root, "bm25_index.json"),
+        vector_dir=os.path.join(root, "vector_index"),
+        state_path=os.path.join(root, "ingest_state.json"),
+    )
+
+
+def _legacy_paths() -> IndexPaths:
+    chroma_dir = next((path for path in LEGACY_CHROMA_DIRS if os.path.exists(path)), LEGACY_CHROMA_DIRS[0])
+    return IndexPaths(
+        version=LEGACY_VERSION,
+        chroma_dir=chroma_dir,
+        bm25_path=os.path.join(BASE_DIR, "data", "bm25_index.json"),
+        vector_dir=os.path.join(BASE_DIR, "data", "vector_index"),
+        state_path=os.path.join(BASE_DIR, "data", "ingest_state.json"),
+    )
+
+
+def read_manifest() -> dict | None:
+    try:
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def current_version() -> str:
+    manifest = read_manifest()
+    return manifest["version"] if manifest else LEGACY_VERSION
+
+
+def current_paths() -> IndexPaths:
+    """path ของ index ที่ current.json ชี้อยู่ (ยังไม่เคย build แบบมีเวอร์ชัน = ตำแหน่งเดิม)"""
+    version = current_version()
+    return _legacy_paths() if version == LEGACY_VERSION else version_paths(version)
+
+
+def create_version() -> IndexPaths:
+    """สร้างโฟลเดอร์ของเวอร์ชันใหม่ (ยังไม่ถูกใช้จนกว่าจะ publish)"""
+    version = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    paths = version_paths(version)
+    os.makedirs(os.path.dirname(paths.chroma_dir), exist_ok=True)
+    return paths
+
+
+def publish(paths: IndexPaths, info: dict | None = None) -> None:
+    """สลับ current.json ให้ชี้เวอร์ชันนี้แบบ atomic (เขียนไฟล์ชั่วคราวแล้ว os.replace)"""
+    manifest = {"version": paths.version, "published_at": time.strftime("%Y-%m-%dT%H:%M:%S"), **(info or {})}
+    tmp_path = f"{MANIFEST_PATH}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def prune(keep: int = KEEP_VERSIONS) -> list[str]:
+    """ลบเวอร์ชันเก่า เก็บเวอร์ชันปัจจุบัน + ล่าสุดอีก keep เวอร์ชัน"""
+    if not os.path.isdir(INDEX_ROOT):
+        return []
+    current = current_version()
+    versions = sorted(
+        (name for name in os.listdir(INDEX_ROOT) if os.path.isdir(os.path.join(INDEX_ROOT, name))),
+        reverse=True,
+    )
+    removed = []
+    for version in versions[keep:]:
+        if version == current:
+            continue
+        shutil.rmtree(os.path.join(INDEX_ROOT, version), ignore_errors=True)
+        removed.append(version)
+    return removed
@@ -0,0 +1,176 @@
+# input_classifier.py
+"""
+ด่านคัดกรอง input แบบ local ก่อนถึง LLM guardrail
+ใช้ keyword lexicon + nearest-neighbour บน embedding (MiniLM ตัวเดียวกับ RAG) ตัดสินเคสที่ชัดเจนในระดับมิลลิวินาที
+เคสที่ไม่แน่ใจเท่านั้นที่ถูกส่งต่อให้ intent_model ตัดสินเหมือนเดิม
+"""
+import re
+import threading
+import time
+
+import numpy as np
+
+from . import metrics
+from .rag_utils import embedding_function
+
+# ----- Lexicon -----
+
+GREETINGS = {
+    "สวัสดี", "สวัสดีครับ", "สวัสดีค่ะ", "หวัดดี", "ขอบคุณ", "ขอบคุณครับ", "ขอบคุณค่ะ",
+    "ขอบคุณมาก", "ขอบใจ", "ลาก่อน", "บาย", "โอเค", "ok", "okay", "hi", "hello", "hey",
+    "thanks", "thank you", "bye",
+}
+
+HEALTH_KEYWORDS = [
+    # ค่าแลป
+    "hba1c", "a1c", "egfr", "gfr", "ldl", "hdl", "cholesterol", "triglyceride", "creatinine",
+    "bun", "fbs", "fpg", "glucose", "potassium", "sodium", "uacr", "acr", "albumin", "alt", "ast",
+    "mg/dl", "mmol", "mmhg", "ไตรกลีเซอไรด์", "คอเลสเตอรอล", "ครีเอตินิน", "โพแทสเซียม", "โซเดียม",
+    "น้ำตาล", "ผลตรวจ", "ผลเลือด", "ผลแลป", "แลป", "ค่าไต", "ค่าตับ", "ไข่ขาว", "ปัสสาวะ",
+    # โรคและอาการ (เลี่ยงคำสั้นที่เป็น substring ของคำอื่น เช่น "ยา" ใน "อยาก", "ชา" ใน "ประชาชน")
+    "เบาหวาน", "ความดัน", "ไขมัน", "โรคไต", "ไตเสื่อม", "ไตวาย", "ตับ", "หัวใจ", "โรค", "อาการ",
+    "ปวด", "เวียนหัว", "หน้ามืด", "เหนื่อย", "บวม", "มือชา", "เท้าชา", "เจ็บ", "ไข้", "สุขภาพ",
+    "หาหมอ", "คุณหมอ", "แพทย์", "โรงพยาบาล", "กินยา", "ลดน้ำหนัก", "ออกกำลังกาย",
+    "diabetes", "hypertension", "blood pressure", "kidney", "liver", "symptom", "doctor",
+]
+
+OFF_TOPIC_KEYWORDS = [
+    "เกม", "game", "ฟุตบอล", "บอล", "ดูหนัง", "หนังเรื่อง", "ซีรีส์", "เพลง", "นักร้อง", "ดารา", "การเมือง",
+    "เลือกตั้ง", "นายก", "ข่าว", "หุ้น", "คริปโต", "bitcoin", "เขียนโค้ด", "code", "python",
+    "javascript", "ทำอาหาร", "สูตรอาหาร", "ท่องเที่ยว", "เที่ยว", "โรงแรม", "ช้อปปิ้ง", "ซื้อของ",
+    "การบ้าน", "แปลภาษา",
+]
+
+# ตัวเลข + หน่วยแลป เช่น "6.1%", "160 mg/dL", "5.2 mmol/L"
+LAB_VALUE_PATTERN = re.compile(r"\d+(?:\.\d+)?\s*(?:%|mg/?dl|mmol/?l|mmhg|ml/min)", re.IGNORECASE)
+
+# ----- Labelled examples สำหรับ nearest-neighbour -----
+
+ALLOW_EXAMPLES = [
+    "HbA1c 6.1% เป็นเบาหวานไหม",
+    "eGFR 48 แย่มากไหม",
+    "LDL 160 สูงไหมครับ",
+    "ความดัน 150/95 ต้องทำยังไง",
+    "ช่วยแปลผลตรวจเลือดให้หน่อย",
+    "น้ำตาลในเลือดตอนเช้า 130 ปกติไหม",
+    "เป็นโรคไตควรกินอาหารอะไร",
+    "ช่วงนี้เวียนหัวบ่อยเกี่ยวกับความดันไหม",
+    "ไขมันในเลือดสูงต้องออกกำลังกายแบบไหน",
+    "ค่าโพแทสเซียมสูงอันตรายไหม",
+    "เบาหวานมีอาการอย่างไร",
+    "ระบบนี้ช่วยอะไรได้บ้าง",
+    "my cholesterol is high what should I do",
+    "is creatinine 1.8 bad",
+]
+
+BLOCK_EXAMPLES = [
+    "แนะนำเกมสนุกๆ หน่อย",
+    "ผลบอลเมื่อคืนเป็นยังไง",
+    "ช่วยเขียนโค้ด python ให้หน่อย",
+    "หนังเรื่องไหนน่าดูตอนนี้",
+    "แนะนำที่เที่ยวเชียงใหม่",
+    "สูตรทำต้มยำกุ้ง",
+    "ใครจะชนะเลือกตั้งครั้งหน้า",
+    "หุ้นตัวไหนน่าซื้อ",
+    "แต่งเพลงรักให้หน่อย",
+    "ช่วยทำการบ้านคณิตศาสตร์",
+    "recommend a good movie",
+    "write a javascript function",
+]
+
+# margin = (ความคล้ายสูงสุดกับ ALLOW) - (ความคล้ายสูงสุดกับ BLOCK)
+ALLOW_MARGIN = 0.10
+BLOCK_MARGIN = 0.12
+
+_lock = threading.Lock()
+_allow_vectors: np.ndarray | None = None
+_block_vectors: np.ndarray | None = None
+
+
+def _example_vectors() -> tuple[np.ndarray, np.ndarray]:
+    """embed ตัวอย่างครั้งเดียวตอนเรียกใช้ครั้งแรก (embedding ถูก normalize แล้ว dot = cosine)"""
+    global _allow_vectors, _block_vectors
+    if _allow_vectors is None:
+        with _lock:
+            if _allow_vectors is None:
+                _block_vectors = np.asarray(embedding_function.embed_documents(BLOCK_EXAMPLES), dtype=np.float32)
+                _allow_vectors = np.asarray(embedding_function.embed_documents(ALLOW_EXAMPLES), dtype=np.float32)
+    return _allow_vectors, _block_vectors
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text.strip().lower()).strip(" !?.ๆ~")
+
+
+def _compile_lexicon(keywords: list[str]) -> re.Pattern:
+    """
+    รวม keyword เป็น regex เดียว คำภาษาอังกฤษต้องตรงทั้งคำ (กัน "alt" ใน "salt", "ast" ใน "fast")
+    ส่วนคำไทยไม่มีช่องว่างคั่นคำ จึงจับแบบ substring
+    """
+    parts = []
+    for keyword in sorted(keywords, key=len, reverse=True):
+        escaped = re.escape(keyword)
+        parts.append(rf"\b{escaped}\b" if keyword.isascii() else escaped)
+    return re.compile("|".join(parts))
+
+
+HEALTH_PATTERN = _compile_lexicon(HEALTH_KEYWORDS)
+OFF_TOPIC_PATTERN = _compile_lexicon(OFF_TOPIC_KEYWORDS)
+
+
+def _lexicon_hits(text: str, pattern: re.Pattern) -> list[str]:
+    return pattern.findall(text)
+
+
+def classify(text: str) -> tuple[str | None, str]:
+    """
+    คืนค่า (action, reason)
+    action เป็น "ALLOW" / "BLOCK" เมื่อมั่นใจ หรือ None เมื่อต้องส่งให้ LLM ตัดสิน
+    """
+    start = time.perf_counter()
+    try:
+        normalized = _normalize(text)
+
+        if not normalized or normalized in GREETINGS:
+            return "ALLOW", "local: greeting"
+
+        health_hits = _lexicon_hits(normalized, HEALTH_PATTERN)
+        off_topic_hits = _lexicon_hits(normalized, OFF_TOPIC_PATTERN)
+
+        if LAB_VALUE_PATTERN.search(normalized) and not off_topic_hits:
+            return "ALLOW", "local: lab value"
+        if health_hits and not off_topic_hits:
+            return "ALLOW", f"local: health keyword ({health_hits[0]})"
+
+        allow_vectors, block_vectors = _example_vectors()
+        query = np.asarray(embedding_function.embed_query(text), dtype=np.float32)
+        margin = float((allow_vectors @ query).max() - (block_vectors @ query).max())
+
+        if margin >= ALLOW_MARGIN and not off_topic_hits:
+            return "ALLOW", f"local: embedding margin {margin:.2f}"
+        # block เองเฉพาะเมื่อ lexicon กับ embedding เห็นตรงกัน ที่เหลือให้ LLM ตัดสิน (fail-open แบบเดิม)
+        if margin <= -BLOCK_MARGIN and off_topic_hits and not health_hits:
+            return "BLOCK", f"local: off-topic ({off_topic_hits[0]}), embedding margin {margin:.2f}"
+        return None, f"uncertain: embedding margin {margin:.2f}"
+    finally:
+        metrics.record("guardrail_input_local_ms", (time.perf_counter() - start) * 1000)
+
+
+def report() -> dict:
+    """อัตราการเรียก LLM และเวลาที่ประหยัดได้ (ประมาณจาก latency เฉลี่ยของ LLM guardrail)"""
+    local = metrics.counter("guardrail_input_local_decided")
+    llm = metrics.counter("guardrail_input_llm_calls")
+    total = local + llm
+    llm_ms = metrics.mean("guardrail_input_llm_ms")
+    local_ms = metrics.mean("guardrail_input_local_ms")
+    return {
+        "total": total,
+        "decided_locally": local,
+        "llm_calls": llm,
+        "llm_call_rate": round(llm / total, 3) if total else 0.0,
+        "estimated_saved_ms_per_request": round(max(0.0, local / total * llm_ms - local_ms), 1) if total else 0.0,
+        "estimated_saved_ms_total": round(local * max(0.0, llm_ms - local_ms), 1),
+    }
+
+
+metrics.register_report("guardrail_input", report)
@@ -0,0 +1,121 @@
+# intent_router.py
+"""
+แยก intent ของข้อความล่าสุดเพื่อเลือกเส้นทางใน graph (เติม AgentState.intent)
+- greeting: ทักทาย/ขอบคุณ/ลา -> ตอบด้วย template ไม่ต้อง RAG ไม่ต้องเรียก LLM
+- system_usage: ถามว่าระบบทำอะไรได้ -> ตอบด้วย template
+- lab_interpretation: มีค่าแลป -> retrieval เฉพาะคู่มือโรคที่เกี่ยวข้อง (ดู lab_engine)
+- general_disease / out_of_scope: ผ่าน input guardrail และ agent ตามเดิม
+"""
+import re
+import time
+
+from langchain_core.messages import AIMessage
+
+from . import metrics
+from .input_classifier import GREETINGS, HEALTH_PATTERN, LAB_VALUE_PATTERN, OFF_TOPIC_PATTERN, _normalize
+
+INTENTS = ["greeting", "system_usage", "lab_interpretation", "general_disease", "out_of_scope"]
+TEMPLATE_INTENTS = {"greeting", "system_usage"}
+
+THANKS_PATTERN = re.compile(r"ขอบคุณ|ขอบใจ|thank")
+GOODBYE_PATTERN = re.compile(r"ลาก่อน|บาย|\bbye\b")
+# ข้อความทักทายสั้นๆ ที่ต่อท้ายด้วยคำอื่นเล็กน้อย เช่น "สวัสดีครับ ยินดีที่ได้รู้จัก"
+GREETING_PREFIX = re.compile(r"^(?:สวัสดี|หวัดดี|ขอบคุณ|ขอบใจ|hi|hello|hey|thanks|thank you)(?![a-z])")
+MAX_GREETING_LENGTH = 25
+
+SYSTEM_USAGE_PATTERN = re.compile(
+    r"ระบบนี้|แชทบอทนี้|บอทนี้|คุณคือใคร|คุณเป็นใคร|ช่วยอะไรได้|ทำอะไรได้|ใช้งานยังไง|ใช้งานอย่างไร|ใช้ยังไง"
+    r"|what can you do|who are you|how (?:do i|to) use",
+    re.IGNORECASE
+)
+
+GREETING_REPLY = "สวัสดีครับ ผมเป็นผู้ช่วยด้านสุขภาพเบื้องต้น มีผลตรวจหรือคำถามเรื่องสุขภาพอะไรให้ช่วยดูไหมครับ"
+THANKS_REPLY = "ยินดีครับ หากมีผลตรวจหรือคำถามเรื่องสุขภาพเพิ่มเติม สอบถามได้ตลอดครับ"
+GOODBYE_REPLY = "ขอบคุณที่ใช้บริการครับ ดูแลสุขภาพด้วยนะครับ"
+SYSTEM_USAGE_REPLY = (
+    "ผมเป็นผู้ช่วยด้านสุขภาพเบื้องต้น ไม่ใช่แพทย์ และไม่วินิจฉัยโรคครับ\n"
+    "- แปลผลค่าแลปเบื้องต้น เช่น HbA1c, น้ำตาลในเลือด, eGFR, LDL, โพแทสเซียม, ความดัน\n"
+    "- ตอบคำถามทั่วไปเรื่องเบาหวาน ความดันโลหิตสูง ไขมันในเลือดสูง โรคไตเรื้อรัง และตับ\n"
+    "พิมพ์ค่าที่ตรวจพร้อมหน่วยมาได้เลย เช่น \"HbA1c 6.1%\" หรือ \"eGFR 48\" ครับ"
+)
+
+
+def classify_intent(text: str, labs: list[dict] | None = None) -> str:
+    """จัด intent ด้วย lexicon + ผลจาก lab_engine (ไม่เรียก LLM)"""
+    normalized = _normalize(text)
+    health_hits = HEALTH_PATTERN.findall(normalized)
+
+    if not normalized or normalized in GREETINGS:
+        return "greeting"
+    if labs or LAB_VALUE_PATTERN.search(normalized):
+        return "lab_interpretation"
+    if GREETING_PREFIX.match(normalized) and len(normalized) <= MAX_GREETING_LENGTH and not health_hits:
+        return "greeting"
+    if SYSTEM_USAGE_PATTERN.search(normalized) and not health_hits:
+        return "system_usage"
+    if OFF_TOPIC_PATTERN.search(normalized) and not health_hits:
+        return "out_of_scope"
+    return "general_disease"
+
+
+def template_reply(intent: str, text: str) -> str:
+    if intent == "system_usage":
+        return SYSTEM_USAGE_REPLY
+    normalized = _normalize(text)
+    if THANKS_PATTERN.search(normalized):
+        return THANKS_REPLY
+    if GOODBYE_PATTERN.search(normalized):
+        return GOODBYE_REPLY
+    return GREETING_REPLY
+
+
+def intent_node(state: dict):
+    start = time.perf_counter()
+    last_message = state["messages"][-1]
+    intent = classify_intent(str(last_message.content), state.get("labs"))
+    metrics.record("intent_classify_ms", (time.perf_counter() - start) * 1000)
+    metrics.incr(f"intent_{intent}")
+    print(f"[1.3] 🧭 INTENT: {intent}")
+    return {
+        "intent": intent,
+        "steps": state.get("steps", []) + [f"intent_{intent}"]
+    }
+
+
+def route_after_intent(state: dict) -> str:
+    return "template" if state.get("intent") in TEMPLATE_INTENTS else "agent"
+
+
+def template_reply_node(state: dict):
+    """ตอบ greeting / system_usage ด้วยข้อความสำเร็จรูป (ไม่ผ่าน RAG และ LLM)"""
+    last_message = state["messages"][-1]
+    return {
+        "messages": [AIMessage(content=template_reply(state.get("intent"), str(last_message.content)))],
+        "steps": state.get("steps", []) + ["template_reply"]
+    }
+
+
+def record_latency(intent: str | None, total_ms: float) -> None:
+    """บันทึก latency ทั้ง request แยกตาม intent (เรียกจาก backend หลัง graph จบ)"""
+    if intent:
+        metrics.record(f"intent_{intent}_latency_ms", total_ms)
+
+
+def report() -> dict:
+    counts = {intent: metrics.counter(f"intent_{intent}") for intent in INTENTS}
+    total = sum(counts.values())
+    return {
+        "total": total,
+        "mean_classify_ms": round(metrics.mean("intent_classify_ms"), 2),
+        "intents": {
+            intent: {
+                "count": count,
+                "share": round(count / total, 3) if total else 0.0,
+                "mean_latency_ms": round(metrics.mean(f"intent_{intent}_latency_ms"), 1),
+            }
+            for intent, count in counts.items()
+        },
+    }
+
+
+metrics.register_report("intent", report)
@@ -0,0 +1,385 @@
+# lab_engine.py
+"""
+Lab engine แบบ deterministic: ดึงชื่อแลป/ค่า/หน่วยจากข้อความไทย-อังกฤษ แปลงหน่วย
+แล้วเทียบกับตารางอ้างอิงที่สร้างจาก data/processed_markdown (เช่น ช่วงเกณฑ์ G ของ eGFR, ช่วง HbA1c)
+
+ผลลัพธ์แบบมีโครงสร้างใช้ทำ red-flag triage, ใส่ใน prompt และจำกัดการค้นหาเฉพาะคู่มือโรคที่เกี่ยวข้อง
+
+สร้างตารางใหม่หลังแก้ไฟล์คู่มือ:
+    python -m agent.lab_engine
+"""
+import json
+import os
+import re
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSED_DIR = os.path.join(BASE_DIR, "data", "processed_markdown")
+REFERENCE_PATH = os.path.join(BASE_DIR, "data", "lab_reference.json")
+
+# ----- ชื่อแลปและหน่วย -----
+
+LAB_ALIASES = {
+    "hba1c": ["hba1c", "hb a1c", "a1c", "น้ำตาลสะสม", "ฮีโมโกลบินเอวันซี"],
+    "fpg": ["fasting plasma glucose", "fasting glucose", "fpg", "fbs", "น้ำตาลขณะอดอาหาร",
+            "น้ำตาลตอนเช้า", "น้ำตาลในเลือด", "ระดับน้ำตาล", "glucose"],
+    "egfr": ["egfr", "gfr", "อัตราการกรองของไต", "ค่าการกรองของไต", "ค่าการกรองไต"],
+    "ldl": ["ldl-c", "ldl", "แอลดีแอล", "ไขมันเลว"],
+    "potassium": ["potassium", "โพแทสเซียม", "โปแตสเซียม", "โพแตสเซียม", "k+"],
+    "bp": ["blood pressure", "ความดันโลหิต", "ความดัน", "bp"],
+}
+
+UNIT_PATTERNS = [
+    ("mmol/mol", r"mmol\s*/\s*mol"),
+    ("mmol/L", r"mmol\s*/\s*l|มิลลิโมล\s*/\s*ลิตร|meq\s*/\s*l"),
+    ("mg/dL", r"mg\s*/\s*dl|mg%|มก\.?\s*/\s*ดล\.?|มิลลิกรัม\s*/\s*เดซิลิตร|มิลลิกรัมต่อเดซิลิตร"),
+    ("mL/min/1.73m2", r"ml\s*/\s*min(?:\s*/\s*1\.73\s*m2?)?|มล\.?\s*/\s*นาที"),
+    ("mmHg", r"mmhg|มม\.?\s*ปรอท|มิลลิเมตรปรอท"),
+    ("%", r"%|เปอร์เซ็นต์"),
+]
+
+CANONICAL_UNITS = {
+    "hba1c": "%",
+    "fpg": "mg/dL",
+    "egfr": "mL/min/1.73m2",
+    "ldl": "mg/dL",
+    "potassium": "mmol/L",
+    "bp": "mmHg",
+}
+
+LAB_DISEASE_FILES = {
+    "hba1c": ["diabetes_knowledge.md"],
+    "fpg": ["diabetes_knowledge.md"],
+    "egfr": ["kidney_knowledge.md"],
+    "ldl": ["dyslipidemia_knowledge.md"],
+    "potassium": ["kidney_knowledge.md"],
+    "bp": ["hypertension_knowledge.md"],
+}
+
+_alias_regex = "|".join(
+    re.escape(alias)
+    for alias in sorted((a for aliases in LAB_ALIASES.values() for a in aliases), key=len, reverse=True)
+)
+_unit_regex = "|".join(f"(?:{pattern})" for _, pattern in UNIT_PATTERNS)
+
+# ชื่อแลป + คำเชื่อมสั้นๆ (เช่น ":", "ได้", "อยู่ที่") + ตัวเลข + หน่วย (ถ้ามี)
+LAB_PATTERN = re.compile(
+    rf"(?<![a-z])(?P<name>{_alias_regex})(?![a-z]|สะสม)[^\d\n]{{0,15}}?"
+    rf"(?P<value>\d+(?:[.,]\d+)?)(?:\s*/\s*(?P<value2>\d{{2,3}}))?\s*(?P<unit>{_unit_regex})?",
+    re.IGNORECASE
+)
+
+_alias_to_lab = {alias: lab for lab, aliases in LAB_ALIASES.items() for alias in aliases}
+
+# เกณฑ์ของ fpg ใช้ได้กับค่าขณะอดอาหารเท่านั้น "น้ำตาลในเลือด 130" เฉยๆ อาจเป็นค่าหลังอาหาร
+FASTING_CONTEXT_PATTERN = re.compile(
+    r"fasting|fbs|fpg|อดอาหาร|งดอาหาร|งดน้ำงดอาหาร|ก่อนอาหาร|ก่อนกินข้าว|ก่อนทานข้าว|ตื่นนอน|ตอนเช้า",
+    re.IGNORECASE
+)
+UNKNOWN_FASTING_NOTE = "ผู้ใช้ไม่ได้บอกว่าเป็นค่าขณะอดอาหาร จึงยังไม่เทียบกับเกณฑ์น้ำตาลขณะอดอาหาร ควรถามก่อนแปลผล"
+
+# ชื่อแลปอย่างเดียว (ไม่ต้องมีค่า) สำหรับติด tag ให้ chunk ตอน ingestion
+LAB_MENTION_PATTERN = re.compile(rf"(?<![a-z])(?:{_alias_regex})(?![a-z]|สะสม)", re.IGNORECASE)
+
+
+def _unit_name(raw_unit: str | None) -> str | None:
+    if not raw_unit:
+        return None
+    for name, pattern in UNIT_PATTERNS:
+        if re.fullmatch(pattern, raw_unit.strip(), re.IGNORECASE):
+            return name
+    return None
+
+
+def normalize_unit(lab: str, value: float, unit: str | None) -> tuple[float, str]:
+    """แปลงค่าเป็นหน่วยมาตรฐานของตารางอ้างอิง ถ้าไม่มีหน่วยจะเดาจากช่วงของค่า"""
+    if lab == "hba1c":
+        if unit == "mmol/mol" or (unit is None and value > 20):
+            # IFCC (mmol/mol) -> NGSP (%)
+            return round(value / 10.929 + 2.15, 1), "%"
+        return value, "%"
+    if lab == "fpg":
+        if unit == "mmol/L" or (unit is None and value < 35):
+            return round(value * 18.016), "mg/dL"
+        return value, "mg/dL"
+    if lab == "ldl":
+        if unit == "mmol/L" or (unit is None and value < 20):
+            return round(value * 38.67), "mg/dL"
+        return value, "mg/dL"
+    return value, CANONICAL_UNITS[lab]
+
+
+def extract_labs(text: str) -> list[dict]:
+    """
+    ดึงค่าแลปทั้งหมดในข้อความ
+    คืนค่า list ของ {"lab", "raw", "value", "unit", ("diastolic" สำหรับความดัน), ("fasting" สำหรับน้ำตาล)}
+    """
+    labs = []
+    seen = set()
+    fasting = FASTING_CONTEXT_PATTERN.search(text) is not None
+    for match in LAB_PATTERN.finditer(text):
+        lab = _alias_to_lab[match.group("name").lower()]
+        raw_value = float(match.group("value").replace(",", "."))
+        unit = _unit_name(match.group("unit"))
+
+        if lab == "bp":
+            if not match.group("value2"):
+                continue
+            item = {"lab": lab, "raw": match.group(0).strip(), "value": raw_value,
+                    "diastolic": float(match.group("value2")), "unit": "mmHg"}
+        else:
+            value, canonical = normalize_unit(lab, raw_value, unit)
+            item = {"lab": lab, "raw": match.group(0).strip(), "value": value, "unit": canonical}
+            if unit and unit != canonical:
+                item["original"] = f"{raw_value:g} {unit}"
+            if lab == "fpg":
+                item["fasting"] = fasting
+
+        if (lab, item["value"]) not in seen:
+            seen.add((lab, item["value"]))
+            labs.append(item)
+    return labs
+
+
+def lab_tags(text: str) -> list[str]:
+    """ชื่อแลปมาตรฐาน (key ของ LAB_ALIASES) ที่ข้อความพูดถึง เรียงตามตัวอักษร"""
+    return sorted({_alias_to_lab[match.group(0).lower()] for match in LAB_MENTION_PATTERN.finditer(text)})
+
+
+# ----- ตารางอ้างอิง -----
+
+def _read_source(filename: str) -> str:
+    path = os.path.join(PROCESSED_DIR, filename)
+    if not os.path.exists(path):
+        return ""
+    with open(path, encoding="utf-8") as f:
+        return re.sub(r"\s+", " ", f.read().replace("&lt;", "<").replace("&gt;", ">"))
+
+
+def _upper_exclusive(bound: str) -> float:
+    """เปลี่ยนขอบบนแบบรวม (เช่น 89 หรือ 6.4) เป็นขอบบนแบบไม่รวม (90 หรือ 6.5)"""
+    decimals = len(bound.split(".")[1]) if "." in bound else 0
+    return round(float(bound) + 10 ** -decimals, decimals)
+
+
+def _ckd_bands(text: str) -> list[dict] | None:
+    table = text.split("ตารางที่ 1 การแบ่งระยะของโรคไตเรื้อรังตามเกณฑ์ของอัตราการกรองของไต", 1)
+    if len(table) < 2:
+        return None
+    rows = re.findall(r"ระยะที่ (\w+) (≥ ?\d+|\d+-\d+|< ?\d+)", table[1][:600])
+    if len(rows) < 6:
+        return None
+
+    bands = []
+    for stage, bound in rows[:6]:
+        if bound.startswith("≥"):
+            band = {"min": float(bound.lstrip("≥ "))}
+        elif bound.startswith("<"):
+            band = {"max": float(bound.lstrip("< "))}
+        else:
+            low, high = bound.split("-")
+            band = {"min": float(low), "max": _upper_exclusive(high)}
+        stage_no = stage.replace("ระยะที่", "")
+        # eGFR ค่าเดียววินิจฉัยโรคไตเรื้อรังไม่ได้ (ต้องผิดปกติต่อเนื่อง 3 เดือน) บอกแค่ช่วงของเกณฑ์
+        band.update({
+            "label": f"G{stage_no}",
+            "label_th": f"อยู่ในช่วงที่เข้าเกณฑ์ G{stage_no} ของอัตราการกรองของไต ควรปรึกษาแพทย์",
+        })
+        bands.append(band)
+    return sorted(bands, key=lambda b: b.get("min", 0))
+
+
+def _hba1c_bands(text: str) -> list[dict] | None:
+    normal = re.search(r"A1C เท่ากับ (\d\.\d)% หรือน้อยกว่า", text)
+    prediabetes = re.search(r"A1C (\d\.\d)-(\d\.\d)% ถือว่าเป็นภาวะก่อนเบาหวาน", text)
+    diabetes = re.search(r"วินิจฉัยโรคเบาหวานได้เมื่อระดับ A1C ≥ ?(\d\.\d)%", text)
+    if not (normal and prediabetes and diabetes):
+        return None
+    return [
+        {"max": _upper_exclusive(normal.group(1)), "label": "normal", "label_th": "อยู่ในช่วงปกติ"},
+        {"min": float(prediabetes.group(1)), "max": float(diabetes.group(1)),
+         "label": "prediabetes", "label_th": "อยู่ในช่วงภาวะก่อนเบาหวาน (prediabetes)"},
+        {"min": float(diabetes.group(1)), "label": "diabetes_range",
+         "label_th": "อยู่ในเกณฑ์ที่ใช้ประเมินโรคเบาหวาน ต้องตรวจยืนยันกับแพทย์"},
+    ]
+
+
+def _fpg_bands(text: str) -> list[dict] | None:
+    ifg = re.search(r"\(Impaired fasting glucose; IFG\) คือ มีค่าระดับน้ำตาลในเลือด (\d+)-(\d+) มก\./ดล\.", text)
+    # หัวข้อ "เมื่อไรจึงต้องยุติการถือศีลอด": น้ำตาลต่ำกว่า 70 / มากกว่า 300
+    low = re.search(r"ระดับน้ำตาลในเลือดต่ำกว่า (\d+) มก\./ดล\. - ระดับน้ำตาลในเลือดมากกว่า \d+", text)
+    if not (ifg and low):
+        return None
+    return [
+        {"max": float(low.group(1)), "label": "hypoglycemia", "label_th": "ต่ำกว่าปกติ (น้ำตาลต่ำ)"},
+        {"min": float(low.group(1)), "max": float(ifg.group(1)), "label": "normal", "label_th": "อยู่ในช่วงปกติ"},
+        {"min": float(ifg.group(1)), "max": _upper_exclusive(ifg.group(2)),
+         "label": "impaired_fasting_glucose", "label_th": "อยู่ในช่วงน้ำตาลขณะอดอาหารผิดปกติ (ภาวะก่อนเบาหวาน)"},
+        {"min": _upper_exclusive(ifg.group(2)), "label": "diabetes_range",
+         "label_th": "อยู่ในเกณฑ์ที่ใช้ประเมินโรคเบาหวาน ต้องตรวจยืนยันซ้ำ"},
+    ]
+
+
+# ช่วงที่คู่มือไม่ได้เขียนเป็นตารางให้ดึงได้ตรงๆ ใช้ค่ามาตรฐานทั่วไป (source = "default")
+DEFAULT_BANDS = {
+    "ldl": [
+        {"max": 100, "label": "optimal", "label_th": "อยู่ในช่วงที่เหมาะสม"},
+        {"min": 100, "max": 130, "label": "near_optimal", "label_th": "ใกล้เคียงช่วงที่เหมาะสม"},
+        {"min": 130, "max": 160, "label": "borderline_high", "label_th": "ค่อนข้างสูง"},
+        {"min": 160, "max": 190, "label": "high", "label_th": "สูง"},
+        {"min": 190, "label": "very_high", "label_th": "สูงมาก"},
+    ],
+    "potassium": [
+        {"max": 3.5, "label": "low", "label_th": "ต่ำกว่าปกติ"},
+        {"min": 3.5, "max": 5.1, "label": "normal", "label_th": "อยู่ในช่วงปกติ"},
+        {"min": 5.1, "max": 6.0, "label": "high", "label_th": "สูงกว่าปกติ"},
+        {"min": 6.0, "label": "very_high", "label_th": "สูงมาก"},
+    ],
+    "bp": [
+        {"max": 120, "label": "optimal", "label_th": "อยู่ในช่วงเหมาะสม"},
+        {"min": 120, "max": 140, "label": "high_normal", "label_th": "ค่อนข้างสูงแต่ยังไม่ถึงเกณฑ์ความดันโลหิตสูง"},
+        {"min": 140, "max": 180, "label": "hypertension_range", "label_th": "อยู่ในเกณฑ์ความดันโลหิตสูง ควรวัดซ้ำ"},
+        {"min": 180, "label": "very_high", "label_th": "สูงมาก"},
+    ],
+}
+# ความดันตัวล่าง: label ตรงกับ bands ของ bp ตามลำดับความรุนแรง ใช้ค่าที่แย่กว่าระหว่างตัวบน/ตัวล่าง
+DEFAULT_DIASTOLIC_BANDS = [
+    {"max": 80, "label": "optimal", "label_th": "อยู่ในช่วงเหมาะสม"},
+    {"min": 80, "max": 90, "label": "high_normal", "label_th": "ค่อนข้างสูงแต่ยังไม่ถึงเกณฑ์ความดันโลหิตสูง"},
+    {"min": 90, "max": 110, "label": "hypertension_range", "label_th": "อยู่ในเกณฑ์ความดันโลหิตสูง ควรวัดซ้ำ"},
+    {"min": 110, "label": "very_high", "label_th": "สูงมาก"},
+]
+
+# red flag: เกณฑ์ที่ควรแนะนำพบแพทย์โดยเร็ว (ค่า, ข้อความแนะนำ)
+RED_FLAGS = {
+    "egfr": [("max", 15, "eGFR ต่ำกว่า 15 ควรพบแพทย์โรคไตโดยเร็ว"),
+             ("max", 30, "eGFR ต่ำกว่า 30 ควรได้รับการส่งต่อพบอายุรแพทย์โรคไต")],
+    "potassium": [("min", 6.0, "โพแทสเซียมตั้งแต่ 6.0 ควรพบแพทย์ทันที"),
+                  ("max", 3.0, "โพแทสเซียมต่ำกว่า 3.0 ควรพบแพทย์โดยเร็ว")],
+    "fpg": [("max", 70, "น้ำตาลต่ำกว่า 70 ถ้ามีอาการใจสั่น เหงื่อออก สับสน ควรแก้ภาวะน้ำตาลต่ำและพบแพทย์"),
+            ("min", 300, "น้ำตาลตั้งแต่ 300 ควรพบแพทย์โดยเร็ว โดยเฉพาะถ้ามีอาการอ่อนเพลีย กระหายน้ำมาก หรือซึม")],
+    "bp": [("min", 180, "ความดันตั้งแต่ 180/110 ควรพบแพทย์โดยเร็ว ถ้ามีอาการเจ็บหน้าอก ปวดศีรษะรุนแรง แขนขาอ่อนแรง ให้ไปห้องฉุกเฉิน")],
+}
+
+
+def build_reference_table() -> dict:
+    """สร้างตารางอ้างอิงจากไฟล์คู่มือใน data/processed_markdown (ใช้ค่า default เมื่อดึงไม่ได้)"""
+    extractors = {
+        "hba1c": (_hba1c_bands, "diabetes_knowledge.md"),
+        "fpg": (_fpg_bands, "diabetes_knowledge.md"),
+        "egfr": (_ckd_bands, "kidney_knowledge.md"),
+    }
+    table = {}
+    for lab, (extract, filename) in extractors.items():
+        bands = extract(_read_source(filename))
+        if bands is None:
+            print(f"WARNING: could not extract {lab} bands from {filename}")
+            continue
+        table[lab] = {"unit": CANONICAL_UNITS[lab], "source": filename, "bands": bands}
+
+    for lab, bands in DEFAULT_BANDS.items():
+        table[lab] = {"unit": CANONICAL_UNITS[lab], "source": "default", "bands": bands}
+    table["bp"]["diastolic_bands"] = DEFAULT_DIASTOLIC_BANDS
+    return table
+
+
+def load_reference_table() -> dict:
+    if os.path.exists(REFERENCE_PATH):
+        with open(REFERENCE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    return build_reference_table()
+
+
+REFERENCE_TABLE = load_reference_table()
+
+
+def _in_band(value: float, band: dict) -> bool:
+    return band.get("min", float("-inf")) <= value < band.get("max", float("inf"))
+
+
+def classify(item: dict) -> dict:
+    """เติมผลเทียบตารางอ้างอิง (band, label_th, source) และ red flag ให้ค่าแลปหนึ่งค่า"""
+    reference = REFERENCE_TABLE.get(item["lab"])
+    result = dict(item)
+    if item["lab"] == "fpg" and not item.get("fasting", True):
+        # red flag (ต่ำกว่า 70 / ตั้งแต่ 300) ยังใช้ได้ไม่ว่าจะอดอาหารหรือไม่ แต่ไม่เทียบช่วงขณะอดอาหาร
+        result["note_th"] = UNKNOWN_FASTING_NOTE
+        reference = None
+    if reference:
+        band = next((b for b in reference["bands"] if _in_band(item["value"], b)), None)
+        diastolic_bands = reference.get("diastolic_bands")
+        if band and diastolic_bands and "diastolic" in item:
+            diastolic = next((b for b in diastolic_bands if _in_band(item["diastolic"], b)), None)
+            severity = [b["label"] for b in reference["bands"]]
+            if diastolic and severity.index(diastolic["label"]) > severity.index(band["label"]):
+                band = diastolic
+        if band:
+            result.update({"band": band["label"], "label_th": band["label_th"], "source": reference["source"]})
+
+    for kind, threshold, message in RED_FLAGS.get(item["lab"], []):
+        value = item["value"]
+        if item["lab"] == "bp" and kind == "min":
+            hit = value >= threshold or item.get("diastolic", 0) >= 110
+        else:
+            hit = value < threshold if kind == "max" else value >= threshold
+        if hit:
+            result["red_flag"] = message
+            break
+    return result
+
+
+def interpret(text: str) -> list[dict]:
+    return [classify(item) for item in extract_labs(text)]
+
+
+def lab_source_files(labs: list[dict]) -> list[str]:
+    """ไฟล์คู่มือที่เกี่ยวข้องกับแลปที่พบ ใช้จำกัดขอบเขตการค้นหา"""
+    files = []
+    for item in labs:
+        for filename in LAB_DISEASE_FILES.get(item["lab"], []):
+            if filename not in files:
+                files.append(filename)
+    return files
+
+
+def format_lab_summary(labs: list[dict]) -> str:
+    """สรุปผลแลปสำหรับใส่ใน system prompt"""
+    lines = []
+    for item in labs:
+        value = f"{item['value']:g}/{item['diastolic']:g}" if item["lab"] == "bp" else f"{item['value']:g}"
+        line = f"- {item['lab'].upper()} {value} {item['unit']}"
+        if item.get("original"):
+            line += f" (แปลงจาก {item['original']})"
+        if item.get("label_th"):
+            line += f": {item['label_th']}"
+        if item.get("note_th"):
+            line += f" ({item['note_th']})"
+        if item.get("red_flag"):
+            line += f" [ต้องแนะนำพบแพทย์: {item['red_flag']}]"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def lab_node(state: dict):
+    """
+    LangGraph node: แปลผลแลปจากข้อความล่าสุดของ user แบบ deterministic
+    """
+    last_message = state["messages"][-1]
+    if last_message.type != "human":
+        return {"labs": [], "red_flags": []}
+
+    labs = interpret(str(last_message.content))
+    red_flags = [item["red_flag"] for item in labs if item.get("red_flag")]
+    if labs:
+        print(f"[1.2] 🧪 LAB ENGINE: {format_lab_summary(labs)}")
+    return {
+        "labs": labs,
+        "red_flags": red_flags,
+        "steps": state.get("steps", []) + (["lab_red_flag"] if red_flags else ["lab_parsed"] if labs else [])
+    }
+
+
+if __name__ == "__main__":
+    table = build_reference_table()
+    with open(REFERENCE_PATH, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False, indent=2)
+    print(f"Saved lab reference table ({', '.join(table)}) to {REFERENCE_PATH}")
@@ -0,0 +1,138 @@
+# lexical_index.py
+"""
+BM25 inverted index สำหรับ hybrid retrieval (BM25 + dense) สร้างตอน ingestion ใน data/MarkdownHeaderTextSplitter.py
+คำถามแลปขึ้นกับ token ตรงตัว เช่น "eGFR", "HbA1c", "LDL" และตัวเลข ซึ่ง dense search อย่างเดียวพลาดได้
+
+ตัดคำไทยด้วย pythainlp (newmm) ถ้าติดตั้งไว้ ไม่งั้นใช้ character bigram แทน
+tokenizer ที่ใช้ตอน build ถูกบันทึกไว้ในไฟล์ ตอน query ต้องใช้ตัวเดียวกัน
+"""
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BM25_INDEX_PATH = os.path.join(BASE_DIR, "data", "bm25_index.json")
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# ตัวเลข/ชื่อแลป/หน่วยภาษาอังกฤษเก็บเป็น token เดียว เช่น "6.5", "mg/dl", "hba1c" / คำไทยส่งต่อให้ตัวตัดคำ
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[./][a-z0-9]+)*|[\u0e00-\u0e7f]+")
+STOPWORDS = {
+    "ที่", "และ", "ของ", "ใน", "เป็น", "ได้", "มี", "ให้", "จะ", "ไม่", "หรือ", "กับ", "ว่า", "แต่", "โดย",
+    "จาก", "เพื่อ", "ซึ่ง", "นี้", "นั้น", "ไป", "มา", "อยู่", "คือ", "ก็", "แล้ว", "ครับ", "ค่ะ", "คะ", "ไหม",
+    "the", "of", "and", "in", "to", "is", "a", "or", "for",
+}
+
+try:
+    from pythainlp.tokenize import word_tokenize
+
+    TOKENIZER = "newmm"
+except ImportError:
+    word_tokenize = None
+    TOKENIZER = "bigram"
+
+
+def _thai_tokens(run: str) -> list[str]:
+    if word_tokenize is not None:
+        return [token for token in word_tokenize(run, engine="newmm", keep_whitespace=False) if token.strip()]
+    if len(run) < 2:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group(0)
+        if token.isascii():
+            tokens.append(token)
+        else:
+            tokens.extend(_thai_tokens(token))
+    return [token for token in tokens if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 บน inverted index: term -> [[doc, tf], ...]"""
+
+    def __init__(self, ids: list[str], source_files: list[str], doc_lengths: list[int],
+                 postings: dict[str, list[list[int]]], tokenizer: str = TOKENIZER):
+        self.ids = ids
+        self.source_files = source_files
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.tokenizer = tokenizer
+        self.avgdl = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+        count = len(ids)
+        self.idf = {
+            term: math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in postings.items()
+        }
+
+    @classmethod
+    def build(cls, ids: list[str], texts: list[str], source_files: list[str]) -> "BM25Index":
+        postings: dict[str, list[list[int]]] = defaultdict(list)
+        doc_lengths = []
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings[term].append([doc, tf])
+        return cls(ids, source_files, doc_lengths, dict(postings))
+
+    def save(self, path: str = BM25_INDEX_PATH) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "tokenizer": self.tokenizer,
+                "ids": self.ids,
+                "source_files": self.source_files,
+                "doc_lengths": self.doc_lengths,
+                "postings": self.postings,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str = BM25_INDEX_PATH) -> "BM25Index":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["source_files"], data["doc_lengths"], data["postings"], data["tokenizer"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int = 20, source_files: list[str] | None = None) -> list[tuple[str, float]]:
+        """คืนค่า [(chunk id, BM25 score)] เรียงจากคะแนนมากไปน้อย"""
+        allowed = set(source_files) if source_files else None
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc, tf in self.postings[term]:
+                if allowed is not None and self.source_files[doc] not in allowed:
+                    continue
+                length_norm = 1 - BM25_B + BM25_B * self.doc_lengths[doc] / self.avgdl
+                scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.ids[doc], score) for doc, score in top]
+
+
+def load_bm25_index(path: str = BM25_INDEX_PATH) -> BM25Index | None:
+    """โหลด index ถ้ามีและใช้ tokenizer เดียวกับตอน build ไม่งั้นคืน None (ใช้ dense อย่างเดียว)"""
+    if not os.path.exists(path):
+        return None
+    index = BM25Index.load(path)
+    if index.tokenizer != TOKENIZER:
+        print(f"WARNING: BM25 index was built with the {index.tokenizer} tokenizer but {TOKENIZER} is active, hybrid retrieval disabled")
+        return None
+    return index
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    """รวมหลายอันดับด้วย RRF: score = sum(1 / (k + rank)) ไม่ต้องปรับสเกลคะแนนของแต่ละวิธี"""
+    scores: dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] += 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
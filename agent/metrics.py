@@ -0,0 +1,76 @@
+# metrics.py
+"""
+ตัวเก็บ latency / counter แบบ in-memory สำหรับดูผ่าน /eval/metrics
+ชื่อ metric ยึดตาม eval/README.md เช่น total_latency_ms, time_to_first_token_ms
+"""
+import threading
+from collections import defaultdict, deque
+
+# เก็บเฉพาะค่าล่าสุดต่อ metric พอสำหรับคำนวณ p50/p90/p95 โดยไม่กินหน่วยความจำไม่จำกัด
+MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_samples: dict[str, deque] = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_counters: dict[str, int] = defaultdict(int)
+# รายงานเฉพาะทางที่โมดูลอื่นลงทะเบียนไว้ (เช่น อัตราการเรียก LLM ของ guardrail) คำนวณตอนเรียก snapshot
+_reports: dict = {}
+
+
+def record(name: str, value_ms: float) -> None:
+    """บันทึกค่า latency (ms) หนึ่งค่า"""
+    with _lock:
+        _samples[name].append(float(value_ms))
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """เพิ่ม counter เช่น cache hit/miss หรือจำนวนครั้งที่เรียก LLM"""
+    with _lock:
+        _counters[name] += amount
+
+
+def register_report(name: str, fn) -> None:
+    """ลงทะเบียนฟังก์ชันที่คืน dict สรุปเฉพาะทาง ให้แสดงใน snapshot() ภายใต้ key reports"""
+    _reports[name] = fn
+
+
+def counter(name: str) -> int:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def mean(name: str) -> float:
+    with _lock:
+        values = list(_samples.get(name, ()))
+    return sum(values) / len(values) if values else 0.0
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def snapshot() -> dict:
+    """สรุป metric ทั้งหมด: latency เป็น count/mean/p50/p90/p95 และ counter ดิบ"""
+    with _lock:
+        samples = {name: sorted(values) for name, values in _samples.items()}
+        counters = dict(_counters)
+
+    latencies = {}
+    for name, values in samples.items():
+        latencies[name] = {
+            "count": len(values),
+            "mean": round(sum(values) / len(values), 1) if values else 0.0,
+            "p50": round(_percentile(values, 50), 1),
+            "p90": round(_percentile(values, 90), 1),
+            "p95": round(_percentile(values, 95), 1),
+        }
+    reports = {name: fn() for name, fn in list(_reports.items())}
+    return {"latency_ms": latencies, "counters": counters, "reports": reports}
+
+
+def reset() -> None:
+    with _lock:
+        _samples.clear()
+        _counters.clear()
@@ -0,0 +1,198 @@
+# near_duplicates.py
+"""
+ยุบ chunk ที่เกือบซ้ำกันตอน ingestion ก่อน embed (MinHash + LSH บน character shingle)
+คู่มือที่แปลงจาก PDF มีหัวกระดาษ/ตาราง/ย่อหน้าซ้ำ และ chunk_overlap=250 ทำให้ซ้ำมากขึ้น
+vector ที่เกือบเหมือนกันแย่งที่กันใน top-k และเปลืองหน่วยความจำ
+
+ยุบเฉพาะภายในไฟล์คู่มือเดียวกัน (SourceFile) เพื่อให้การค้นแบบ shard ยังเห็น chunk ของโรคนั้นครบ
+chunk ที่เหลือเก็บที่มาของตัวที่ถูกยุบไว้ใน metadata Duplicates / DuplicateTopics
+
+วัดผลต่อ latency และ recall บน index ปัจจุบัน:
+    python -m agent.near_duplicates benchmark
+"""
+import json
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+from langchain_core.documents import Document
+
+NEAR_DUPLICATE_DEDUPE = os.environ.get("NEAR_DUPLICATE_DEDUPE", "1") == "1"
+# Jaccard (ประมาณจาก MinHash) ของ shingle ตั้งแต่เท่านี้ถือว่าซ้ำ
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+
+# shingle ระดับตัวอักษร ใช้ได้กับภาษาไทยที่ไม่มีช่องว่างระหว่างคำ
+SHINGLE_CHARS = 5
+NUM_PERM = 64
+# 8 band x 8 row: คู่ที่ Jaccard ~0.77 ขึ้นไปมีโอกาสชน bucket อย่างน้อยหนึ่ง band สูง แล้วค่อยเช็คกับ threshold
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 32, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 32, size=NUM_PERM).astype(np.uint64)
+
+
+def shingles(text: str) -> set[str]:
+    normalized = " ".join(text.lower().split())
+    if len(normalized) <= SHINGLE_CHARS:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_CHARS] for i in range(len(normalized) - SHINGLE_CHARS + 1)}
+
+
+def signature(text: str) -> np.ndarray:
+    """MinHash signature (NUM_PERM ค่า) ของ shingle ใน text"""
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)), dtype=np.uint64
+    )
+    permuted = ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME) & _MAX_HASH
+    return permuted.min(axis=1)
+
+
+def near_duplicate_groups(texts: list[str], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list[int]:
+    """คืน index ของกลุ่ม (index ตัวแรกของกลุ่ม) ของแต่ละข้อความ"""
+    if not texts:
+        return []
+    signatures = np.stack([signature(text) for text in texts])
+    parent = list(range(len(texts)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(BANDS):
+        buckets: dict[bytes, list[int]] = {}
+        for i, key in enumerate(signatures[:, band * ROWS:(band + 1) * ROWS]):
+            buckets.setdefault(key.tobytes(), []).append(i)
+        for members in buckets.values():
+            for a, i in enumerate(members):
+                for j in members[a + 1:]:
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j and (signatures[i] == signatures[j]).mean() >= threshold:
+                        parent[max(root_i, root_j)] = min(root_i, root_j)
+    return [find(i) for i in range(len(texts))]
+
+
+def _topic(doc: Document) -> str:
+    return " > ".join(doc.metadata[key] for key in ("Topic", "Subtopic") if doc.metadata.get(key))
+
+
+def representatives(chunks: dict[str, Document], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> dict[str, str]:
+    """chunk id -> id ของ chunk ที่เก็บไว้แทนกลุ่ม (ตัวที่ยาวที่สุด) โดยจับกลุ่มภายใน SourceFile เดียวกัน"""
+    by_file: dict[str, list[str]] = {}
+    for chunk_id, chunk in chunks.items():
+        by_file.setdefault(chunk.metadata.get("SourceFile", ""), []).append(chunk_id)
+
+    mapping = {}
+    for file_ids in by_file.values():
+        groups: dict[int, list[str]] = {}
+        roots = near_duplicate_groups([chunks[chunk_id].page_content for chunk_id in file_ids], threshold)
+        for chunk_id, root in zip(file_ids, roots):
+            groups.setdefault(root, []).append(chunk_id)
+        for members in groups.values():
+            keep = max(members, key=lambda chunk_id: len(chunks[chunk_id].page_content))
+            mapping.update((chunk_id, keep) for chunk_id in members)
+    return mapping
+
+
+def collapse_near_duplicates(chunks: dict[str, Document],
+                             threshold: float = NEAR_DUPLICATE_THRESHOLD) -> tuple[dict[str, Document], int]:
+    """
+    ยุบ chunk ที่เกือบซ้ำกัน เหลือตัวแทนของแต่ละกลุ่มพร้อมที่มาของตัวที่ถูกยุบ
+    คืนค่า (chunk ที่เหลือตามลำดับเดิม, จำนวนที่ถูกยุบ)
+    """
+    mapping = representatives(chunks, threshold)
+    collapsed: dict[str, list[str]] = {}
+    for chunk_id, keep in mapping.items():
+        if chunk_id != keep:
+            collapsed.setdefault(keep, []).append(chunk_id)
+
+    for keep, others in collapsed.items():
+        topics = dict.fromkeys(_topic(chunks[chunk_id]) for chunk_id in others)
+        chunks[keep].metadata["Duplicates"] = len(others)
+        chunks[keep].metadata["DuplicateTopics"] = " | ".join(topic for topic in topics if topic)
+
+    kept = {chunk_id: chunk for chunk_id, chunk in chunks.items() if mapping[chunk_id] == chunk_id}
+    return kept, len(chunks) - len(kept)
+
+
+# ----- Benchmark -----
+
+def _top_k(matrix: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    scores = matrix @ query
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def benchmark(k: int = 6, repeats: int = 20, threshold: float = NEAR_DUPLICATE_THRESHOLD) -> dict:
+    """
+    เทียบการค้น exact บน vector ทั้งหมดของ index ปัจจุบันกับชุดที่ยุบ near-duplicate แล้ว
+    recall@k: สัดส่วนของกลุ่มใน top-k เดิมที่ตัวแทนของกลุ่มยังอยู่ใน top-k หลังยุบ
+    distinct_groups_in_topk: ใน top-k เดิมมีเนื้อหาไม่ซ้ำกันกี่ส่วน (ต่ำ = ถูก near-duplicate เบียด)
+    index ที่ build หลังเปิด dedupe แล้วจะยุบได้น้อย ให้ build ด้วย NEAR_DUPLICATE_DEDUPE=0 ก่อนวัด
+    """
+    from .rag_utils import active_index, embedding_function
+    from .vector_index import BENCHMARK_QUERIES, _latency_summary
+
+    data = active_index().vector_db.get(include=["embeddings", "documents", "metadatas"])
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    chunks = {
+        chunk_id: Document(id=chunk_id, page_content=text, metadata=dict(meta or {}))
+        for chunk_id, text, meta in zip(data["ids"], data["documents"], data["metadatas"])
+    }
+
+    start = time.perf_counter()
+    mapping = representatives(chunks, threshold)
+    collapse_s = time.perf_counter() - start
+
+    # กลุ่มของแต่ละ row = row ของตัวแทนที่ถูกเก็บไว้
+    row_of = {chunk_id: row for row, chunk_id in enumerate(data["ids"])}
+    group_of = [row_of[mapping[chunk_id]] for chunk_id in data["ids"]]
+    kept_rows = np.array([row for row, group in enumerate(group_of) if row == group])
+    reduced = vectors[kept_rows]
+
+    queries = np.asarray(embedding_function.embed_documents(BENCHMARK_QUERIES), dtype=np.float32)
+    full_ms, reduced_ms, recall, distinct = [], [], [], []
+    for repeat in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            full_top = _top_k(vectors, query, k)
+            full_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            reduced_top = kept_rows[_top_k(reduced, query, k)]
+            reduced_ms.append((time.perf_counter() - start) * 1000)
+            if repeat == 0:
+                full_groups = {group_of[row] for row in full_top}
+                reduced_groups = {group_of[row] for row in reduced_top}
+                recall.append(len(full_groups & reduced_groups) / len(full_groups))
+                distinct.append(len(full_groups) / len(full_top))
+
+    return {
+        "chunks": len(vectors),
+        "after_collapse": len(kept_rows),
+        "shrink": round(1 - len(kept_rows) / max(1, len(vectors)), 3),
+        "threshold": threshold,
+        "collapse_seconds": round(collapse_s, 2),
+        "vector_mb": round(vectors.nbytes / 1024 / 1024, 2),
+        "vector_mb_after": round(reduced.nbytes / 1024 / 1024, 2),
+        "k": k,
+        "full": _latency_summary(full_ms),
+        "collapsed": _latency_summary(reduced_ms),
+        "recall_at_k": round(sum(recall) / len(recall), 3),
+        "distinct_groups_in_topk": round(sum(distinct) / len(distinct), 3),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        print(json.dumps(benchmark(), indent=2))
+    else:
+        print("usage: python -m agent.near_duplicates benchmark")
@@ -0,0 +1,179 @@
+# output_safety.py
+"""
+Pre-screen แบบ rule-based สำหรับ output guardrail
+ตรวจกฎ 3 ข้อเดียวกับ prompt ของ Safety Editor ด้วย automaton (Aho-Corasick) + regex
+คำตอบที่ติดธงส่งต่อให้ LLM แก้ไขพร้อมจุดที่พบ
+
+คำตอบที่ไม่ติดธงข้าม LLM ได้เลย (needs_llm_review) ตัวอย่างคำตอบที่ต้องจับได้อยู่ใน tests/test_output_safety.py
+ตั้ง OUTPUT_TOPIC_REVIEW=1 เพื่อให้ LLM ตรวจคำตอบที่พูดถึงโรค/ยาด้วยแม้ไม่ติดธง (แทบทุกคำตอบของแชทบอทนี้)
+"""
+import os
+import re
+from collections import deque
+
+from . import metrics
+
+OUTPUT_TOPIC_REVIEW = os.environ.get("OUTPUT_TOPIC_REVIEW", "0") == "1"
+
+
+class AhoCorasick:
+    """
+    Automaton ค้นหาหลาย keyword ในรอบเดียว O(len(text) + จำนวนที่เจอ)
+    ไม่สนตัวพิมพ์เล็ก/ใหญ่ และคำภาษาอังกฤษต้องไม่ติดกับตัวอักษรอื่น (กัน "arb" ใน "carb")
+    """
+
+    def __init__(self, keywords: dict[str, str]):
+        # keywords: คำ -> หมวด (เช่น "drug", "alarm")
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[tuple[str, str]]] = [[]]
+
+        for keyword, category in keywords.items():
+            node = 0
+            for char in keyword.lower():
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[node][char] = len(self._goto) - 1
+                node = self._goto[node][char]
+            self._output[node].append((keyword, category))
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text: str) -> list[tuple[str, str]]:
+        lowered = text.lower()
+        hits = []
+        node = 0
+        for end, char in enumerate(lowered):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for keyword, category in self._output[node]:
+                start = end - len(keyword) + 1
+                if keyword.isascii() and not _is_word_boundary(lowered, start, end + 1):
+                    continue
+                hits.append((keyword, category))
+        return hits
+
+
+def _is_word_boundary(text: str, start: int, end: int) -> bool:
+    before = text[start - 1] if start > 0 else " "
+    after = text[end] if end < len(text) else " "
+    return not (before.isascii() and before.isalnum()) and not (after.isascii() and after.isalnum())
+
+
+# ----- กฎข้อ 2: ชื่อยา / กลุ่มยา -----
+DRUG_NAMES = [
+    # เบาหวาน
+    "metformin", "เมทฟอร์มิน", "insulin", "อินซูลิน", "glipizide", "glibenclamide", "gliclazide",
+    "glimepiride", "pioglitazone", "sitagliptin", "vildagliptin", "linagliptin", "empagliflozin",
+    "dapagliflozin", "canagliflozin", "sglt2", "sglt-2", "dpp-4", "glp-1", "semaglutide", "liraglutide",
+    # ความดัน / โรคไต
+    "amlodipine", "แอมโลดิปีน", "nifedipine", "losartan", "ลอซาร์แทน", "valsartan", "telmisartan",
+    "enalapril", "lisinopril", "ramipril", "acei", "ace inhibitor", "arb", "atenolol", "propranolol",
+    "bisoprolol", "carvedilol", "hydrochlorothiazide", "hctz", "furosemide", "spironolactone",
+    "finerenone",
+    # ไขมัน
+    "statin", "สแตติน", "atorvastatin", "simvastatin", "rosuvastatin", "pravastatin", "pitavastatin",
+    "ezetimibe", "fenofibrate", "gemfibrozil", "pcsk9",
+    # ยาแก้ปวด / อื่นๆ ที่มักหลุดมาจาก context
+    "nsaid", "nsaids", "ibuprofen", "ไอบูโพรเฟน", "diclofenac", "naproxen", "celecoxib", "ponstan",
+    "aspirin", "แอสไพริน", "paracetamol", "พาราเซตามอล", "allopurinol", "sodium bicarbonate",
+    # กลุ่มยาที่เรียกเป็นภาษาไทย
+    "ยาลดความดัน", "ยาความดัน", "ยาเบาหวาน", "ยาลดน้ำตาล", "ยาลดไขมัน", "ยาไขมัน", "ยาขับปัสสาวะ",
+    "ยาขับน้ำ", "ยาแก้ปวด", "ยาต้านการอักเสบ", "ยาละลายลิ่มเลือด", "ยาต้านเกล็ดเลือด", "ยาฉีด",
+]
+
+# ----- กฎข้อ 2 (ต่อ): สั่งเริ่ม/หยุด/ปรับยาเอง -----
+MEDICATION_CHANGE_PATTERN = re.compile(
+    r"(?:หยุด|เลิก|งด|ลด|เพิ่ม|ปรับ|เริ่ม|เปลี่ยน|ข้าม)(?:การ)?(?:ใช้|กิน|ทาน|รับประทาน|ฉีด)?\s*(?:ยา|อินซูลิน)"
+    r"|(?:กิน|ทาน|รับประทาน|ฉีด)(?:ยา|อินซูลิน)\S*\s*(?:เพิ่ม|ลด|น้อยลง|มากขึ้น|เอง)"
+    r"|\b(?:stop|start|skip|quit)\s+(?:taking\s+)?(?:your\s+)?(?:medication|medicine|insulin|pills?)"
+    r"|\b(?:increase|decrease|reduce|double|adjust)\s+(?:your\s+)?(?:dose|dosage|medication|insulin)",
+    re.IGNORECASE
+)
+
+# ----- กฎข้อ 2 (ต่อ): วิธีใช้ยา เช่น ขนาด/ความถี่ -----
+DOSAGE_PATTERN = re.compile(
+    r"\d+(?:\.\d+)?\s*(?:mg|มก\.?|มิลลิกรัม|เม็ด|ยูนิต|unit)\s*(?:/|ต่อ)?\s*(?:วัน|day|ครั้ง|มื้อ)"
+    r"|วันละ\s*\d+\s*(?:ครั้ง|เม็ด)|(?:ก่อน|หลัง)อาหาร\s*\d+\s*(?:นาที|ชั่วโมง)",
+    re.IGNORECASE
+)
+
+# ----- กฎข้อ 3: คำที่ทำให้ตกใจ -----
+ALARM_WORDS = ["อันตราย", "วิกฤต", "วิกฤติ", "ร้ายแรง"]
+
+# ----- กฎข้อ 1: ฟันธงวินิจฉัย -----
+DISEASES = r"(?:โรค)?(?:เบาหวาน|ความดันโลหิตสูง|ความดันสูง|ไขมันในเลือดสูง|ไขมันสูง|ไตเรื้อรัง|ไตวาย|โรคไต|ไตเสื่อม|ตับอักเสบ|ไขมันพอกตับ)"
+DIAGNOSIS_PATTERNS = [
+    re.compile(rf"(?:คุณ|ท่าน|ผู้ใช้)(?:ได้)?(?:ป่วย)?เป็น\s*{DISEASES}"),
+    re.compile(rf"เป็น\s*{DISEASES}\s*(?:แน่นอน|แล้ว|อย่างแน่นอน|ชัดเจน)"),
+    re.compile(rf"(?:วินิจฉัย|ยืนยัน)(?:ได้)?ว่า(?:คุณ)?เป็น\s*{DISEASES}"),
+    re.compile(rf"(?:ถือว่า|น่าจะ|แสดงว่า|หมายความว่า|บ่งชี้ว่า|เข้าข่าย|สรุปว่า)(?:คุณ|ท่าน)?(?:ป่วย)?(?:เป็น|มี)?\s*(?:ภาวะ)?{DISEASES}"),
+    # "คุณมีภาวะ..." ทุกแบบ ยกเว้น "คุณมีภาวะเสี่ยง..." ที่เป็นคำที่กฎอนุญาต
+    re.compile(r"(?:คุณ|ท่าน)(?:มี|เข้าสู่)(?:ภาวะ|อาการของ)(?!เสี่ยง)\s*\S+"),
+    re.compile(r"\byou (?:have|are suffering from)\s+(?:diabetes|hypertension|dyslipidemia|ckd|chronic kidney disease|kidney failure)", re.IGNORECASE),
+    re.compile(r"\b(?:diagnosed with|confirms? (?:that )?you have)\b", re.IGNORECASE),
+]
+
+_automaton = AhoCorasick({
+    **{name: "drug" for name in DRUG_NAMES},
+    **{word: "alarm" for word in ALARM_WORDS},
+})
+
+
+# คำตอบที่พูดถึงโรค/ยา ส่งให้ LLM ตรวจแม้ไม่ติดธงเมื่อเปิด OUTPUT_TOPIC_REVIEW
+SENSITIVE_TOPIC_PATTERN = re.compile(
+    r"เบาหวาน|ความดัน|ไขมัน|โรคไต|ไตเรื้อรัง|ไตวาย|ไตเสื่อม|ตับ|อินซูลิน"
+    r"|(?:กิน|ทาน|ใช้|รับ|จ่าย|สั่ง|หยุด|ลด|เพิ่ม|ปรับ|เริ่ม)ยา|ยา(?:ลด|รักษา|ฉีด|เม็ด|แก้|ขับ|ต้าน)"
+    r"|\b(?:diabetes|hypertension|cholesterol|kidney|liver|medication|medicine|drug|insulin)",
+    re.IGNORECASE
+)
+
+
+def prescreen(text: str) -> list[str]:
+    """
+    คืนรายการสิ่งที่ติดกฎ เช่น ["drug: metformin", "alarm: อันตราย", "diagnosis: คุณเป็นเบาหวาน"]
+    list ว่าง = ไม่ติดกฎข้อไหน (ดู needs_llm_review ว่ายังต้องส่ง LLM หรือไม่)
+    """
+    hits = [f"{category}: {keyword}" for keyword, category in _automaton.find(text)]
+    hits += [f"dosage: {match.group(0)}" for match in DOSAGE_PATTERN.finditer(text)]
+    hits += [f"medication_change: {match.group(0)}" for match in MEDICATION_CHANGE_PATTERN.finditer(text)]
+    for pattern in DIAGNOSIS_PATTERNS:
+        hits += [f"diagnosis: {match.group(0)}" for match in pattern.finditer(text)]
+    return list(dict.fromkeys(hits))
+
+
+def needs_llm_review(text: str, hits: list[str]) -> bool:
+    """ติดธง หรือพูดถึงโรค/ยาเมื่อเปิด OUTPUT_TOPIC_REVIEW"""
+    if hits:
+        return True
+    return OUTPUT_TOPIC_REVIEW and SENSITIVE_TOPIC_PATTERN.search(text) is not None
+
+
+def report() -> dict:
+    passed = metrics.counter("guardrail_output_prescreen_passed")
+    llm = metrics.counter("guardrail_output_llm_calls")
+    total = passed + llm
+    return {
+        "total": total,
+        "passed_without_llm": passed,
+        "llm_calls": llm,
+        "llm_topic_reviews": metrics.counter("guardrail_output_topic_reviews"),
+        "llm_call_rate": round(llm / total, 3) if total else 0.0,
+        "mean_prescreen_ms": round(metrics.mean("guardrail_output_prescreen_ms"), 2),
+        "mean_llm_ms": round(metrics.mean("guardrail_output_llm_ms"), 1),
+    }
+
+
+metrics.register_report("guardrail_output", report)
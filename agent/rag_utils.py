@@ -1,45 +1,610 @@
 # rag_utils.py
 import os
-from langchain_huggingface import HuggingFaceEmbeddings
+import asyncio
+import hashlib
+import json
+import queue
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_chroma import Chroma
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-PERSIST_DIRECTORY = os.path.join(BASE_DIR, "data", "chroma_db_health")
+from . import context_budget, index_store, metrics
+from .embedding_backend import load_embedding_model
+from .index_store import IndexPaths
+from .lexical_index import load_bm25_index, reciprocal_rank_fusion
+from .vector_index import NumpyIndex, filter_source_files, render_chunk
 
-# โหลด Embedding Model (บังคับ CPU เหมือนเดิมเพื่อแก้บั๊ก Mac)
-embedding_function = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
-    model_kwargs={'device': 'cpu'},
-    encode_kwargs={'normalize_embeddings': True}
-)
+# "chroma" = ค้นผ่าน Chroma, "numpy" = ค้นใน matrix ที่ export ไว้ (ดู vector_index.py)
+RETRIEVER_BACKEND = os.environ.get("RETRIEVER_BACKEND", "chroma")
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "2048"))
+# รอ request อื่นที่เข้ามาใกล้ๆ กันไม่เกินเท่านี้ แล้ว encode รวมเป็น batch เดียว
+EMBEDDING_BATCH_WINDOW_MS = float(os.environ.get("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH = int(os.environ.get("EMBEDDING_MAX_BATCH", "32"))
+
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "256"))
+RETRIEVAL_CACHE_TTL_SECONDS = int(os.environ.get("RETRIEVAL_CACHE_TTL_SECONDS", "600"))
+# retrieval ที่ช้ากว่านี้ถูกตัดทิ้งแล้วตอบแบบไม่มี context (no_context_prompt) แทนการรอ
+RETRIEVAL_TIMEOUT_SECONDS = float(os.environ.get("RETRIEVAL_TIMEOUT_SECONDS", "5"))
+
+
+def _default_retrieval_workers() -> int:
+    """ขนาด pool เท่ากับจำนวน intra-op thread ของ torch (ไม่มี torch เช่นใช้ ONNX ใช้จำนวน CPU)"""
+    try:
+        import torch
+        return max(1, torch.get_num_threads())
+    except ImportError:
+        return max(1, os.cpu_count() or 1)
+
+
+RETRIEVAL_WORKERS = int(os.environ.get("RETRIEVAL_WORKERS", "0")) or _default_retrieval_workers()
+# pool แยกจาก default executor ของ asyncio งาน retrieval ที่ค้างจึงไม่ไปแย่ง thread ของงานอื่น
+# และจำนวน embedding/Chroma query ที่รันพร้อมกันถูกจำกัดไว้ไม่เกินจำนวน core
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+
+def normalize_query(text: str) -> str:
+    # ไม่แปลงตัวพิมพ์เล็ก/ใหญ่ เพราะ tokenizer ของ MiniLM แยกตัวพิมพ์ (ผลจะต่างจากไม่ใช้ cache)
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingService(Embeddings):
+    """
+    ห่อ embedding model ให้มี LRU cache ตามข้อความที่ normalize แล้ว
+    และรวม request ที่เข้ามาพร้อมๆ กันจากหลาย thread เป็น forward pass เดียว (micro-batching)
+    แทนที่จะรัน batch ขนาด 1 หลายๆ ครั้งแย่ง CPU กัน
+    """
+
+    def __init__(self, embeddings: Embeddings, cache_size: int = EMBEDDING_CACHE_SIZE,
+                 batch_window_ms: float = EMBEDDING_BATCH_WINDOW_MS, max_batch: int = EMBEDDING_MAX_BATCH):
+        self.embeddings = embeddings
+        self.cache_size = cache_size
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[tuple[str, Future]] = queue.Queue()
+        self._worker: threading.Thread | None = None
+
+    # ----- cache -----
+    def _cache_get(self, key: str) -> list[float] | None:
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            return vector
+
+    def _cache_put(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # ----- micro-batching -----
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            try:
+                deadline = time.perf_counter() + self.batch_window
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                self._encode_batch(batch)
+            except Exception as e:
+                # error ใดๆ ในรอบนี้ (encode, cache, future ที่ถูกยกเลิก) ต้องไม่ทำให้ thread ตาย
+                # และผู้ที่ยังรอ future ใน batch นี้ต้องได้ exception กลับไป ไม่ค้างตลอดไป
+                metrics.incr("embedding_batch_errors")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _encode_batch(self, batch: list[tuple[str, Future]]) -> None:
+        # ข้อความซ้ำใน batch เดียวกัน encode ครั้งเดียว
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        start = time.perf_counter()
+        vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+        metrics.record("embedding_encode_ms", (time.perf_counter() - start) * 1000)
+        metrics.incr("embedding_batches")
+        metrics.incr("embedding_batched_texts", len(texts))
+        for text, vector in vectors.items():
+            self._cache_put(text, vector)
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def _submit(self, text: str) -> Future:
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    # ----- Embeddings interface -----
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [normalize_query(text) for text in texts]
+        results: dict[str, list[float]] = {}
+        futures: dict[str, Future] = {}
+        for key in keys:
+            if key in results or key in futures:
+                continue
+            vector = self._cache_get(key)
+            if vector is not None:
+                results[key] = vector
+                metrics.incr("embedding_cache_hits")
+            else:
+                futures[key] = self._submit(key)
+                metrics.incr("embedding_cache_misses")
+        for key, future in futures.items():
+            results[key] = future.result()
+        return [results[key] for key in keys]
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def report(self) -> dict:
+        hits = metrics.counter("embedding_cache_hits")
+        misses = metrics.counter("embedding_cache_misses")
+        batches = metrics.counter("embedding_batches")
+        return {
+            "cache_size": len(self._cache),
+            "cache_hits": hits,
+            "cache_misses": misses,
+            "cache_hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+            "batches": batches,
+            "mean_batch_size": round(metrics.counter("embedding_batched_texts") / batches, 2) if batches else 0.0,
+            "batch_errors": metrics.counter("embedding_batch_errors"),
+            "mean_encode_ms": round(metrics.mean("embedding_encode_ms"), 1),
+        }
+
+
+# โหลด Embedding Model (torch หรือ ONNX int8 ตาม EMBEDDING_BACKEND ดู embedding_backend.py)
+base_embedding_function = load_embedding_model()
+embedding_function = EmbeddingService(base_embedding_function)
+metrics.register_report("embedding", embedding_function.report)
+
+# BM25 index ที่ build คู่กับ vector DB (ไม่มีไฟล์ = dense อย่างเดียว) ดู lexical_index.py
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "1") == "1"
+# จำนวนผู้สมัครจากแต่ละวิธีก่อนรวมด้วย RRF
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "20"))
+# ความถี่ที่ request path เช็ค data/indexes/current.json ว่ามีเวอร์ชันใหม่หรือไม่ (0 = ไม่เช็ค ต้องเรียก reload_index เอง)
+INDEX_RELOAD_CHECK_SECONDS = float(os.environ.get("INDEX_RELOAD_CHECK_SECONDS", "10"))
+
+
+def index_version() -> str:
+    """
+    เวอร์ชันของ index ที่ใช้ตอบอยู่ (ดู index_store.py)
+    เปลี่ยนเมื่อ reload_index สลับไปเวอร์ชันใหม่ cache ที่อิงเวอร์ชันเก่าจึงหมดอายุเอง
+    """
+    return active_index().version
+
+
+class RetrievalCache:
+    """
+    LRU + TTL cache ของผล retrieval (Document + context ที่ประกอบแล้ว)
+    key = (query ที่ normalize, k, filter/shard) และล้างทั้งหมดเมื่อ index_version() เปลี่ยน
+    """
+
+    def __init__(self, size: int = RETRIEVAL_CACHE_SIZE, ttl_seconds: int = RETRIEVAL_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[tuple, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._version: str | None = None
+
+    @staticmethod
+    def make_key(query: str, k: int, scope) -> tuple:
+        return normalize_query(query), k, json.dumps(scope, sort_keys=True, ensure_ascii=False)
+
+    def _check_version(self) -> None:
+        version = index_version()
+        if version != self._version:
+            if self._version is not None:
+                metrics.incr("retrieval_cache_invalidations")
+                print("[Retrieval Cache] Index changed, cache cleared")
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key: tuple):
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.incr("retrieval_cache_hits" if entry is not None else "retrieval_cache_misses")
+        return entry[1] if entry is not None else None
+
+    def put(self, key: tuple, value) -> None:
+        with self._lock:
+            self._check_version()
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def report(self) -> dict:
+        hits = metrics.counter("retrieval_cache_hits")
+        misses = metrics.counter("retrieval_cache_misses")
+        return {
+            "size": len(self._entries),
+            "capacity": self.size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+            "invalidations": metrics.counter("retrieval_cache_invalidations"),
+        }
+
+
+retrieval_cache = RetrievalCache()
+metrics.register_report("retrieval_cache", retrieval_cache.report)
+
+
+def chunk_id(doc: Document) -> str:
+    """ID ของ chunk จาก vector store (ถ้าไม่มีใช้ hash ของเนื้อหาแทน)"""
+    if getattr(doc, "id", None):
+        return str(doc.id)
+    return hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()[:16]
+
+
+def source_filter(source_files: list[str] | None) -> dict | None:
+    """filter ของ Chroma สำหรับจำกัดการค้นหาเฉพาะไฟล์คู่มือที่ระบุ (metadata SourceFile)"""
+    if not source_files:
+        return None
+    if len(source_files) == 1:
+        return {"SourceFile": source_files[0]}
+    return {"SourceFile": {"$in": list(source_files)}}
+
+
+class RetrievalIndex:
+    """
+    index หนึ่งเวอร์ชัน: Chroma + BM25 + NumPy export (ถ้าใช้ RETRIEVER_BACKEND=numpy) จากโฟลเดอร์เดียวกัน
+    request หนึ่งถือ object เดียวตลอดการค้น จึงไม่เห็น dense กับ BM25 คนละเวอร์ชันระหว่าง hot-swap
+    """
+
+    def __init__(self, paths: IndexPaths):
+        self.paths = paths
+        self.version = paths.version
+        self._vector_db = None
+        self._vector_db_lock = threading.Lock()
+        self.numpy_index = self._load_numpy_index()
+        self.bm25_index = load_bm25_index(paths.bm25_path) if HYBRID_RETRIEVAL else None
+
+    @property
+    def vector_db(self) -> Chroma:
+        # เปิด Chroma เมื่อต้องใช้จริง worker ที่ค้นจาก NumPy export จึงไม่ต้องโหลด SQLite/HNSW ของตัวเอง
+        if self._vector_db is None:
+            with self._vector_db_lock:
+                if self._vector_db is None:
+                    self._vector_db = Chroma(
+                        persist_directory=self.paths.chroma_dir,
+                        embedding_function=embedding_function
+                    )
+        return self._vector_db
+
+    def _load_numpy_index(self) -> NumpyIndex | None:
+        if RETRIEVER_BACKEND != "numpy":
+            return None
+        try:
+            index = NumpyIndex(self.paths.vector_dir)
+            mode = "pq + exact re-rank" if index.codes is not None else "exact"
+            print(f"[RAG] Using NumPy vector index ({len(index)} chunks, {index.vectors.dtype}, {mode})")
+            return index
+        except FileNotFoundError:
+            print(f"WARNING: {self.paths.vector_dir} not found (run python -m agent.vector_index export), falling back to Chroma")
+            return None
+
+    def search_by_vector_with_scores(self, query_vector: list[float], k: int = 6, filter: dict | None = None) -> list[tuple[Document, float]]:
+        """ค้นด้วย vector คืน [(Document, cosine)] (มากกว่า = ใกล้กว่า) เพื่อรวมผลจากหลาย shard"""
+        if self.numpy_index is not None:
+            return self.numpy_index.similarity_search_with_scores(query_vector, k=k, filter=filter)
+        results = self.vector_db.similarity_search_by_vector_with_relevance_scores(query_vector, k=k, filter=filter)
+        # Chroma คืน squared L2 distance บน vector ที่ normalize แล้ว: d = 2 - 2cos
+        return [(doc, 1 - distance / 2) for doc, distance in results]
+
+    def documents_by_ids(self, ids: list[str]) -> dict[str, Document]:
+        if not ids:
+            return {}
+        if self.numpy_index is not None:
+            return {doc.id: doc for doc in self.numpy_index.get_by_ids(ids)}
+        data = self.vector_db.get(ids=ids, include=["documents", "metadatas"])
+        return {
+            chunk: Document(id=chunk, page_content=text, metadata=meta or {})
+            for chunk, text, meta in zip(data["ids"], data["documents"], data["metadatas"])
+        }
+
+    def candidates(self, query: str, query_vector: list[float], k: int = 6,
+                   filter: dict | None = None) -> tuple[list[tuple[Document, float]], list[tuple[str, float]]]:
+        """
+        ผู้สมัครก่อน fusion: ([(Document, cosine)], [(chunk id, BM25 score)])
+        คะแนนทั้งสองแบบเทียบกันได้ข้าม shard (BM25 ใช้ idf/avgdl ของทั้ง corpus) จึงรวมหลาย shard ก่อนค่อย fuse ได้
+        """
+        if self.bm25_index is None:
+            return self.search_by_vector_with_scores(query_vector, k, filter), []
+        candidates = max(k, HYBRID_CANDIDATES)
+        dense = self.search_by_vector_with_scores(query_vector, candidates, filter)
+        lexical = self.bm25_index.search(query, candidates, filter_source_files(filter))
+        return dense, lexical
+
+    def fuse(self, dense: list[tuple[Document, float]], lexical: list[tuple[str, float]], k: int = 6) -> list[tuple[Document, float]]:
+        """
+        รวมอันดับจาก dense + BM25 ด้วย reciprocal rank fusion (ไม่มี BM25 = เรียงตาม cosine)
+        ผลจากหลาย shard ต้องต่อกันก่อนเรียก เพื่อให้จัดอันดับจากคะแนนดิบ ไม่ใช่จากอันดับภายใน shard
+        """
+        dense = sorted(dense, key=lambda hit: hit[1], reverse=True)
+        if self.bm25_index is None:
+            return dense[:k]
+        lexical = sorted(lexical, key=lambda hit: hit[1], reverse=True)
+
+        docs = {chunk_id(doc): doc for doc, _ in dense}
+        fused = reciprocal_rank_fusion([list(docs), [chunk for chunk, _ in lexical]])[:k]
+        docs.update(self.documents_by_ids([chunk for chunk, _ in fused if chunk not in docs]))
+        return [(docs[chunk], score) for chunk, score in fused if chunk in docs]
+
+    def search_hits(self, query: str, query_vector: list[float], k: int = 6, filter: dict | None = None) -> list[tuple[Document, float]]:
+        """ค้นแบบ hybrid: อันดับจาก dense + อันดับจาก BM25 รวมด้วย reciprocal rank fusion คืน [(Document, score)]"""
+        dense, lexical = self.candidates(query, query_vector, k, filter)
+        return self.fuse(dense, lexical, k)
+
+    def warm_up(self) -> None:
+        """ค้นหนึ่งครั้งก่อนรับ traffic จริง ให้ Chroma โหลด HNSW/SQLite page และ BM25 ถูกแตะครบ"""
+        self.search_hits("warm up", embedding_function.embed_query("warm up"), 1)
+
+
+# โหลด Database เตรียมไว้เลย (จะได้ไม่ต้องโหลดใหม่ทุกครั้งที่เรียก) จากเวอร์ชันที่ current.json ชี้
+_active_index = RetrievalIndex(index_store.current_paths())
+_reload_lock = threading.Lock()
+_last_reload_check = time.monotonic()
+# hybrid ได้ recall เท่าเดิมด้วย k ที่น้อยกว่า จึงลด context ลงจาก 6 เป็น 4 chunk
+RETRIEVAL_K = int(os.environ.get("RETRIEVAL_K", "4" if _active_index.bm25_index is not None else "6"))
+
+
+def active_index() -> RetrievalIndex:
+    return _active_index
+
+
+def reload_index(force: bool = False) -> bool:
+    """
+    เปิด index เวอร์ชันที่ current.json ชี้ warm-up แล้วค่อยสลับ reference (atomic ใน Python)
+    request ที่กำลังค้นอยู่ใช้ index เดิมจนจบ ไม่ต้อง restart process
+    คืน True ถ้าสลับแล้ว (มี reload อื่นทำอยู่หรือเป็นเวอร์ชันเดิมคืน False)
+    """
+    global _active_index
+    if not _reload_lock.acquire(blocking=False):
+        return False
+    try:
+        paths = index_store.current_paths()
+        if paths.version == _active_index.version and not force:
+            return False
+        start = time.perf_counter()
+        index = RetrievalIndex(paths)
+        index.warm_up()
+        previous, _active_index = _active_index.version, index
+        retrieval_cache.clear()
+        metrics.incr("index_reloads")
+        metrics.record("index_reload_ms", (time.perf_counter() - start) * 1000)
+        print(f"[RAG] Index swapped {previous} -> {index.version} ({(time.perf_counter() - start) * 1000:.0f} ms)")
+        return True
+    except Exception as e:
+        # เวอร์ชันใหม่เปิดไม่ได้ ใช้ของเดิมต่อ
+        metrics.incr("index_reload_failures")
+        print(f"WARNING: failed to load index {index_store.current_version()}: {e}")
+        return False
+    finally:
+        _reload_lock.release()
+
+
+def maybe_reload_index() -> None:
+    """เรียกจาก request path: เช็ค current.json ไม่เกินทุก INDEX_RELOAD_CHECK_SECONDS ถ้าเปลี่ยนโหลดใน background thread"""
+    global _last_reload_check
+    if INDEX_RELOAD_CHECK_SECONDS <= 0 or time.monotonic() - _last_reload_check < INDEX_RELOAD_CHECK_SECONDS:
+        return
+    _last_reload_check = time.monotonic()
+    if index_store.current_version() != _active_index.version and not _reload_lock.locked():
+        threading.Thread(target=reload_index, name="index-reload", daemon=True).start()
+
+
+def search_hits(query: str, query_vector: list[float], k: int = 6, filter: dict | None = None) -> list[tuple[Document, float]]:
+    return active_index().search_hits(query, query_vector, k, filter)
+
+
+def retrieve_documents(query: str, k: int = 6, filter: dict | None = None) -> list[Document]:
+    """
+    รับคำถาม -> ค้นหา Vector DB (+ BM25) -> คืนค่าเป็น Document ที่เจอ
+    filter: metadata filter ของ Chroma เช่น source_filter(["kidney_knowledge.md"])
+    """
+    try:
+        return [doc for doc, _ in search_hits(query, embedding_function.embed_query(query), k, filter)]
+    except Exception as e:
+        print(f"Error retrieval: {e}")
+        return []
+
+
+def retrieve_documents_batch(queries: list[str], k: int = 6, filter: dict | None = None) -> list[list[Document]]:
+    """หลายคำถามพร้อมกัน: encode ทุกคำถามใน forward pass เดียว แล้วค้นทีละ vector"""
+    try:
+        vectors = embedding_function.embed_documents(queries)
+        return [
+            [doc for doc, _ in search_hits(query, vector, k, filter)]
+            for query, vector in zip(queries, vectors)
+        ]
+    except Exception as e:
+        print(f"Error retrieval: {e}")
+        return [[] for _ in queries]
+
+
+def retrieve_sharded(query: str, shards: list[str], k: int = 6) -> list[Document]:
+    """ค้นเฉพาะ shard (ไฟล์คู่มือ) ที่ระบุทีละ shard แล้วรวม top-k (ดู _fuse_shards) ถ้า shards ว่างค้นทั้งหมด"""
+    if len(shards) <= 1:
+        return retrieve_documents(query, k, source_filter(shards))
+    index = active_index()
+    try:
+        vector = embedding_function.embed_query(query)
+        per_shard = [index.candidates(query, vector, k, source_filter([shard])) for shard in shards]
+    except Exception as e:
+        print(f"Error retrieval: {e}")
+        return []
+    return _fuse_shards(index, per_shard, k)
+
+
+def _fuse_shards(index: RetrievalIndex, per_shard: list[tuple[list, list]], k: int) -> list[Document]:
+    """
+    รวมผลหลาย shard จากคะแนนดิบ (cosine / BM25) แล้ว fuse ครั้งเดียว
+    ไม่เรียงด้วย RRF ของแต่ละ shard เพราะอันดับ 1 ของ shard เล็กจะได้คะแนนเท่าอันดับ 1 ของ shard หลักเสมอ
+    """
+    dense = [hit for hits, _ in per_shard for hit in hits]
+    lexical = [hit for _, hits in per_shard for hit in hits]
+    return [doc for doc, _ in index.fuse(dense, lexical, k)]
+
+
+def format_context(results: list[Document]) -> str:
+    # เอาเนื้อหาที่ render ไว้ตอน ingestion (metadata Rendered) มาต่อกัน พร้อมบอกที่มา
+    return "".join(f"[ข้อมูลที่ {i+1} {render_chunk(doc)}\n\n" for i, doc in enumerate(results))
 
-# โหลด Database เตรียมไว้เลย (จะได้ไม่ต้องโหลดใหม่ทุกครั้งที่เรียก)
-vector_db = Chroma(
-    persist_directory=PERSIST_DIRECTORY,
-    embedding_function=embedding_function
-)
 
 def retrieve_context(query: str, k: int = 6) -> str:
     """
     รับคำถาม -> ค้นหา Vector DB -> คืนค่าเป็น Text (Context)
     """
+    maybe_reload_index()
+    key = RetrievalCache.make_key(query, k, "format_context")
+    context = retrieval_cache.get(key)
+    if context is None:
+        documents = retrieve_documents(query, k)
+        context = format_context(documents)
+        if documents:
+            retrieval_cache.put(key, context)
+    return context
+
+
+def retrieve_contexts(queries: list[str], k: int = 6) -> list[str]:
+    """เวอร์ชัน batch ของ retrieve_context สำหรับ eval หรือ multi-query"""
+    return [format_context(results) for results in retrieve_documents_batch(queries, k)]
+
+
+async def run_retrieval(fn, *args):
+    """รันงาน retrieval แบบ sync (embedding / Chroma / BM25) ใน retrieval_executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(retrieval_executor, partial(fn, *args))
+
+
+async def _with_timeout(coro, fallback, timeout: float | None, note: str = "continuing without context"):
+    """
+    timeout แล้วคืน fallback แทน (งานใน thread ยกเลิกกลางคันไม่ได้ แต่ pool มีขนาดจำกัด
+    request อื่นจึงไม่ต้องรอตาม)
+    """
+    start = time.perf_counter()
     try:
-        results = vector_db.similarity_search(query, k=k)
-        
-        if not results:
-            return ""
-
-        # เอาเนื้อหามาต่อๆ กัน พร้อมบอกที่มา
-        context_str = ""
-        for i, doc in enumerate(results):
-            source = doc.metadata.get("Disease", "Unknown Source")
-            topic = doc.metadata.get("Topic", "")
-            content = doc.page_content.replace("\n", " ") # ลบ newline ให้ต่อกันสวยๆ
-            
-            context_str += f"[ข้อมูลที่ {i+1} จาก: {source} - {topic}]:\n{content}\n\n"
-            
-        return context_str
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        metrics.incr("retrieval_timeouts")
+        print(f"WARNING: retrieval timed out after {timeout:.1f}s, {note}")
+        return fallback
+    finally:
+        metrics.record("retrieval_latency_ms", (time.perf_counter() - start) * 1000)
+
+
+def report() -> dict:
+    return {
+        "workers": RETRIEVAL_WORKERS,
+        "timeout_seconds": RETRIEVAL_TIMEOUT_SECONDS,
+        "timeouts": metrics.counter("retrieval_timeouts"),
+        "mean_latency_ms": round(metrics.mean("retrieval_latency_ms"), 1),
+        "index_version": index_version(),
+        "index_reloads": metrics.counter("index_reloads"),
+        "index_reload_failures": metrics.counter("index_reload_failures"),
+        "mean_index_reload_ms": round(metrics.mean("index_reload_ms"), 1),
+    }
+
+
+metrics.register_report("retrieval", report)
+
+
+async def aretrieve_documents(query: str, k: int = 6, filter: dict | None = None,
+                              timeout: float | None = RETRIEVAL_TIMEOUT_SECONDS) -> list[Document]:
+    """
+    เวอร์ชัน async ของ retrieve_documents สำหรับ graph ที่รันด้วย ainvoke
+    งาน embedding + Chroma เป็น CPU/IO แบบ sync จึงโยนไปรันใน retrieval_executor
+    เพื่อไม่ให้ event loop ของ uvicorn ค้าง
+    """
+    return await _with_timeout(run_retrieval(retrieve_documents, query, k, filter), [], timeout)
 
+
+async def _aretrieve_sharded(query: str, shards: list[str], k: int) -> list[Document]:
+    if len(shards) <= 1:
+        return await run_retrieval(retrieve_documents, query, k, source_filter(shards))
+    index = active_index()
+    try:
+        vector = await run_retrieval(embedding_function.embed_query, query)
+        per_shard = await asyncio.gather(*(
+            run_retrieval(index.candidates, query, vector, k, source_filter([shard]))
+            for shard in shards
+        ))
+        # documents_by_ids ของ chunk ที่มาจาก BM25 อย่างเดียวอ่าน store จึงรันใน executor ด้วย
+        return await run_retrieval(_fuse_shards, index, per_shard, k)
     except Exception as e:
         print(f"Error retrieval: {e}")
-        return ""
\ No newline at end of file
+        return []
+
+
+async def aretrieve_sharded(query: str, shards: list[str], k: int = 6,
+                            timeout: float | None = RETRIEVAL_TIMEOUT_SECONDS) -> list[Document]:
+    """
+    เวอร์ชัน async ของ retrieve_sharded: หลาย shard ค้นพร้อมกันใน retrieval_executor
+    (query ถูก embed ครั้งเดียว ครั้งถัดไปได้จาก cache ของ EmbeddingService)
+    """
+    return await _with_timeout(_aretrieve_sharded(query, shards, k), [], timeout)
+
+
+async def aretrieve_with_context(query: str, shards: list[str], k: int = 6,
+                                 timeout: float | None = RETRIEVAL_TIMEOUT_SECONDS) -> tuple[list[Document], str]:
+    """
+    retrieval สำหรับ call_model: คืน (Document, context ที่ผ่าน context_budget แล้ว)
+    ผลที่เคยค้นแล้วด้วย query/k/shard เดิมบน index เดิมได้จาก cache ทันที
+    timeout หรือ error คืน ([], "") ให้ call_model ใช้ no_context_prompt
+    """
+    maybe_reload_index()
+    key = RetrievalCache.make_key(query, k, sorted(shards))
+    cached = retrieval_cache.get(key)
+    if cached is not None:
+        return cached
+    documents = await aretrieve_sharded(query, shards, k, timeout)
+    context = context_budget.assemble_context(documents)
+    if documents:
+        retrieval_cache.put(key, (documents, context))
+    return documents, context
+
+
+async def aretrieve_context(query: str, k: int = 6) -> str:
+    return format_context(await aretrieve_documents(query, k))
+
+
+async def aretrieve_contexts(queries: list[str], k: int = 6) -> list[str]:
+    return await _with_timeout(run_retrieval(retrieve_contexts, queries, k), ["" for _ in queries], RETRIEVAL_TIMEOUT_SECONDS)
@@ -7,9 +7,14 @@ class AgentState(TypedDict):
 
     # debug
     summary: str
+    summarized_ids: list[str]           # ID ของข้อความที่ถูกรวมอยู่ใน summary แล้ว (ดู conversation_store)
     steps: list[str]                    # log ว่า agent ทำอะไรไปบ้าง
     current_node: Optional[str]         # ตอนนี้อยู่ node ไหน
     blocked: bool
+    output_checked: bool                # True เมื่อ output guardrail ตรวจทีละประโยคระหว่าง stream แล้ว
+    answer_cache_key: Optional[dict]    # key ของ semantic answer cache (None = ไม่ใช้ cache ใน turn นี้)
 
     # medical-specific
-    intent: Optional[str]               # symptom, general_health
+    intent: Optional[str]               # ดู intent_router.INTENTS เช่น greeting, lab_interpretation
+    labs: list[dict]                    # ค่าแลปที่ lab_engine ดึงและแปลผลได้จากข้อความล่าสุด
+    red_flags: list[str]                # คำแนะนำเร่งด่วนจากค่าแลปที่เข้าเกณฑ์ red flag
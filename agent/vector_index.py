@@ -0,0 +1,496 @@
+# vector_index.py
+"""
+Vector index แบบ in-memory ด้วย NumPy ใช้แทน Chroma ตอน retrieve (RETRIEVER_BACKEND=numpy)
+corpus มีแค่หลักพัน chunk จึงเก็บ vector ทั้งหมดเป็น matrix เดียว (memory-map จากไฟล์ .npy)
+top-k = matrix-vector product หนึ่งครั้ง + argpartition ไม่มี overhead ของ client/SQLite
+
+ทุกไฟล์ (vector, PQ code, เนื้อหา chunk) ถูก memory-map ไม่ได้ copy เข้า heap
+uvicorn worker หลายตัวจึงใช้ page เดียวกันใน page cache แทนที่จะมีสำเนาของตัวเอง
+--pq เก็บ product-quantized code (PQ_SUBSPACES byte ต่อ vector) ไว้ให้คะแนนคร่าวๆ
+แล้ว re-rank ผู้สมัคร RERANK_CANDIDATES ตัวด้วย vector จริงแบบ exact
+
+build ทุกครั้ง export ลงเวอร์ชันใหม่ก่อน publish (VECTOR_INDEX_DTYPE / VECTOR_INDEX_PQ)
+export ใหม่จาก Chroma ของเวอร์ชันที่ใช้อยู่ และเทียบ latency/หน่วยความจำกับ Chroma:
+    python -m agent.vector_index export [--float32] [--pq]
+    python -m agent.vector_index benchmark
+    python -m agent.vector_index storage-benchmark
+"""
+import json
+import mmap
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VECTOR_INDEX_DIR = os.path.join(BASE_DIR, "data", "vector_index")
+
+META_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "ids.json"
+# เนื้อหา/metadata ของแต่ละ chunk เป็น JSON ต่อกันในไฟล์เดียว + offset ของแต่ละ row
+CHUNKS_FILE = "chunks.bin"
+OFFSETS_FILE = "offsets.npy"
+SOURCES_FILE = "sources.npy"
+PQ_CODES_FILE = "pq_codes.npy"
+PQ_CODEBOOKS_FILE = "pq_codebooks.npy"
+
+# ให้คะแนนทีละก้อน เพื่อไม่ต้องแปลง float16 ทั้ง matrix เป็น float32 พร้อมกัน
+BLOCK_ROWS = 4096
+
+# 384 มิติ / 48 = subvector ละ 8 มิติ, code 48 byte ต่อ vector (float16 = 768, float32 = 1536)
+PQ_SUBSPACES = int(os.environ.get("PQ_SUBSPACES", "48"))
+PQ_CENTROIDS = 256
+PQ_TRAIN_SAMPLE = 20000
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "64"))
+
+# รูปแบบที่ build (data/MarkdownHeaderTextSplitter.py) และคำสั่ง export ใช้เป็นค่าเริ่มต้น
+# float16 ใช้ที่ครึ่งเดียว ความคลาดเคลื่อนของ cosine ~1e-3 สลับลำดับได้แค่ chunk ที่คะแนนแทบเท่ากัน
+# (recall@k เทียบ float32 ดูได้จาก storage-benchmark)
+VECTOR_INDEX_DTYPE = os.environ.get("VECTOR_INDEX_DTYPE", "float16")
+VECTOR_INDEX_PQ = os.environ.get("VECTOR_INDEX_PQ", "0") == "1"
+
+
+def render_chunk(doc: Document) -> str:
+    """ส่วนของ context ต่อหนึ่ง chunk (ไม่รวมลำดับ) ใช้ร่วมกับ rag_utils.format_context"""
+    rendered = doc.metadata.get("Rendered")
+    if rendered:
+        return rendered
+    source = doc.metadata.get("Disease", "Unknown Source")
+    topic = doc.metadata.get("Topic", "")
+    content = doc.page_content.replace("\n", " ")  # ลบ newline ให้ต่อกันสวยๆ
+    return f"จาก: {source} - {topic}]:\n{content}"
+
+
+def filter_source_files(filter: dict | None) -> list[str] | None:
+    """แปลง filter ที่ rag_utils.source_filter สร้างกลับเป็นรายชื่อไฟล์ (None = ไม่จำกัด)"""
+    if not filter:
+        return None
+    condition = filter.get("SourceFile")
+    if condition is None or len(filter) != 1:
+        raise ValueError(f"Only SourceFile filters are supported, got {filter}")
+    return list(condition["$in"]) if isinstance(condition, dict) else [condition]
+
+
+def _kmeans(data: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+def _nearest(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """index ของ centroid ที่ใกล้ที่สุด (L2) ทีละ BLOCK_ROWS แถว"""
+    norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), BLOCK_ROWS):
+        block = data[start:start + BLOCK_ROWS]
+        assign[start:start + len(block)] = (norms[None, :] - 2 * block @ centroids.T).argmin(axis=1)
+    return assign
+
+
+def train_pq(vectors: np.ndarray, subspaces: int = PQ_SUBSPACES, iterations: int = 20) -> tuple[np.ndarray, np.ndarray]:
+    """product quantizer: k-means แยกต่อ subvector คืนค่า (codebooks [M, K, D/M], codes [N, M] uint8)"""
+    count, dim = vectors.shape
+    if dim % subspaces:
+        raise ValueError(f"dimension {dim} is not divisible by PQ_SUBSPACES={subspaces}")
+    width = dim // subspaces
+    centroids = min(PQ_CENTROIDS, count)
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(count, min(PQ_TRAIN_SAMPLE, count), replace=False)]
+
+    codebooks = np.empty((subspaces, centroids, width), dtype=np.float32)
+    codes = np.empty((count, subspaces), dtype=np.uint8)
+    for m in range(subspaces):
+        part = slice(m * width, (m + 1) * width)
+        codebooks[m] = _kmeans(sample[:, part], centroids, iterations, rng)
+        codes[:, m] = _nearest(vectors[:, part], codebooks[m])
+    return codebooks, codes
+
+
+def export_index(vector_db, out_dir: str = VECTOR_INDEX_DIR, dtype: str = VECTOR_INDEX_DTYPE,
+                 pq: bool = VECTOR_INDEX_PQ) -> dict:
+    """
+    ดึง vector + เนื้อหา + metadata ทั้งหมดจาก Chroma แล้วเขียนเป็นไฟล์ที่ NumpyIndex โหลดได้
+    เขียนลงโฟลเดอร์ชั่วคราวแล้วค่อยสลับ เพราะ worker ที่ mmap ไฟล์เดิมอยู่จะพังถ้าไฟล์ถูกเขียนทับ
+    """
+    data = vector_db.get(include=["embeddings", "documents", "metadatas"])
+    ids = list(data["ids"])
+    # store ว่างได้ embedding เป็น array 1 มิติ (หรือ None) ให้เป็น matrix 0 แถวแทน NumpyIndex จะคืนผลว่าง
+    if ids:
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    else:
+        vectors = np.empty((0, 0), dtype=np.float32)
+    # embedding ถูก normalize แล้ว แต่กันไว้เผื่อ index เก่า: dot product = cosine
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.maximum(norms, 1e-12)
+
+    documents = data["documents"]
+    metadatas = [meta or {} for meta in data["metadatas"]]
+    source_files = sorted({meta.get("SourceFile", "") for meta in metadatas})
+    source_codes = {name: code for code, name in enumerate(source_files)}
+
+    tmp_dir = f"{out_dir}.{uuid.uuid4().hex[:8]}.tmp"
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, VECTORS_FILE), vectors.astype(dtype))
+    with open(os.path.join(tmp_dir, IDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+
+    offsets = [0]
+    with open(os.path.join(tmp_dir, CHUNKS_FILE), "wb") as f:
+        for text, meta in zip(documents, metadatas):
+            record = json.dumps({
+                "document": text,
+                "metadata": meta,
+                "rendered": render_chunk(Document(page_content=text, metadata=meta)),
+            }, ensure_ascii=False).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.save(os.path.join(tmp_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, SOURCES_FILE),
+            np.asarray([source_codes[meta.get("SourceFile", "")] for meta in metadatas], dtype=np.int32))
+
+    info = {
+        "count": len(documents),
+        "dim": int(vectors.shape[1]) if len(vectors) else 0,
+        "dtype": dtype,
+        "source_files": source_files,
+        "pq": None,
+    }
+    if pq and len(vectors):
+        codebooks, codes = train_pq(vectors)
+        np.save(os.path.join(tmp_dir, PQ_CODEBOOKS_FILE), codebooks)
+        np.save(os.path.join(tmp_dir, PQ_CODES_FILE), codes)
+        info["pq"] = {"subspaces": codebooks.shape[0], "centroids": codebooks.shape[1]}
+    with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False)
+
+    # inode เดิมยังอยู่จนกว่า worker ที่ mmap ไว้จะปิด จึงลบโฟลเดอร์เก่าได้ทันที
+    old_dir = f"{out_dir}.{uuid.uuid4().hex[:8]}.old"
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return info
+
+
+class NumpyIndex:
+    """
+    index บน matrix ที่ normalize แล้ว: exact (brute-force) หรือ PQ + exact re-rank ถ้า export ด้วย --pq
+    รองรับ filter เฉพาะรูปแบบที่ rag_utils.source_filter สร้าง: {"SourceFile": x} หรือ {"SourceFile": {"$in": [...]}}
+    """
+
+    def __init__(self, index_dir: str = VECTOR_INDEX_DIR, mmap_files: bool = True):
+        self.index_dir = index_dir
+        mode = "r" if mmap_files else None
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode=mode)
+        self.offsets = np.load(os.path.join(index_dir, OFFSETS_FILE), mmap_mode=mode)
+        with open(os.path.join(index_dir, IDS_FILE), encoding="utf-8") as f:
+            self.ids: list[str] = json.load(f)
+        self.rows_by_id = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+
+        with open(os.path.join(index_dir, CHUNKS_FILE), "rb") as f:
+            self._chunks = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.ids else b""
+
+        # shard ต่อไฟล์คู่มือ: row ของแต่ละ SourceFile คำนวณครั้งเดียวตอนโหลด
+        sources = np.load(os.path.join(index_dir, SOURCES_FILE))
+        self.shards = {name: np.flatnonzero(sources == code) for code, name in enumerate(self.info["source_files"])}
+
+        self.codebooks = self.codes = None
+        if self.info.get("pq"):
+            self.codebooks = np.load(os.path.join(index_dir, PQ_CODEBOOKS_FILE))
+            self.codes = np.load(os.path.join(index_dir, PQ_CODES_FILE), mmap_mode=mode)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _rows_for(self, filter: dict | None) -> np.ndarray | None:
+        allowed = filter_source_files(filter)
+        if allowed is None:
+            return None
+        shards = [self.shards[name] for name in allowed if name in self.shards]
+        return np.sort(np.concatenate(shards)) if shards else np.empty(0, dtype=np.int64)
+
+    def _scores(self, query: np.ndarray, rows: np.ndarray | None) -> np.ndarray:
+        matrix = self.vectors if rows is None else self.vectors[rows]
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), BLOCK_ROWS):
+            block = matrix[start:start + BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ query
+        return scores
+
+    def _pq_scores(self, query: np.ndarray, rows: np.ndarray | None) -> np.ndarray:
+        """คะแนนโดยประมาณ: ตาราง dot product ของ query กับทุก centroid แล้วรวมตาม code (ADC)"""
+        subspaces, _, width = self.codebooks.shape
+        table = np.einsum("mkd,md->mk", self.codebooks, query.reshape(subspaces, width))
+        codes = self.codes if rows is None else self.codes[rows]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            block = np.asarray(codes[start:start + BLOCK_ROWS])
+            scores[start:start + len(block)] = table[np.arange(subspaces), block].sum(axis=1)
+        return scores
+
+    @staticmethod
+    def _top(scores: np.ndarray, rows: np.ndarray | None, k: int) -> list[tuple[int, float]]:
+        if len(scores) == 0:
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        positions = top if rows is None else rows[top]
+        return [(int(row), float(scores[i])) for row, i in zip(positions, top)]
+
+    def search(self, query_vector, k: int = 6, filter: dict | None = None) -> list[tuple[int, float]]:
+        """คืนค่า [(row, cosine score)] เรียงจากคะแนนมากไปน้อย"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        rows = self._rows_for(filter)
+        if self.codes is None:
+            return self._top(self._scores(query, rows), rows, k)
+
+        approx = self._pq_scores(query, rows)
+        if len(approx) == 0:
+            return []
+        # re-rank ผู้สมัครจาก PQ ด้วย vector จริง (อ่านจาก mmap เฉพาะ row เหล่านี้)
+        count = min(max(k, RERANK_CANDIDATES), len(approx))
+        candidates = np.argpartition(-approx, count - 1)[:count]
+        candidates = np.sort(candidates if rows is None else rows[candidates])
+        return self._top(self._scores(query, candidates), candidates, k)
+
+    def _record(self, row: int) -> dict:
+        return json.loads(self._chunks[int(self.offsets[row]):int(self.offsets[row + 1])])
+
+    def document(self, row: int) -> Document:
+        record = self._record(row)
+        return Document(
+            id=self.ids[row],
+            page_content=record["document"],
+            metadata={**record["metadata"], "Rendered": record["rendered"]},
+        )
+
+    def get_by_ids(self, ids: list[str]) -> list[Document]:
+        return [self.document(self.rows_by_id[chunk_id]) for chunk_id in ids if chunk_id in self.rows_by_id]
+
+    def similarity_search_by_vector(self, query_vector, k: int = 6, filter: dict | None = None) -> list[Document]:
+        return [self.document(row) for row, _ in self.search(query_vector, k, filter)]
+
+    def similarity_search_with_scores(self, query_vector, k: int = 6, filter: dict | None = None) -> list[tuple[Document, float]]:
+        return [(self.document(row), score) for row, score in self.search(query_vector, k, filter)]
+
+
+# ----- Benchmark -----
+
+BENCHMARK_QUERIES = [
+    "HbA1c 6.1% เป็นเบาหวานไหม",
+    "eGFR 48 แย่มากไหม",
+    "LDL 160 สูงไหมครับ",
+    "ความดัน 150/95 ต้องทำยังไง",
+    "น้ำตาลในเลือดตอนเช้า 130 ปกติไหม",
+    "เป็นโรคไตควรกินอาหารอะไร",
+    "ค่าโพแทสเซียมสูงอันตรายไหม",
+    "เบาหวานมีอาการอย่างไร",
+    "ไขมันในเลือดสูงต้องออกกำลังกายแบบไหน",
+    "ผู้สูงอายุควรคุมความดันเท่าไหร่",
+]
+
+
+def _rss_mb() -> float:
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / 1024 if sys.platform != "darwin" else usage / 1024 / 1024
+    except ImportError:
+        return 0.0
+
+
+def _memory_mb() -> dict:
+    """
+    หน่วยความจำของ process นี้ (Linux): rss = ทั้งหมด, anonymous = heap ส่วนตัวของ worker
+    rss - anonymous คือ page ของไฟล์ (mmap/page cache) ที่ worker ทุกตัวใช้ร่วมกันได้
+    """
+    try:
+        with open("/proc/self/smaps_rollup", encoding="utf-8") as f:
+            # บรรทัดแรกเป็นช่วง address ไม่ใช่ field
+            fields = {key: value for key, _, value in (line.partition(":") for line in f) if key.isalpha()}
+        rss = int(fields["Rss"].split()[0]) / 1024
+        anonymous = int(fields["Anonymous"].split()[0]) / 1024
+        return {"rss": rss, "anonymous": anonymous}
+    except (OSError, KeyError, ValueError):
+        rss = _rss_mb()
+        return {"rss": rss, "anonymous": rss}
+
+
+def _latency_summary(values: list[float]) -> dict:
+    values = sorted(values)
+    return {
+        "p50_ms": round(values[len(values) // 2], 3),
+        "p95_ms": round(values[min(len(values) - 1, int(0.95 * len(values)))], 3),
+        "mean_ms": round(sum(values) / len(values), 3),
+    }
+
+
+def benchmark(k: int = 6, repeats: int = 20) -> dict:
+    """
+    เทียบเฉพาะส่วนค้นหา (ใช้ query vector ชุดเดียวกัน ไม่นับเวลา embedding)
+    และวัด overlap ของ top-k เทียบกับ Chroma
+    """
+    from .rag_utils import active_index, embedding_function
+
+    current = active_index()
+    vector_db = current.vector_db
+    query_vectors = embedding_function.embed_documents(BENCHMARK_QUERIES)
+
+    chroma_ms, chroma_ids = [], []
+    for _ in range(repeats):
+        for vector in query_vectors:
+            start = time.perf_counter()
+            docs = vector_db.similarity_search_by_vector(vector, k=k)
+            chroma_ms.append((time.perf_counter() - start) * 1000)
+            if len(chroma_ids) < len(query_vectors):
+                chroma_ids.append([doc.id for doc in docs])
+
+    rss_before = _rss_mb()
+    index = NumpyIndex(current.paths.vector_dir)
+    numpy_ms, numpy_ids = [], []
+    for _ in range(repeats):
+        for vector in query_vectors:
+            start = time.perf_counter()
+            rows = index.search(vector, k=k)
+            numpy_ms.append((time.perf_counter() - start) * 1000)
+            if len(numpy_ids) < len(query_vectors):
+                numpy_ids.append([index.ids[row] for row, _ in rows])
+
+    overlap = [
+        len(set(a) & set(b)) / max(1, len(a))
+        for a, b in zip(chroma_ids, numpy_ids)
+    ]
+    return {
+        "chunks": len(index),
+        "k": k,
+        "chroma": _latency_summary(chroma_ms),
+        "numpy": _latency_summary(numpy_ms),
+        "numpy_matrix_mb": round(index.vectors.nbytes / 1024 / 1024, 2),
+        "numpy_dtype": str(index.vectors.dtype),
+        "numpy_peak_rss_delta_mb": round(_rss_mb() - rss_before, 1),
+        "topk_overlap_with_chroma": round(sum(overlap) / len(overlap), 3),
+    }
+
+
+def measure(backend: str, path: str, queries_path: str, k: int, repeats: int = 20) -> dict:
+    """
+    รันใน process แยก (storage-benchmark เรียกผ่าน subprocess): เปิด index แล้วค้น query ชุดเดียวกัน
+    หน่วยความจำวัดเป็นส่วนต่างก่อนเปิดกับหลังค้นครบ จึงเห็นต้นทุนต่อ worker ของแต่ละรูปแบบ
+    """
+    queries = np.load(queries_path)
+    before = _memory_mb()
+    if backend == "chroma":
+        from langchain_chroma import Chroma
+        store = Chroma(persist_directory=path)
+
+        def search(query: np.ndarray) -> list[str]:
+            return [doc.id for doc in store.similarity_search_by_vector(query.tolist(), k=k)]
+    else:
+        index = NumpyIndex(path)
+
+        def search(query: np.ndarray) -> list[str]:
+            # ดึง Document ด้วยเหมือนตอนใช้งานจริง เพื่อให้นับการอ่านเนื้อหา chunk จาก mmap
+            return [doc.id for doc in index.similarity_search_by_vector(query, k=k)]
+
+    latencies, results = [], []
+    for repeat in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            ids = search(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if repeat == 0:
+                results.append(ids)
+    after = _memory_mb()
+    return {
+        "latency": _latency_summary(latencies),
+        "private_mb": round(after["anonymous"] - before["anonymous"], 1),
+        "shared_mb": round((after["rss"] - after["anonymous"]) - (before["rss"] - before["anonymous"]), 1),
+        "ids": results,
+    }
+
+
+def _disk_mb(path: str) -> float:
+    total = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+    return round(total / 1024 / 1024, 2)
+
+
+def benchmark_storage(k: int = 6) -> dict:
+    """
+    เทียบรูปแบบการเก็บ vector: float32 / float16 / PQ (+ exact re-rank) กับ Chroma
+    แต่ละรูปแบบวัดใน process ใหม่ (latency, หน่วยความจำส่วนตัว/ส่วนที่แชร์ได้ต่อ worker, ขนาดบน disk)
+    recall@k เทียบกับ brute-force float32 บน vector ชุดเดียวกัน
+    """
+    from .rag_utils import active_index, embedding_function
+
+    current = active_index()
+    vector_db = current.vector_db
+    queries = np.asarray(embedding_function.embed_documents(BENCHMARK_QUERIES), dtype=np.float32)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queries_path = os.path.join(tmp, "queries.npy")
+        np.save(queries_path, queries)
+        variants = {}
+        for name, dtype, pq in [("float32", "float32", False), ("float16", "float16", False), ("pq", "float16", True)]:
+            variants[name] = os.path.join(tmp, name)
+            export_index(vector_db, variants[name], dtype, pq=pq)
+
+        exact = NumpyIndex(variants["float32"], mmap_files=False)
+        truth = [{exact.ids[row] for row, _ in exact.search(query, k)} for query in queries]
+
+        report = {"chunks": len(exact), "k": k, "rerank_candidates": RERANK_CANDIDATES, "pq_subspaces": PQ_SUBSPACES}
+        for name, path in [("chroma", current.paths.chroma_dir), *variants.items()]:
+            output = subprocess.run(
+                [sys.executable, "-m", "agent.vector_index", "measure",
+                 "chroma" if name == "chroma" else "numpy", path, queries_path, str(k)],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            recall = [len(truth_ids & set(ids)) / max(1, len(truth_ids)) for truth_ids, ids in zip(truth, result.pop("ids"))]
+            report[name] = {**result, "disk_mb": _disk_mb(path), "recall_at_k": round(sum(recall) / len(recall), 3)}
+    return report
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "export"
+    if command == "export":
+        # export ลงโฟลเดอร์ของ index เวอร์ชันที่ใช้อยู่ ให้ vector ตรงกับ Chroma/BM25 ชุดเดียวกัน
+        from .rag_utils import active_index
+        current = active_index()
+        info = export_index(
+            current.vector_db,
+            current.paths.vector_dir,
+            dtype="float32" if "--float32" in sys.argv else VECTOR_INDEX_DTYPE,
+            pq="--pq" in sys.argv or VECTOR_INDEX_PQ,
+        )
+        pq = f", pq {info['pq']['subspaces']}x{info['pq']['centroids']}" if info["pq"] else ""
+        print(f"Exported {info['count']} chunks ({info['dim']}-d {info['dtype']}{pq}) to {current.paths.vector_dir}")
+    elif command == "benchmark":
+        print(json.dumps(benchmark(), indent=2))
+    elif command == "storage-benchmark":
+        print(json.dumps(benchmark_storage(), indent=2))
+    elif command == "measure":
+        backend, path, queries_path, k = sys.argv[2:6]
+        print(json.dumps(measure(backend, path, queries_path, int(k))))
+    else:
+        print("usage: python -m agent.vector_index [export [--float32] [--pq] | benchmark | storage-benchmark]")
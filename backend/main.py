@@ -1,3 +1,4 @@
+import os
 import uuid
 import asyncio
 import json
@@ -6,11 +7,12 @@ import time
 import html
 from pathlib import Path
 from typing import Any, Optional
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from agent import conversation_store, metrics
 
 # ลบ chat_memory_store ออกไปเลย! เราจะใช้ความจำจาก Open WebUI แทน
 
@@ -29,6 +31,9 @@ HEALTH_MODEL = "health-agent"
 EVAL_SIMULATOR_MODEL = "health-eval-simulator"
 USER_SIMULATION_CASES_PATH = Path(__file__).resolve().parents[1] / "eval" / "user_simulation_cases.json"
 JUDGE_CRITERIA_PATH = Path(__file__).resolve().parents[1] / "eval" / "judge_criteria.json"
+# simulator/eval ใช้เส้นทางไม่ stream (guardrail ตรวจทั้งคำตอบ) ให้ผล eval เทียบกับของเดิมได้
+# ตั้ง EVAL_STREAMING=1 เพื่อวัดผ่านเส้นทาง stream ทีละประโยคแบบที่ผู้ใช้เห็น (ได้ time to first token จริง)
+EVAL_STREAMING = os.environ.get("EVAL_STREAMING", "0") == "1"
 graph = None
 chat_model = None
 
@@ -52,6 +57,8 @@ class ChatRequest(BaseModel):
     model: str
     messages: list[Message]
     stream: Optional[bool] = False
+    user: Optional[str] = None
+    chat_id: Optional[str] = None
 
 
 def _response_payload(content: str, usage_data: dict[str, int] | None = None):
@@ -93,7 +100,7 @@ def _stream_chunk(content: str, chunk_id: str) -> str:
     return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
 
-def _stream_done(chunk_id: str) -> str:
+def _stream_done(chunk_id: str, timings: dict[str, int] | None = None) -> str:
     payload = {
         "id": chunk_id,
         "object": "chat.completion.chunk",
@@ -105,6 +112,8 @@ def _stream_done(chunk_id: str) -> str:
             }
         ]
     }
+    if timings:
+        payload["timings"] = timings
     return f"data: {json.dumps(payload, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
 
 
@@ -212,20 +221,114 @@ def _extract_case_id(user_text: str, cases: list[dict[str, Any]]) -> str | None:
     return None
 
 
-def _invoke_health_chatbot(chatbot_messages: list[HumanMessage | AIMessage]) -> tuple[str, int]:
-    graph, _ = _load_agent_resources()
-    start = time.perf_counter()
-    result = graph.invoke({
-        "messages": chatbot_messages,
+def _conversation_id(req: ChatRequest, request: Request) -> str:
+    """
+    ID ของบทสนทนาสำหรับแยกสรุปใน conversation_store: chat id ก่อน แล้วค่อย user id
+    Open WebUI ส่ง header เหล่านี้เมื่อเปิด ENABLE_FORWARD_USER_INFO_HEADERS
+    """
+    return (
+        request.headers.get("x-openwebui-chat-id")
+        or req.chat_id
+        or request.headers.get("x-openwebui-user-id")
+        or req.user
+        or ""
+    )
+
+
+async def _initial_state(messages: list, conversation_id: str = "") -> dict[str, Any]:
+    # โหลดสรุปเดิมของบทสนทนานี้ (ถ้ามี) แล้วส่งเข้า graph เฉพาะข้อความที่ยังไม่ถูกสรุป
+    restored = await asyncio.to_thread(conversation_store.restore_state, messages, conversation_id)
+    return {
+        **restored,
         "steps": [],
         "current_node": "",
-        "intent": None
-    })
+        "intent": None,
+        "labs": [],
+        "red_flags": []
+    }
+
+
+async def _astream_health_chatbot(messages: list, conversation_id: str = ""):
+    """
+    รัน graph ในโหมด stream แล้วคืน event เป็น tuple:
+    ("token", ข้อความที่ผ่าน guardrail แล้ว) ระหว่างทาง และ ("done", timings) ตอนจบ
+    ถ้า graph ไม่ได้ stream อะไรออกมาเลย (เช่นโดน input guardrail block) จะส่งข้อความสุดท้ายเป็น token เดียว
+    """
+    graph, _ = _load_agent_resources()
+    start = time.perf_counter()
+    first_token_ms = None
+    final_state = None
+
+    async for mode, payload in graph.astream(
+        await _initial_state(messages, conversation_id),
+        config={"configurable": {"stream_output": True}},
+        stream_mode=["custom", "values"]
+    ):
+        if mode == "values":
+            final_state = payload
+            continue
+        content = payload.get("content")
+        if not content:
+            continue
+        if first_token_ms is None:
+            first_token_ms = int((time.perf_counter() - start) * 1000)
+        yield "token", content
+
+    if first_token_ms is None and final_state and final_state.get("messages"):
+        first_token_ms = int((time.perf_counter() - start) * 1000)
+        yield "token", final_state["messages"][-1].content
+
+    total_ms = int((time.perf_counter() - start) * 1000)
+    timings = {
+        "time_to_first_token_ms": first_token_ms if first_token_ms is not None else total_ms,
+        "total_latency_ms": total_ms
+    }
+    metrics.record("time_to_first_token_ms", timings["time_to_first_token_ms"])
+    metrics.record("total_latency_ms", total_ms)
+    # import ตรงนี้: intent_router โหลด embedding model/Chroma (ผ่าน input_classifier) ให้โหลดพร้อม graph เท่านั้น
+    from agent import intent_router
+    intent_router.record_latency((final_state or {}).get("intent"), total_ms)
+    print(f"[Stream] TTFT: {timings['time_to_first_token_ms']} ms | Total: {total_ms} ms")
+    yield "done", timings
+
+
+async def _stream_health_chatbot(messages: list, conversation_id: str = ""):
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+    try:
+        async for kind, payload in _astream_health_chatbot(messages, conversation_id):
+            if kind == "token":
+                yield _stream_chunk(payload, chunk_id)
+            else:
+                yield _stream_done(chunk_id, payload)
+    except Exception as exc:
+        print(f"[Stream] Error: {type(exc).__name__}: {exc}")
+        yield _stream_chunk("\n\nขออภัยครับ ระบบขัดข้องชั่วคราว กรุณาลองใหม่อีกครั้งครับ", chunk_id)
+        yield _stream_done(chunk_id)
+
+
+async def _invoke_health_chatbot(chatbot_messages: list[HumanMessage | AIMessage], conversation_id: str = "") -> tuple[str, int, int]:
+    """
+    รัน chatbot หนึ่ง turn คืนค่า (คำตอบ, latency, time to first token)
+    โหมดไม่ stream คำตอบออกมาทีเดียว time to first token จึงเท่ากับ latency
+    """
+    if EVAL_STREAMING:
+        parts = []
+        timings = {}
+        async for kind, payload in _astream_health_chatbot(chatbot_messages, conversation_id):
+            if kind == "token":
+                parts.append(payload)
+            else:
+                timings = payload
+        return "".join(parts).strip(), timings["total_latency_ms"], timings["time_to_first_token_ms"]
+
+    graph, _ = _load_agent_resources()
+    start = time.perf_counter()
+    result = await graph.ainvoke(await _initial_state(chatbot_messages, conversation_id))
     latency_ms = int((time.perf_counter() - start) * 1000)
-    return result["messages"][-1].content, latency_ms
+    return result["messages"][-1].content, latency_ms, latency_ms
 
 
-def _next_patient_message(case: dict[str, Any], transcript: list[dict[str, str]], remaining_turns: int) -> str:
+async def _next_patient_message(case: dict[str, Any], transcript: list[dict[str, str]], remaining_turns: int) -> str:
     _, chat_model = _load_agent_resources()
     public_case = {
         "id": case.get("id"),
@@ -248,7 +351,7 @@ def _next_patient_message(case: dict[str, Any], transcript: list[dict[str, str]]
         f"Transcript ปัจจุบัน:\n{transcript_text}\n\n"
         "จงสร้างข้อความผู้ป่วยถัดไปเป็นภาษาไทย หรือ DONE:"
     )
-    response = chat_model.invoke([
+    response = await chat_model.ainvoke([
         SystemMessage(content="You simulate realistic Thai patient behavior for healthcare chatbot evaluation."),
         HumanMessage(content=prompt)
     ])
@@ -276,7 +379,7 @@ def _parse_judge_json(raw_output: str) -> dict[str, Any]:
     }
 
 
-def _judge_transcript(case: dict[str, Any], transcript: list[dict[str, str]], latencies: list[int]) -> dict[str, Any]:
+async def _judge_transcript(case: dict[str, Any], transcript: list[dict[str, str]], latencies: list[int]) -> dict[str, Any]:
     _, chat_model = _load_agent_resources()
     transcript_text = "\n".join(
         f"{idx + 1}. {turn['role']}: {turn['content']}" for idx, turn in enumerate(transcript)
@@ -307,10 +410,10 @@ def _judge_transcript(case: dict[str, Any], transcript: list[dict[str, str]], la
         "ตอบเป็น JSON เท่านั้น ห้ามมี markdown:\n"
         f"{_output_schema_template(criteria)}"
     )
-    raw = chat_model.invoke([
+    raw = (await chat_model.ainvoke([
         SystemMessage(content="You are a strict medical chatbot evaluator. Return valid JSON only."),
         HumanMessage(content=prompt)
-    ]).content
+    ])).content
     return _parse_judge_json(raw)
 
 
@@ -394,7 +497,7 @@ def _format_latency_and_judge(latencies: list[int], judge: dict[str, Any]) -> st
     return "\n".join(lines)
 
 
-def _stream_openwebui_simulation(user_text: str):
+async def _stream_openwebui_simulation(user_text: str):
     chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
 
     def emit(content: str) -> str:
@@ -421,6 +524,8 @@ def _stream_openwebui_simulation(user_text: str):
         transcript: list[dict[str, str]] = []
         chatbot_messages: list[HumanMessage | AIMessage] = []
         latencies: list[int] = []
+        # แต่ละรอบ simulation เป็นบทสนทนาใหม่ ไม่ใช้สรุปร่วมกับรอบก่อนที่เริ่มด้วย prompt เดียวกัน
+        conversation_id = f"simulation-{uuid.uuid4().hex}"
 
         yield emit(f"# Simulation: `{case['id']}`\n\nRisk level: `{case.get('risk_level', '-')}`\n\n## Transcript")
 
@@ -431,23 +536,23 @@ def _stream_openwebui_simulation(user_text: str):
             yield emit(f"\n\n**Patient Simulator:**\n{patient_message}\n")
 
             yield emit("\n_Health Chatbot is responding..._\n")
-            chatbot_answer, latency_ms = _invoke_health_chatbot(chatbot_messages)
+            chatbot_answer, latency_ms, ttft_ms = await _invoke_health_chatbot(chatbot_messages, conversation_id)
             latencies.append(latency_ms)
             transcript.append({"role": "chatbot", "content": chatbot_answer})
             chatbot_messages.append(AIMessage(content=chatbot_answer))
-            yield emit(f"\n**Health Chatbot:**\n{chatbot_answer}\n\n_Latency: {latency_ms} ms_\n")
+            yield emit(f"\n**Health Chatbot:**\n{chatbot_answer}\n\n_Latency: {latency_ms} ms (first token {ttft_ms} ms)_\n")
 
             remaining_turns = max_patient_turns - patient_turn_index - 1
             if remaining_turns <= 0:
                 break
 
             yield emit("\n_Patient Simulator is thinking..._\n")
-            patient_message = _next_patient_message(case, transcript, remaining_turns)
+            patient_message = await _next_patient_message(case, transcript, remaining_turns)
             if patient_message.upper().startswith("DONE"):
                 break
 
         yield emit("\n\n## Judge\n_Judge is scoring the full transcript..._\n")
-        judge = _judge_transcript(case, transcript, latencies)
+        judge = await _judge_transcript(case, transcript, latencies)
         yield emit(_format_latency_and_judge(latencies, judge))
         yield _stream_done(chunk_id)
     except Exception as exc:
@@ -455,7 +560,7 @@ def _stream_openwebui_simulation(user_text: str):
         yield _stream_done(chunk_id)
 
 
-def _run_openwebui_simulation(user_text: str) -> str:
+async def _run_openwebui_simulation(user_text: str) -> str:
     user_text = _normalize_simulation_command(user_text)
     cases = _load_simulation_cases()
     if "list" in user_text.lower() or "case" in user_text.lower() and "run" not in user_text.lower():
@@ -471,13 +576,14 @@ def _run_openwebui_simulation(user_text: str) -> str:
     transcript: list[dict[str, str]] = []
     chatbot_messages: list[HumanMessage | AIMessage] = []
     latencies: list[int] = []
+    conversation_id = f"simulation-{uuid.uuid4().hex}"
 
     patient_message = case["starting_prompt"]
     for patient_turn_index in range(max_patient_turns):
         transcript.append({"role": "patient", "content": patient_message})
         chatbot_messages.append(HumanMessage(content=patient_message))
 
-        chatbot_answer, latency_ms = _invoke_health_chatbot(chatbot_messages)
+        chatbot_answer, latency_ms, _ = await _invoke_health_chatbot(chatbot_messages, conversation_id)
         latencies.append(latency_ms)
         transcript.append({"role": "chatbot", "content": chatbot_answer})
         chatbot_messages.append(AIMessage(content=chatbot_answer))
@@ -486,11 +592,11 @@ def _run_openwebui_simulation(user_text: str) -> str:
         if remaining_turns <= 0:
             break
 
-        patient_message = _next_patient_message(case, transcript, remaining_turns)
+        patient_message = await _next_patient_message(case, transcript, remaining_turns)
         if patient_message.upper().startswith("DONE"):
             break
 
-    judge = _judge_transcript(case, transcript, latencies)
+    judge = await _judge_transcript(case, transcript, latencies)
     return _format_simulation_result(case, transcript, latencies, judge)
 
 
@@ -875,7 +981,7 @@ def _simulator_page() -> str:
       });
       source.addEventListener("bot", event => {
         const data = JSON.parse(event.data);
-        addBubble("bot", data.content, `Latency: ${data.latency_ms} ms`);
+        addBubble("bot", data.content, `Latency: ${data.latency_ms} ms · First token: ${data.ttft_ms} ms`);
       });
       source.addEventListener("status", event => {
         const status = JSON.parse(event.data).content;
@@ -919,13 +1025,14 @@ def _eval_event(event: str, data: dict[str, Any]) -> str:
     return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
-async def _blocking_step_events(
+async def _step_events(
     func,
     args: tuple[Any, ...],
     status_content: str,
     timeout_seconds: int | None = None
 ):
-    task = asyncio.create_task(asyncio.to_thread(func, *args))
+    # func เป็น coroutine function แล้ว จึงรันเป็น task บน event loop ได้เลย ไม่ต้องกิน thread
+    task = asyncio.create_task(func(*args))
     start = time.perf_counter()
 
     while True:
@@ -953,6 +1060,7 @@ async def _eval_simulation_event_stream(case_id: str):
         transcript: list[dict[str, str]] = []
         chatbot_messages: list[HumanMessage | AIMessage] = []
         latencies: list[int] = []
+        conversation_id = f"simulation-{uuid.uuid4().hex}"
 
         yield _eval_event("status", {"content": f"Running {case_id} (risk={case.get('risk_level', '-')})"})
 
@@ -965,26 +1073,27 @@ async def _eval_simulation_event_stream(case_id: str):
             yield _eval_event("status", {"content": "Health Chatbot is responding..."})
             chatbot_answer = ""
             latency_ms = 0
-            async for kind, payload in _blocking_step_events(
+            ttft_ms = 0
+            async for kind, payload in _step_events(
                 _invoke_health_chatbot,
-                (list(chatbot_messages),),
+                (list(chatbot_messages), conversation_id),
                 "Health Chatbot is responding...",
             ):
                 if kind == "event":
                     yield payload
                 else:
-                    chatbot_answer, latency_ms = payload
+                    chatbot_answer, latency_ms, ttft_ms = payload
             latencies.append(latency_ms)
             transcript.append({"role": "chatbot", "content": chatbot_answer})
             chatbot_messages.append(AIMessage(content=chatbot_answer))
-            yield _eval_event("bot", {"content": chatbot_answer, "latency_ms": latency_ms})
+            yield _eval_event("bot", {"content": chatbot_answer, "latency_ms": latency_ms, "ttft_ms": ttft_ms})
 
             remaining_turns = max_patient_turns - patient_turn_index - 1
             if remaining_turns <= 0:
                 break
 
             yield _eval_event("status", {"content": "Patient Simulator is thinking..."})
-            async for kind, payload in _blocking_step_events(
+            async for kind, payload in _step_events(
                 _next_patient_message,
                 (case, list(transcript), remaining_turns),
                 "Patient Simulator is thinking...",
@@ -998,7 +1107,7 @@ async def _eval_simulation_event_stream(case_id: str):
 
         yield _eval_event("status", {"content": "LLM Judge is scoring the full transcript..."})
         judge: dict[str, Any] = {}
-        async for kind, payload in _blocking_step_events(
+        async for kind, payload in _step_events(
             _judge_transcript,
             (case, list(transcript), list(latencies)),
             "LLM Judge is scoring the full transcript...",
@@ -1016,7 +1125,7 @@ async def _eval_simulation_event_stream(case_id: str):
         yield _eval_event("done", {})
 
 @app.post("/v1/chat/completions")
-async def chat_completions(req: ChatRequest):
+async def chat_completions(req: ChatRequest, request: Request):
     
     # 1. Convert Open WebUI messages to LangGraph message format
     langchain_messages = []
@@ -1054,14 +1163,14 @@ async def chat_completions(req: ChatRequest):
                     "X-Accel-Buffering": "no"
                 }
             )
-        assistant_content = _run_openwebui_simulation(last_message_content)
+        assistant_content = await _run_openwebui_simulation(last_message_content)
         return _response_payload(assistant_content, usage_data)
 
     if is_webui_task:
         print("\n[Interceptor] Open WebUI automated task detected. Bypassing LangGraph.")
         # Call the model directly without saving to memory
         _, chat_model = _load_agent_resources()
-        response = chat_model.invoke(langchain_messages)
+        response = await chat_model.ainvoke(langchain_messages)
         assistant_content = response.content
         
         # Extract token usage for the automated task
@@ -1073,13 +1182,24 @@ async def chat_completions(req: ChatRequest):
     else:
         print("\n[Interceptor] Normal user message detected. Routing to LangGraph.")
         # 2. Pass the entire history into LangGraph
+        if req.stream:
+            # stream คำตอบทีละประโยคที่ผ่าน output guardrail แล้ว
+            return StreamingResponse(
+                _stream_health_chatbot(langchain_messages, _conversation_id(req, request)),
+                media_type="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no"
+                }
+            )
+
         graph, _ = _load_agent_resources()
-        result = graph.invoke({
-            "messages": langchain_messages,
-            "steps": [],
-            "current_node": "",
-            "intent": None
-        })
+        start = time.perf_counter()
+        result = await graph.ainvoke(await _initial_state(langchain_messages, _conversation_id(req, request)))
+        total_ms = (time.perf_counter() - start) * 1000
+        metrics.record("total_latency_ms", total_ms)
+        from agent import intent_router
+        intent_router.record_latency(result.get("intent"), total_ms)
 
         # 3. Retrieve the final response from AI
         assistant_msg = result["messages"][-1]
@@ -1131,6 +1251,21 @@ async def eval_simulator_stream(case_id: str):
     )
 
 
+@app.get("/eval/metrics")
+async def eval_metrics():
+    return metrics.snapshot()
+
+
+@app.post("/index/reload")
+async def reload_index():
+    # สลับไปใช้ index เวอร์ชันที่ data/indexes/current.json ชี้ โดยไม่ต้อง restart
+    _load_agent_resources()
+    from agent import rag_utils
+
+    reloaded = await asyncio.to_thread(rag_utils.reload_index)
+    return {"reloaded": reloaded, "version": rag_utils.index_version()}
+
+
 @app.get("/v1/models")
 async def list_models():
     return {
@@ -1,38 +1,94 @@
+import hashlib
+import json
 import os
 import re
 import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterable, Iterator
 
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.documents import Document
 from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 
 
 BASE_DIR = Path(__file__).resolve().parent
 PROJECT_DIR = BASE_DIR.parent
 
-RAW_DIR = Path(r"C:\ChatBot\raw-markdown")
+# Share the embedding backend (torch or int8 ONNX) with the query side.
+sys.path.insert(0, str(PROJECT_DIR))
+from agent.context_budget import estimate_tokens  # noqa: E402
+from agent.embedding_backend import EMBEDDING_BACKEND, MODEL_NAME, load_embedding_model  # noqa: E402
+from agent.index_store import (  # noqa: E402
+    INDEX_ROOT,
+    IndexPaths,
+    create_version,
+    current_paths,
+    prune,
+    publish,
+    version_paths,
+)
+from agent.lab_engine import lab_tags  # noqa: E402
+from agent.lexical_index import BM25Index  # noqa: E402
+from agent.near_duplicates import (  # noqa: E402
+    NEAR_DUPLICATE_DEDUPE,
+    NEAR_DUPLICATE_THRESHOLD,
+    collapse_near_duplicates,
+)
+from agent.vector_index import VECTOR_INDEX_DTYPE, VECTOR_INDEX_PQ, export_index, render_chunk  # noqa: E402
+
 PROCESSED_DIR = BASE_DIR / "processed_markdown"
-PERSIST_DIRECTORY = BASE_DIR / "chroma_db_health"
-
-FILES = {
-    "diabetes_knowledge.md": {
-        "disease": "โรค: เบาหวาน (Diabetes)",
-        "source": "Clinical Practice Guideline for Diabetes 2023",
-    },
-    "hypertension_knowledge.md": {
-        "disease": "โรค: ความดันโลหิตสูง (Hypertension)",
-        "source": "Thai Guidelines on the Treatment of Hypertension 2024",
-    },
-    "dyslipidemia_knowledge.md": {
-        "disease": "โรค: ไขมันในเลือดผิดปกติ (Dyslipidemia)",
-        "source": "Clinical Practice Guideline on Management of Dyslipidemia 2024",
-    },
-    "kidney_knowledge.md": {
-        "disease": "โรค: ไตเรื้อรัง (Chronic Kidney Disease)",
-        "source": "แนวทางการดูแลผู้ป่วยโรคไตเรื้อรังก่อนการบำบัดทดแทนไต 2565",
-    },
-}
+# Guideline registry: raw markdown directory plus the disease/source label of each file.
+# Adding a guideline = adding an entry here; the next build only embeds its chunks.
+# A relative raw_dir is resolved against data/ (default data/raw_markdown); GUIDELINE_RAW_DIR overrides it.
+MANIFEST_PATH = BASE_DIR / "guidelines.json"
+
+CHUNK_SIZE = 900
+CHUNK_OVERLAP = 250
+
+# Chunks embedded and written to Chroma per step; each step is checkpointed.
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "64"))
+# Worker processes for preprocessing/splitting guideline files.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+# Progress of the build in flight; a rerun with the same plan resumes into the same version directory.
+CHECKPOINT_PATH = Path(INDEX_ROOT) / "build_checkpoint.json"
+
+
+def load_manifest(path: Path = MANIFEST_PATH) -> tuple[Path, dict[str, dict]]:
+    manifest = json.loads(path.read_text(encoding="utf-8"))
+    raw_dir = Path(os.environ.get("GUIDELINE_RAW_DIR", manifest["raw_dir"]))
+    if not raw_dir.is_absolute():
+        raw_dir = BASE_DIR / raw_dir
+    return raw_dir, {item["file"]: item for item in manifest["guidelines"]}
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha1()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_settings() -> dict:
+    """Everything that changes chunk boundaries or vectors; a mismatch forces a full rebuild."""
+    return {
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding_model": MODEL_NAME,
+        "embedding_backend": EMBEDDING_BACKEND,
+        "near_duplicate_threshold": NEAR_DUPLICATE_THRESHOLD if NEAR_DUPLICATE_DEDUPE else None,
+    }
+
+
+def load_state(path: str) -> dict:
+    """Per-file and per-chunk hashes of the index at `path` ({} if it was not built incrementally)."""
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
 
 
 def clean_markdown(text: str) -> str:
@@ -96,111 +152,612 @@ def remove_low_value_lines(text: str) -> str:
     return "\n".join(cleaned)
 
 
-def preprocess_file(input_path: Path, output_path: Path, disease: str, source: str) -> None:
-    raw = input_path.read_text(encoding="utf-8")
-    text = clean_markdown(raw)
-    text = remove_low_value_lines(text)
-    text = demote_headers(text)
+# ----- Streaming preprocessor -----
+# One pass over the raw lines doing what clean_markdown -> remove_low_value_lines -> demote_headers
+# and MarkdownHeaderTextSplitter do over whole-file strings; only the current header section is
+# held in memory. The whole-text functions above are kept as the reference (see benchmark()).
+
+# All tag/image substitutions of clean_markdown in one scan; the group that matched picks the replacement.
+INLINE_PATTERN = re.compile(
+    r"(!\[[^\]]*\]\([^)]+\))|(<br\s*/?>)|(</?mark>)|(</?sup[^>]*>)|(<[^>]+>)",
+    flags=re.I,
+)
+INLINE_REPLACEMENTS = ["", " ", "", "", " "]
+HEADING_PREFIX = re.compile(r"^#+\s*")
+PAGE_LEFTOVER = re.compile(r"[ก-ฮA-Za-z0-9]{1,2}")
+RAW_HEADER = re.compile(r"^(#{1,5})\s+(.*)$")
+SKIP_EXACT = {
+    "สารบัญ",
+    "สารบัญ (ต่อ)",
+    "คำนำ",
+    "คำย่อ",
+    "คำย่อ (ต่อ)",
+    "เอกสารอ้างอิง",
+}
 
-    output = (
-        f"# {disease}\n\n"
-        f"## แหล่งข้อมูล: {source}\n\n"
-        f"{text}\n"
+# Longest separator first, as MarkdownHeaderTextSplitter sorts them.
+HEADERS_TO_SPLIT_ON = [
+    ("###", "Subtopic"),
+    ("##", "Topic"),
+    ("#", "Disease"),
+]
+
+
+def clean_line(line: str) -> str:
+    line = line.replace("\ufeff", "")
+    if "<" not in line and "![" not in line:
+        return line
+    return INLINE_PATTERN.sub(lambda match: INLINE_REPLACEMENTS[match.lastindex - 1], line)
+
+
+def _collapse_blank_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Cleaned lines with runs of empty lines collapsed and the whole text stripped, like clean_markdown."""
+    held = None  # last line with content; rstripped if nothing follows it
+    pending = []  # whitespace-only lines after `held`, dropped at the end of the file
+    for line in lines:
+        line = clean_line(line.rstrip("\n"))
+        if not line.strip():
+            if held is not None:
+                pending.append(line)
+            continue
+        if held is None:
+            held = line.lstrip()
+            continue
+        yield held
+        previous_empty = False
+        for blank in pending:
+            if blank == "" and previous_empty:
+                continue
+            previous_empty = blank == ""
+            yield blank
+        pending.clear()
+        held = line
+    if held is not None:
+        yield held.rstrip()
+
+
+def _remove_low_value_lines(lines: Iterable[str]) -> Iterator[str]:
+    held = None  # an empty line is held back: a trailing one is dropped when the text is split again
+    for cleaned in lines:
+        # "+ \n" so other line boundaries (\u2028, \x0c, ...) split exactly like str.splitlines on the whole text
+        for line in (cleaned + "\n").splitlines():
+            stripped = line.strip()
+            if stripped:
+                heading_text = HEADING_PREFIX.sub("", stripped).strip()
+                # Table-of-contents headings, isolated page numbers or tiny PDF leftovers.
+                if heading_text in SKIP_EXACT or PAGE_LEFTOVER.fullmatch(heading_text):
+                    continue
+            if held is not None:
+                yield held
+                held = None
+            if line:
+                yield line
+            else:
+                held = line
+
+
+def iter_clean_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Streaming clean_markdown + remove_low_value_lines + demote_headers."""
+    for line in _remove_low_value_lines(_collapse_blank_lines(lines)):
+        match = RAW_HEADER.match(line)
+        if match:
+            hashes, title = match.groups()
+            title = title.strip()
+            if title:
+                yield "#" + hashes + " " + title
+            continue
+        yield line
+
+
+class SectionSplitter:
+    """
+    Line-at-a-time MarkdownHeaderTextSplitter(strip_headers=False): feed() returns the header
+    sections completed by that line, close() the rest. Only the open section is kept in memory.
+    """
+
+    def __init__(self):
+        self.header_stack: list[tuple[int, str]] = []
+        self.metadata: dict[str, str] = {}
+        self.line_metadata: dict[str, str] = {}
+        self.content: list[str] = []
+        self.section: list[str] = []
+        self.section_metadata: dict[str, str] | None = None
+        self.fence = ""
+
+    def _flush_content(self) -> list[Document]:
+        content, metadata = "\n".join(self.content), self.line_metadata.copy()
+        self.content.clear()
+        section = self.section
+        # Same metadata, or a header line followed by its first sub-section: keep aggregating.
+        if section and (metadata == self.section_metadata or (
+            len(self.section_metadata) < len(metadata) and section[-1].rsplit("\n", 1)[-1][0] == "#"
+        )):
+            section.append(content)
+            self.section_metadata = metadata
+            return []
+        done = self._emit()
+        self.section, self.section_metadata = [content], metadata
+        return done
+
+    def _emit(self) -> list[Document]:
+        if not self.section:
+            return []
+        return [Document(page_content="  \n".join(self.section), metadata=self.section_metadata)]
+
+    def feed(self, line: str) -> list[Document]:
+        stripped = "".join(filter(str.isprintable, line.strip()))
+
+        if not self.fence:
+            if stripped.startswith("```") and stripped.count("```") == 1:
+                self.fence = "```"
+            elif stripped.startswith("~~~"):
+                self.fence = "~~~"
+        elif stripped.startswith(self.fence):
+            self.fence = ""
+        if self.fence:
+            self.content.append(stripped)
+            return []
+
+        done = []
+        for separator, name in HEADERS_TO_SPLIT_ON:
+            if stripped.startswith(separator) and (len(stripped) == len(separator) or stripped[len(separator)] == " "):
+                level = len(separator)
+                while self.header_stack and self.header_stack[-1][0] >= level:
+                    self.metadata.pop(self.header_stack.pop()[1], None)
+                self.header_stack.append((level, name))
+                self.metadata[name] = stripped[len(separator):].strip()
+                if self.content:
+                    done = self._flush_content()
+                self.content.append(stripped)
+                break
+        else:
+            if stripped:
+                self.content.append(stripped)
+            elif self.content:
+                done = self._flush_content()
+        self.line_metadata = self.metadata.copy()
+        return done
+
+    def close(self) -> list[Document]:
+        done = self._flush_content() if self.content else []
+        done += self._emit()
+        self.section, self.section_metadata = [], None
+        return done
+
+
+def text_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", "|", ". ", " ", ""],
     )
 
-    output_path.write_text(output, encoding="utf-8")
 
+def chunk_lines(lines: Iterable[str], info: dict, source_file: str) -> dict[str, Document]:
+    """Header-aware chunks of processed markdown lines keyed by their content-hash id."""
+    splitter = text_splitter()
+    sections = SectionSplitter()
+    chunks_by_id = {}
 
-def build_processed_markdown() -> list[Path]:
+    def add(done: list[Document]) -> None:
+        for chunk in splitter.split_documents(done):
+            # Force metadata from filename so it will not leak across documents.
+            chunk.metadata["Disease"] = info["disease"]
+            chunk.metadata["Source"] = info["source"]
+            chunk.metadata["SourceFile"] = source_file
+            # Precomputed for query time: the context block (see rag_utils.format_context),
+            # its token cost (context_budget) and the labs it mentions (lab_engine names,
+            # comma-separated because Chroma metadata must be scalar).
+            chunk.metadata["LabTags"] = ",".join(lab_tags(chunk.page_content))
+            chunk.metadata["Rendered"] = render_chunk(chunk)
+            chunk.metadata["Tokens"] = estimate_tokens(chunk.metadata["Rendered"])
+
+            # Stable content-hash ids so the BM25 index and Chroma refer to the same chunk
+            # and an unchanged chunk keeps its id (and its vector) across builds.
+            key = f"{chunk.metadata['SourceFile']}\n{chunk.page_content}"
+            chunks_by_id.setdefault(hashlib.sha1(key.encode("utf-8")).hexdigest(), chunk)
+
+    for line in lines:
+        add(sections.feed(line))
+    add(sections.close())
+    return chunks_by_id
+
+
+def preprocess_file(input_path: Path, output_path: Path, disease: str, source: str) -> dict[str, Document]:
+    """
+    Stream the raw guideline into its processed markdown and chunk it in the same pass.
+    Returns the chunks so the build does not have to read the processed file back.
+    """
+    info = {"disease": disease, "source": source}
+
+    def processed_lines(raw_lines: Iterable[str], out) -> Iterator[str]:
+        for line in (f"# {disease}", "", f"## แหล่งข้อมูล: {source}", ""):
+            out.write(line + "\n")
+            yield line
+        for line in iter_clean_lines(raw_lines):
+            out.write(line + "\n")
+            yield line
+
+    tmp_path = output_path.with_suffix(".tmp")
+    with input_path.open(encoding="utf-8") as raw, tmp_path.open("w", encoding="utf-8") as out:
+        chunks = chunk_lines(processed_lines(raw, out), info, output_path.name)
+    os.replace(tmp_path, output_path)
+    return chunks
+
+
+def map_files(fn, *iterables) -> list:
+    """fn over guideline files, in a process pool when there is more than one file to do."""
+    jobs = list(zip(*iterables))
+    if len(jobs) <= 1 or INGEST_WORKERS <= 1:
+        return [fn(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(INGEST_WORKERS, len(jobs))) as pool:
+        return list(pool.map(fn, *zip(*jobs)))
+
+
+def build_processed_markdown(raw_dir: Path, guidelines: dict[str, dict], previous_files: dict) -> dict[str, dict]:
+    """
+    Preprocess raw guidelines whose content or labels changed since the last build.
+    Returns {filename: {"path", "input_sha1", "sha1"}} for every guideline that has a processed file,
+    plus "chunks" for the files preprocessed in this run.
+    """
     PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
 
-    processed_files = []
+    processed = {}
+    jobs = []
 
-    for filename, info in FILES.items():
-        input_path = RAW_DIR / filename
+    for filename, info in guidelines.items():
+        input_path = raw_dir / filename
         output_path = PROCESSED_DIR / filename
-
-        if not input_path.exists():
+        previous = previous_files.get(filename, {})
+
+        if input_path.exists():
+            key = f"{file_hash(input_path)}\n{info['disease']}\n{info['source']}"
+            input_sha1 = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            if input_sha1 == previous.get("input_sha1") and output_path.exists():
+                print(f"Unchanged: {input_path}")
+            else:
+                jobs.append((input_path, output_path, info["disease"], info["source"]))
+        elif output_path.exists():
+            # Raw exports live outside the repo; the committed processed copy is used as-is.
+            input_sha1 = previous.get("input_sha1")
+            print(f"WARNING: raw file not found: {input_path}, using {output_path}")
+        else:
             print(f"WARNING: file not found: {input_path}")
             continue
 
-        preprocess_file(
-            input_path=input_path,
-            output_path=output_path,
-            disease=info["disease"],
-            source=info["source"],
-        )
+        processed[filename] = {"path": output_path, "input_sha1": input_sha1}
 
-        processed_files.append(output_path)
-        print(f"Processed: {output_path}")
+    if jobs:
+        for (_, output_path, _, _), chunks in zip(jobs, map_files(preprocess_file, *zip(*jobs))):
+            processed[output_path.name]["chunks"] = chunks
+            print(f"Processed: {output_path}")
 
-    return processed_files
+    for item in processed.values():
+        item["sha1"] = file_hash(item["path"])
 
+    return processed
 
-def build_vector_db(processed_files: list[Path]) -> None:
-    if PERSIST_DIRECTORY.exists():
-        shutil.rmtree(PERSIST_DIRECTORY)
 
-    headers_to_split_on = [
-        ("#", "Disease"),
-        ("##", "Topic"),
-        ("###", "Subtopic"),
-    ]
+def split_file(file_path: Path, info: dict) -> dict[str, Document]:
+    """Chunks of one processed guideline keyed by their content-hash id."""
+    with file_path.open(encoding="utf-8") as f:
+        return chunk_lines((line.rstrip("\n") for line in f), info, file_path.name)
 
-    header_splitter = MarkdownHeaderTextSplitter(
-        headers_to_split_on=headers_to_split_on,
-        strip_headers=False,
-    )
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=900,
-        chunk_overlap=250,
-        separators=["\n\n", "\n", "|", ". ", " ", ""],
-    )
+def chunk_hash(chunk: Document) -> str:
+    """Changes when the metadata changes; the id only covers the embedded text."""
+    key = f"{chunk.page_content}\n{json.dumps(chunk.metadata, sort_keys=True, ensure_ascii=False)}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
-    all_chunks = []
 
-    for file_path in processed_files:
-        text = file_path.read_text(encoding="utf-8")
+def plan_changes(processed: dict[str, dict], guidelines: dict[str, dict], previous_files: dict):
+    """
+    Difference between `processed` and the previous build: chunks to embed, chunks whose
+    metadata changed, ids to delete, plus the per-file state of the new build.
+    """
+    files_state = {}
+    to_add: dict[str, Document] = {}
+    to_update: dict[str, Document] = {}
+    to_delete: list[str] = []
+
+    changed = []
+    for filename, item in processed.items():
+        previous = previous_files.get(filename)
+        if previous and previous["sha1"] == item["sha1"]:
+            files_state[filename] = {**previous, "input_sha1": item["input_sha1"]}
+        else:
+            changed.append(filename)
+
+    # Files preprocessed in this run were already chunked in the same pass.
+    to_split = [filename for filename in changed if "chunks" not in processed[filename]]
+    split = dict(zip(to_split, map_files(
+        split_file,
+        [processed[filename]["path"] for filename in to_split],
+        [guidelines[filename] for filename in to_split],
+    )))
+    for filename in changed:
+        chunks = split[filename] if filename in split else processed[filename]["chunks"]
+        collapsed = 0
+        if NEAR_DUPLICATE_DEDUPE:
+            # Before embedding: near-identical chunks would only crowd each other out of top-k.
+            total = len(chunks)
+            chunks, collapsed = collapse_near_duplicates(chunks)
+            print(f"Near-duplicates: {filename} {total} -> {len(chunks)} chunks ({collapsed / max(1, total):.1%} collapsed)")
+        previous = previous_files.get(filename)
+        hashes = {chunk_id: chunk_hash(chunk) for chunk_id, chunk in chunks.items()}
+        old_hashes = previous["chunks"] if previous else {}
+        for chunk_id, chunk in chunks.items():
+            if chunk_id not in old_hashes:
+                to_add[chunk_id] = chunk
+            elif old_hashes[chunk_id] != hashes[chunk_id]:
+                to_update[chunk_id] = chunk
+        to_delete.extend(chunk_id for chunk_id in old_hashes if chunk_id not in chunks)
+        item = processed[filename]
+        files_state[filename] = {
+            "input_sha1": item["input_sha1"],
+            "sha1": item["sha1"],
+            "near_duplicates": collapsed,
+            "chunks": hashes,
+        }
+
+    for filename, previous in previous_files.items():
+        if filename not in processed:
+            to_delete.extend(previous["chunks"])
+
+    return files_state, to_add, to_update, to_delete
+
+
+def save_checkpoint(checkpoint: dict) -> None:
+    tmp_path = CHECKPOINT_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(checkpoint, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, CHECKPOINT_PATH)
+
+
+def resume_checkpoint(plan_id: str) -> dict | None:
+    """Checkpoint of an interrupted build with the same plan (same base index, settings and changes)."""
+    try:
+        checkpoint = json.loads(CHECKPOINT_PATH.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    version_dir = os.path.dirname(version_paths(checkpoint["version"]).chroma_dir)
+    if checkpoint.get("plan") != plan_id or not os.path.isdir(version_dir):
+        return None
+    return checkpoint
+
+
+def embed_in_batches(db: Chroma, embedding_function, chunks: dict[str, Document], checkpoint: dict) -> None:
+    """Embed and upsert `chunks` INGEST_BATCH_SIZE at a time, checkpointing after every batch."""
+    ids = list(chunks)
+    present = set()
+    for start in range(0, len(ids), 1000):
+        present.update(db.get(ids=ids[start:start + 1000], include=[])["ids"])
+    pending = [chunk_id for chunk_id in ids if chunk_id not in present]
+    if present:
+        print(f"Resuming: {len(present)}/{len(ids)} chunks already embedded")
+
+    started = time.perf_counter()
+    for start in range(0, len(pending), INGEST_BATCH_SIZE):
+        batch_ids = pending[start:start + INGEST_BATCH_SIZE]
+        batch = [chunks[chunk_id] for chunk_id in batch_ids]
+        vectors = embedding_function.embed_documents([chunk.page_content for chunk in batch])
+        # upsert so a batch repeated after an interruption does not fail on existing ids
+        db._collection.upsert(
+            ids=batch_ids,
+            embeddings=vectors,
+            documents=[chunk.page_content for chunk in batch],
+            metadatas=[chunk.metadata for chunk in batch],
+        )
 
-        header_chunks = header_splitter.split_text(text)
-        chunks = text_splitter.split_documents(header_chunks)
+        checkpoint["embedded"] = len(present) + start + len(batch_ids)
+        save_checkpoint(checkpoint)
+        elapsed = time.perf_counter() - started
+        print(f"Embedded {checkpoint['embedded']}/{len(ids)} chunks ({(start + len(batch_ids)) / elapsed:.1f} chunks/s)")
 
-        info = FILES[file_path.name]
+    if pending:
+        elapsed = time.perf_counter() - started
+        print(f"Embedding throughput: {len(pending) / elapsed:.1f} chunks/s "
+              f"({len(pending)} chunks in {elapsed:.1f}s, batch size {INGEST_BATCH_SIZE})")
 
-        for chunk in chunks:
-            # Force metadata from filename so it will not leak across documents.
-            chunk.metadata["Disease"] = info["disease"]
-            chunk.metadata["Source"] = info["source"]
-            chunk.metadata["SourceFile"] = file_path.name
 
-        all_chunks.extend(chunks)
+def build_vector_db(processed: dict[str, dict], guidelines: dict[str, dict],
+                    base: IndexPaths | None, previous_files: dict) -> None:
+    """
+    Apply the difference between `processed` and the previous build (`base`, `previous_files`):
+    embed new chunks, update metadata of changed ones, delete vanished ones.
+    With no base every chunk is embedded.
+    """
+    files_state, to_add, to_update, to_delete = plan_changes(processed, guidelines, previous_files)
+
+    reused = sum(len(state["chunks"]) for state in files_state.values()) - len(to_add) - len(to_update)
+    print(f"Chunks: {len(to_add)} to embed, {len(to_update)} metadata updates, {len(to_delete)} to delete, {reused} reused")
+
+    if base is not None and not (to_add or to_update or to_delete):
+        print(f"Index {base.version} is up to date")
+        return
+
+    plan = json.dumps({
+        "base": base.version if base else None,
+        "settings": build_settings(),
+        "add": sorted(to_add),
+        "update": sorted((chunk_id, chunk_hash(chunk)) for chunk_id, chunk in to_update.items()),
+        "delete": sorted(to_delete),
+    })
+    plan_id = hashlib.sha1(plan.encode("utf-8")).hexdigest()
+
+    checkpoint = resume_checkpoint(plan_id)
+    if checkpoint is not None:
+        paths = version_paths(checkpoint["version"])
+        print(f"Resuming interrupted build {paths.version}")
+    else:
+        # Build into a fresh version directory; the running backend keeps serving the
+        # current one until publish() flips data/indexes/current.json.
+        paths = create_version()
+        if base is not None:
+            # Start from a copy of the live store so unchanged chunks keep their vectors.
+            shutil.copytree(base.chroma_dir, paths.chroma_dir)
+        checkpoint = {"version": paths.version, "plan": plan_id, "embedded": 0, "total": len(to_add)}
+        save_checkpoint(checkpoint)
+
+    embedding_function = load_embedding_model()
+
+    db = Chroma(
+        persist_directory=paths.chroma_dir,
+        embedding_function=embedding_function,
+    )
+    if to_delete:
+        db.delete(ids=to_delete)
+    if to_update:
+        db._collection.update(
+            ids=list(to_update),
+            metadatas=[chunk.metadata for chunk in to_update.values()],
+        )
+    embed_in_batches(db, embedding_function, to_add, checkpoint)
+
+    print(f"Done. Chroma documents: {db._collection.count()}")
+    print(f"Saved at: {paths.chroma_dir}")
+
+    # BM25 statistics (idf, avgdl) depend on the whole corpus, so it is rebuilt from the final store.
+    data = db.get(include=["documents", "metadatas"])
+    bm25 = BM25Index.build(
+        ids=list(data["ids"]),
+        texts=data["documents"],
+        source_files=[meta["SourceFile"] for meta in data["metadatas"]],
+    )
+    bm25.save(paths.bm25_path)
+    print(f"BM25 index: {len(bm25)} chunks, {len(bm25.postings)} terms ({bm25.tokenizer}) saved at: {paths.bm25_path}")
 
-    print(f"Final chunks: {len(all_chunks)}")
+    # The NumPy export belongs to the version too: a published version must serve RETRIEVER_BACKEND=numpy as-is.
+    vectors = export_index(db, paths.vector_dir, VECTOR_INDEX_DTYPE, pq=VECTOR_INDEX_PQ)
+    print(f"Vector index: {vectors['count']} chunks ({vectors['dtype']}{', pq' if vectors['pq'] else ''}) saved at: {paths.vector_dir}")
 
-    embedding_function = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
-        model_kwargs={"device": "cpu"},
-        encode_kwargs={"normalize_embeddings": True},
+    Path(paths.state_path).write_text(
+        json.dumps({"settings": build_settings(), "files": files_state}, ensure_ascii=False, indent=2),
+        encoding="utf-8",
     )
 
-    db = Chroma.from_documents(
-        documents=all_chunks,
-        embedding=embedding_function,
-        persist_directory=str(PERSIST_DIRECTORY),
+    collapsed = sum(state.get("near_duplicates", 0) for state in files_state.values())
+    print(f"Near-duplicates collapsed: {collapsed} ({collapsed / max(1, collapsed + len(bm25)):.1%} of the chunks)")
+    publish(paths, {"chunks": len(bm25), "near_duplicates_collapsed": collapsed, "tokenizer": bm25.tokenizer})
+    CHECKPOINT_PATH.unlink(missing_ok=True)
+    print(f"Published index version {paths.version}")
+    removed = prune()
+    if removed:
+        print(f"Removed old index versions: {', '.join(removed)}")
+
+
+# ----- Benchmark: streaming preprocessor vs the whole-text functions -----
+
+def legacy_preprocess(input_path: Path, disease: str, source: str) -> tuple[str, list[Document]]:
+    """The previous preprocess_file + split path, kept as the reference for benchmark()."""
+    raw = input_path.read_text(encoding="utf-8")
+    text = clean_markdown(raw)
+    text = remove_low_value_lines(text)
+    text = demote_headers(text)
+    output = (
+        f"# {disease}\n\n"
+        f"## แหล่งข้อมูล: {source}\n\n"
+        f"{text}\n"
+    )
+    header_splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=[(separator, name) for separator, name in reversed(HEADERS_TO_SPLIT_ON)],
+        strip_headers=False,
     )
+    return output, text_splitter().split_documents(header_splitter.split_text(output))
 
-    print(f"Done. Chroma documents: {db._collection.count()}")
-    print(f"Saved at: {PERSIST_DIRECTORY}")
+
+def _measure(fn) -> tuple[float, float]:
+    """(seconds, peak traced MB) — timed without tracemalloc, peak measured on a second run."""
+    import tracemalloc
+
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def benchmark(scale: int = 20) -> list[dict]:
+    """
+    Time and peak memory of both preprocessors on the processed guidelines used as raw input,
+    and on a synthetic file `scale` times their combined size.
+    "preprocess" = raw -> processed text only; "end_to_end" adds header-aware chunking.
+    """
+    import tempfile
+
+    info = {"disease": "benchmark", "source": "benchmark"}
+    inputs = sorted(PROCESSED_DIR.glob("*.md"))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic = Path(tmp) / "synthetic.md"
+        with synthetic.open("w", encoding="utf-8") as out:
+            for copy in range(scale):
+                for path in inputs:
+                    out.write(f"# ส่วนที่ {copy} {path.stem}\n")
+                    out.write(path.read_text(encoding="utf-8"))
+        output_path = Path(tmp) / "out.md"
+
+        for path in inputs + [synthetic]:
+            def streaming_preprocess():
+                with path.open(encoding="utf-8") as raw, output_path.open("w", encoding="utf-8") as out:
+                    for line in iter_clean_lines(raw):
+                        out.write(line + "\n")
+
+            def legacy_clean():
+                demote_headers(remove_low_value_lines(clean_markdown(path.read_text(encoding="utf-8"))))
+
+            legacy_s, legacy_mb = _measure(legacy_clean)
+            streaming_s, streaming_mb = _measure(streaming_preprocess)
+            legacy_e2e_s, legacy_e2e_mb = _measure(lambda: legacy_preprocess(path, info["disease"], info["source"]))
+            streaming_e2e_s, streaming_e2e_mb = _measure(
+                lambda: preprocess_file(path, output_path, info["disease"], info["source"])
+            )
+
+            legacy_output, legacy_chunks = legacy_preprocess(path, info["disease"], info["source"])
+            chunks = preprocess_file(path, output_path, info["disease"], info["source"])
+            with path.open(encoding="utf-8") as f:
+                lines = sum(1 for _ in f)
+            results.append({
+                "file": path.name,
+                "lines": lines,
+                "preprocess": {
+                    "legacy_s": round(legacy_s, 3), "streaming_s": round(streaming_s, 3),
+                    "speedup": round(legacy_s / streaming_s, 2) if streaming_s else None,
+                    "legacy_peak_mb": round(legacy_mb, 2), "streaming_peak_mb": round(streaming_mb, 2),
+                },
+                "end_to_end": {
+                    "legacy_s": round(legacy_e2e_s, 3), "streaming_s": round(streaming_e2e_s, 3),
+                    "speedup": round(legacy_e2e_s / streaming_e2e_s, 2) if streaming_e2e_s else None,
+                    "legacy_peak_mb": round(legacy_e2e_mb, 2), "streaming_peak_mb": round(streaming_e2e_mb, 2),
+                },
+                "same_output": legacy_output == output_path.read_text(encoding="utf-8"),
+                "same_chunks": list(dict.fromkeys(doc.page_content for doc in legacy_chunks)) == [doc.page_content for doc in chunks.values()],
+            })
+    return results
 
 
 def main():
-    processed_files = build_processed_markdown()
+    if "--benchmark" in sys.argv:
+        print(json.dumps(benchmark(), ensure_ascii=False, indent=2))
+        return
+
+    raw_dir, guidelines = load_manifest()
+
+    # Incremental build on top of the current index unless --full or the chunking/embedding settings changed.
+    base = current_paths()
+    previous = load_state(base.state_path)
+    if "--full" in sys.argv or previous.get("settings") != build_settings() or not os.path.isdir(base.chroma_dir):
+        base, previous = None, {}
+    previous_files = previous.get("files", {})
+
+    processed = build_processed_markdown(raw_dir, guidelines, previous_files)
 
-    if not processed_files:
+    if not processed:
         raise RuntimeError("No markdown files were processed.")
 
-    build_vector_db(processed_files)
+    build_vector_db(processed, guidelines, base, previous_files)
 
 
 if __name__ == "__main__":
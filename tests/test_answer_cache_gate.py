@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("langgraph")
+pytest.importorskip("langchain_google_vertexai")
+messages = pytest.importorskip("langchain_core.messages")
+
+from agent import answer_cache, disease_detector, graph  # noqa: E402
+
+CACHED_ANSWER = "ค่า HbA1c 6.1% อยู่ในช่วงเสี่ยง ควรปรึกษาแพทย์ครับ"
+
+
+@pytest.fixture
+def cache_hit(monkeypatch):
+    """call_model เจอคำตอบใน answer cache เสมอ และเก็บสิ่งที่เขียนออก stream ไว้ตรวจ"""
+    written = []
+
+    async def no_context(query, shards, k):
+        return [], ""
+
+    monkeypatch.setattr(disease_detector, "detect_shards", lambda text, labs=None: [])
+    monkeypatch.setattr(graph, "aretrieve_with_context", no_context)
+    monkeypatch.setattr(answer_cache, "is_cacheable", lambda state: True)
+    monkeypatch.setattr(answer_cache, "make_key", lambda question, chunk_ids: {"question": question})
+    monkeypatch.setattr(answer_cache, "lookup", lambda key: CACHED_ANSWER)
+    monkeypatch.setattr(graph, "get_stream_writer", lambda: written.append)
+    return written
+
+
+def state() -> dict:
+    return {"messages": [messages.HumanMessage(content="HbA1c 6.1% เป็นอะไรไหม")], "steps": []}
+
+
+def test_cached_answer_waits_for_the_output_gate(cache_hit):
+    async def scenario():
+        gate = asyncio.Event()
+        config = {"configurable": {"stream_output": True, "output_gate": gate}}
+        task = asyncio.create_task(graph.call_model(state(), config))
+        await asyncio.sleep(0.2)
+        assert cache_hit == []
+        assert not task.done()
+
+        gate.set()
+        result = await task
+        assert cache_hit == [{"content": CACHED_ANSWER}]
+        assert "answer_cache_hit" in result["steps"]
+
+    asyncio.run(scenario())
+
+
+def test_blocked_input_never_streams_the_cached_answer(cache_hit, monkeypatch):
+    async def blocked(state):
+        await asyncio.sleep(0.2)
+        return {"blocked": True, "steps": state["steps"] + ["guardrail_input"]}
+
+    monkeypatch.setattr(graph, "guardrail_input_node", blocked)
+    config = {"configurable": {"stream_output": True}}
+    result = asyncio.run(graph.speculative_agent_node(state(), config))
+    assert result["blocked"]
+    assert cache_hit == []
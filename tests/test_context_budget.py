@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("numpy")
+documents = pytest.importorskip("langchain_core.documents")
+
+from agent import context_budget  # noqa: E402
+
+Document = documents.Document
+
+BODY = "ผู้ป่วยเบาหวานควรตรวจระดับน้ำตาลสะสมอย่างสม่ำเสมอทุกสามถึงหกเดือนตามคำแนะนำของแพทย์ผู้ดูแล"
+TAIL = "ควบคุมอาหารประเภทแป้งและน้ำตาล ออกกำลังกายอย่างน้อยสัปดาห์ละหนึ่งร้อยห้าสิบนาที"
+
+
+def doc(text: str, topic: str = "การดูแลตนเอง", source: str = "diabetes_knowledge.md") -> Document:
+    return Document(page_content=text, metadata={"SourceFile": source, "Disease": "เบาหวาน", "Topic": topic})
+
+
+def test_estimate_tokens_counts_thai_denser_than_ascii():
+    assert context_budget.estimate_tokens("abcd") == 1
+    assert context_budget.estimate_tokens("กขคง") == 2
+    assert context_budget.estimate_tokens("") == 0
+
+
+def test_overlapping_chunks_from_the_same_topic_are_merged():
+    overlap = BODY[-context_budget.MIN_OVERLAP_CHARS:]
+    merged = context_budget.merge_chunks([doc(BODY), doc(overlap + TAIL)])
+    assert [d.page_content for d in merged] == [BODY + TAIL]
+
+
+def test_contained_chunk_is_dropped():
+    merged = context_budget.merge_chunks([doc(BODY + TAIL), doc(TAIL)])
+    assert [d.page_content for d in merged] == [BODY + TAIL]
+
+
+def test_chunks_from_different_topics_are_kept_apart():
+    merged = context_budget.merge_chunks([doc(BODY), doc(BODY, topic="อาการ")])
+    assert len(merged) == 2
+
+
+def test_dedupe_sentences_drops_repeats_and_keeps_short_lines():
+    seen: set[str] = set()
+    assert context_budget.dedupe_sentences(BODY, seen) == BODY
+    assert context_budget.dedupe_sentences(f"{BODY}\n|\n{TAIL}", seen) == f"|\n{TAIL}"
+
+
+def test_assemble_context_numbers_blocks():
+    context = context_budget.assemble_context([doc(BODY), doc(TAIL, topic="อาหาร")], budget=1000)
+    assert context.startswith("[ข้อมูลที่ 1 จาก: เบาหวาน - การดูแลตนเอง]:")
+    assert "[ข้อมูลที่ 2 จาก: เบาหวาน - อาหาร]:" in context
+
+
+def test_first_chunk_is_truncated_to_whole_lines_within_budget():
+    context = context_budget.assemble_context([doc(f"{BODY}\n{TAIL}"), doc(TAIL, topic="อาหาร")], budget=70)
+    assert BODY in context
+    assert TAIL not in context
+
+
+def test_assemble_context_skips_a_chunk_that_only_fits_its_header():
+    assert context_budget.assemble_context([doc(BODY)], budget=context_budget.MIN_CONTENT_TOKENS) == ""
+    assert context_budget.assemble_context([]) == ""
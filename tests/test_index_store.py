@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from agent import index_store
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "INDEX_ROOT", str(tmp_path))
+    monkeypatch.setattr(index_store, "MANIFEST_PATH", str(tmp_path / "current.json"))
+    return tmp_path
+
+
+def make_version(root, name: str) -> index_store.IndexPaths:
+    paths = index_store.version_paths(name)
+    os.makedirs(paths.chroma_dir)
+    return paths
+
+
+def test_without_manifest_uses_legacy_paths(root):
+    assert index_store.read_manifest() is None
+    assert index_store.current_version() == index_store.LEGACY_VERSION
+    assert index_store.current_paths().version == index_store.LEGACY_VERSION
+
+
+def test_created_version_is_not_current_until_published(root):
+    paths = index_store.create_version()
+    assert os.path.isdir(os.path.join(root, paths.version))
+    assert index_store.current_version() == index_store.LEGACY_VERSION
+
+    index_store.publish(paths, {"chunks": 12})
+    assert index_store.current_paths() == paths
+    manifest = json.loads((root / "current.json").read_text(encoding="utf-8"))
+    assert (manifest["version"], manifest["chunks"]) == (paths.version, 12)
+    assert [name for name in os.listdir(root) if name.endswith(".tmp")] == []
+
+
+def test_version_paths_live_under_the_version_directory(root):
+    paths = index_store.version_paths("20260101-000000-abcdef")
+    base = os.path.join(root, "20260101-000000-abcdef")
+    assert paths.chroma_dir == os.path.join(base, "chroma")
+    assert paths.bm25_path == os.path.join(base, "bm25_index.json")
+    assert paths.vector_dir == os.path.join(base, "vector_index")
+    assert paths.state_path == os.path.join(base, "ingest_state.json")
+
+
+def test_prune_keeps_newest_versions_and_the_current_one(root):
+    names = [f"2026010{day}-000000-aaaaaa" for day in range(1, 6)]
+    for name in names:
+        make_version(root, name)
+    index_store.publish(index_store.version_paths(names[0]))
+
+    removed = index_store.prune(keep=2)
+    assert sorted(removed) == names[1:3]
+    assert sorted(name for name in os.listdir(root) if name != "current.json") == [names[0], *names[3:]]
+
+
+def test_prune_without_index_root_is_a_no_op(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "INDEX_ROOT", str(tmp_path / "missing"))
+    assert index_store.prune() == []
@@ -0,0 +1,49 @@
+import pytest
+
+# input_classifier ใช้ embedding ของ rag_utils ต้องมี dependency ของ backend ครบ
+pytest.importorskip("numpy")
+messages = pytest.importorskip("langchain_core.messages")
+
+from agent import intent_router  # noqa: E402
+
+
+@pytest.mark.parametrize("text,intent", [
+    ("สวัสดีครับ", "greeting"),
+    ("ขอบคุณมากครับ", "greeting"),
+    ("บาย", "greeting"),
+    ("ระบบนี้ทำอะไรได้บ้าง", "system_usage"),
+    ("HbA1c 6.1%", "lab_interpretation"),
+    ("สวัสดีครับ น้ำตาล 130 mg/dl", "lab_interpretation"),
+    ("สวัสดีครับ เป็นเบาหวานต้องกินอะไร", "general_disease"),
+    ("ระบบนี้ช่วยเรื่องเบาหวานได้ไหม", "general_disease"),
+    ("แนะนำเกมสนุกๆ หน่อย", "out_of_scope"),
+])
+def test_classify_intent(text, intent):
+    assert intent_router.classify_intent(text) == intent
+
+
+def test_labs_from_lab_engine_force_lab_interpretation():
+    assert intent_router.classify_intent("ค่านี้ปกติไหม", labs=[{"lab": "egfr", "value": 48}]) == "lab_interpretation"
+
+
+@pytest.mark.parametrize("intent,text,reply", [
+    ("greeting", "สวัสดีครับ", intent_router.GREETING_REPLY),
+    ("greeting", "ขอบคุณครับ", intent_router.THANKS_REPLY),
+    ("greeting", "ลาก่อนครับ", intent_router.GOODBYE_REPLY),
+    ("system_usage", "บอทนี้ใช้งานยังไง", intent_router.SYSTEM_USAGE_REPLY),
+])
+def test_template_reply(intent, text, reply):
+    assert intent_router.template_reply(intent, text) == reply
+
+
+def test_only_template_intents_skip_the_agent():
+    for intent in intent_router.INTENTS:
+        expected = "template" if intent in intent_router.TEMPLATE_INTENTS else "agent"
+        assert intent_router.route_after_intent({"intent": intent}) == expected
+
+
+def test_template_reply_node_answers_without_the_llm():
+    state = {"messages": [messages.HumanMessage(content="สวัสดีครับ")], "intent": "greeting", "steps": ["intent_greeting"]}
+    result = intent_router.template_reply_node(state)
+    assert result["messages"][0].content == intent_router.GREETING_REPLY
+    assert result["steps"] == ["intent_greeting", "template_reply"]
@@ -0,0 +1,99 @@
+import pytest
+
+from agent import lab_engine
+
+
+def only(text: str) -> dict:
+    labs = lab_engine.interpret(text)
+    assert len(labs) == 1, labs
+    return labs[0]
+
+
+@pytest.mark.parametrize("text,lab,value,unit", [
+    ("HbA1c 6.1%", "hba1c", 6.1, "%"),
+    ("a1c 48 mmol/mol", "hba1c", 6.5, "%"),
+    ("FBS 5.5 mmol/L", "fpg", 99, "mg/dL"),
+    ("eGFR 48", "egfr", 48, "mL/min/1.73m2"),
+    ("LDL 4.2 mmol/L", "ldl", 162, "mg/dL"),
+    ("ไขมันเลว 160 มก./ดล.", "ldl", 160, "mg/dL"),
+    ("โพแทสเซียม 5.8", "potassium", 5.8, "mmol/L"),
+])
+def test_extracts_and_normalizes_units(text, lab, value, unit):
+    item = only(text)
+    assert (item["lab"], item["value"], item["unit"]) == (lab, value, unit)
+
+
+def test_blood_pressure_needs_both_values():
+    item = only("ความดัน 150/95 ครับ")
+    assert (item["value"], item["diastolic"]) == (150, 95)
+    assert lab_engine.interpret("ความดันสูงมาก 150") == []
+
+
+@pytest.mark.parametrize("text,band", [
+    ("ความดัน 118/76", "optimal"),
+    ("ความดัน 125/85", "high_normal"),
+    ("ความดัน 130/95", "hypertension_range"),
+    ("ความดัน 150/70", "hypertension_range"),
+    ("ความดัน 130/112", "very_high"),
+])
+def test_blood_pressure_uses_the_worse_of_systolic_and_diastolic(text, band):
+    assert only(text)["band"] == band
+
+
+def test_diastolic_110_is_a_red_flag():
+    assert "180/110" in only("ความดัน 130/112")["red_flag"]
+    assert "red_flag" not in only("ความดัน 130/95")
+
+
+@pytest.mark.parametrize("value,band", [(95, "G1"), (75, "G2"), (48, "G3a"), (35, "G3b"), (20, "G4"), (10, "G5")])
+def test_egfr_is_described_as_a_range_not_a_diagnosis(value, band):
+    item = only(f"eGFR {value}")
+    assert item["band"] == band
+    assert f"เกณฑ์ {band}" in item["label_th"]
+    assert "โรคไตเรื้อรัง" not in item["label_th"]
+
+
+def test_egfr_red_flags():
+    assert "15" in only("eGFR 12")["red_flag"]
+    assert "30" in only("eGFR 25")["red_flag"]
+    assert "red_flag" not in only("eGFR 48")
+
+
+@pytest.mark.parametrize("text", ["FBS 130", "น้ำตาลขณะอดอาหาร 130", "ตอนเช้าก่อนกินข้าว น้ำตาลในเลือด 130"])
+def test_fasting_glucose_uses_fasting_cutoffs(text):
+    item = only(text)
+    assert item["fasting"] is True
+    assert item["band"] == "diabetes_range"
+
+
+@pytest.mark.parametrize("text", ["น้ำตาลในเลือด 130", "glucose 180", "ระดับน้ำตาล 150"])
+def test_unspecified_glucose_is_not_compared_with_fasting_cutoffs(text):
+    item = only(text)
+    assert item["fasting"] is False
+    assert "band" not in item
+    assert item["note_th"] == lab_engine.UNKNOWN_FASTING_NOTE
+    assert lab_engine.UNKNOWN_FASTING_NOTE in lab_engine.format_lab_summary([item])
+
+
+def test_glucose_red_flags_apply_without_fasting():
+    assert "300" in only("น้ำตาลในเลือด 350")["red_flag"]
+    assert "70" in only("น้ำตาลในเลือด 60")["red_flag"]
+
+
+def test_hba1c_bands():
+    assert only("HbA1c 5.5%")["band"] == "normal"
+    assert only("HbA1c 6.1%")["band"] == "prediabetes"
+    assert only("HbA1c 7.0%")["band"] == "diabetes_range"
+
+
+def test_potassium_red_flag():
+    assert "ทันที" in only("โพแทสเซียม 6.2")["red_flag"]
+
+
+def test_lab_source_files():
+    labs = lab_engine.interpret("HbA1c 7% และ eGFR 48")
+    assert lab_engine.lab_source_files(labs) == ["diabetes_knowledge.md", "kidney_knowledge.md"]
+
+
+def test_lab_tags():
+    assert lab_engine.lab_tags("ค่า HbA1c และ eGFR ของผู้ป่วย") == ["egfr", "hba1c"]
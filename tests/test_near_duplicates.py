@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("numpy")
+documents = pytest.importorskip("langchain_core.documents")
+
+from agent import near_duplicates  # noqa: E402
+
+Document = documents.Document
+
+PARAGRAPH = (
+    "ผู้ป่วยเบาหวานควรตรวจระดับน้ำตาลสะสม (HbA1c) ทุกสามถึงหกเดือน "
+    "ควบคุมอาหารประเภทแป้งและน้ำตาล ลดเครื่องดื่มที่มีรสหวาน "
+    "ออกกำลังกายแบบแอโรบิกอย่างน้อยสัปดาห์ละ 150 นาที "
+    "ตรวจเท้าด้วยตนเองทุกวันเพื่อหาแผลหรือรอยช้ำ "
+    "และพบจักษุแพทย์เพื่อตรวจจอประสาทตาปีละครั้ง"
+)
+OTHER = (
+    "ผู้ป่วยโรคไตเรื้อรังควรจำกัดโซเดียมไม่เกินวันละ 2,000 มิลลิกรัม "
+    "หลีกเลี่ยงยาแก้ปวดกลุ่ม NSAIDs และติดตามค่า eGFR กับโพแทสเซียมตามนัด"
+)
+
+
+def chunk(text: str, topic: str, source: str = "diabetes_knowledge.md") -> Document:
+    return Document(page_content=text, metadata={"SourceFile": source, "Topic": topic})
+
+
+def test_identical_and_near_identical_texts_share_a_group():
+    near = PARAGRAPH.replace("ทุกวัน", "ทุกๆ วัน")
+    assert near_duplicates.near_duplicate_groups([PARAGRAPH, near, PARAGRAPH, OTHER]) == [0, 0, 0, 3]
+
+
+def test_signature_is_deterministic():
+    assert (near_duplicates.signature(PARAGRAPH) == near_duplicates.signature(PARAGRAPH)).all()
+    assert len(near_duplicates.signature("สั้น")) == near_duplicates.NUM_PERM
+
+
+def test_collapse_keeps_the_longest_chunk_and_records_the_others():
+    chunks = {
+        "a": chunk(PARAGRAPH, "การดูแลตนเอง"),
+        "b": chunk(PARAGRAPH + " ค่ะ", "คำแนะนำ"),
+        "c": chunk(OTHER, "โรคไต"),
+    }
+    kept, removed = near_duplicates.collapse_near_duplicates(chunks)
+    assert removed == 1
+    assert list(kept) == ["b", "c"]
+    assert kept["b"].metadata["Duplicates"] == 1
+    assert kept["b"].metadata["DuplicateTopics"] == "การดูแลตนเอง"
+    assert "Duplicates" not in kept["c"].metadata
+
+
+def test_duplicates_in_different_source_files_are_kept():
+    chunks = {
+        "a": chunk(PARAGRAPH, "การดูแลตนเอง"),
+        "b": chunk(PARAGRAPH, "การดูแลตนเอง", source="hypertension_knowledge.md"),
+    }
+    kept, removed = near_duplicates.collapse_near_duplicates(chunks)
+    assert removed == 0
+    assert list(kept) == ["a", "b"]
@@ -0,0 +1,59 @@
+import pytest
+
+from agent import output_safety
+
+# คำตอบที่ผิดกฎของ Safety Editor: pre-screen ต้องติดธงทุกข้อ (หมวดที่คาดว่าจะเจอ)
+UNSAFE_ANSWERS = [
+    ("จากค่าน้ำตาล 130 ถือว่าเป็นโรคเบาหวานค่ะ", "diagnosis"),
+    ("ค่า HbA1c 7.2% แสดงว่าคุณเป็นเบาหวานแล้วครับ", "diagnosis"),
+    ("น่าจะเป็นความดันโลหิตสูงครับ", "diagnosis"),
+    ("คุณมีภาวะไตเสื่อมระยะที่ 3 ครับ", "diagnosis"),
+    ("ผลนี้เข้าข่ายโรคไตเรื้อรังครับ", "diagnosis"),
+    ("คุณเป็นเบาหวานครับ", "diagnosis"),
+    ("You have diabetes.", "diagnosis"),
+    ("ให้หยุดยาเบาหวานเองได้เลย", "medication_change"),
+    ("ลองลดยาความดันลงครึ่งหนึ่งครับ", "medication_change"),
+    ("ช่วงนี้ฉีดอินซูลินเพิ่มได้ครับ", "medication_change"),
+    ("เริ่มกินยาลดไขมันได้เลยครับ", "medication_change"),
+    ("You can stop taking your medication.", "medication_change"),
+    ("ควรกินยาลดความดันต่อเนื่องครับ", "drug"),
+    ("ปรึกษาแพทย์เรื่องการใช้อินซูลินครับ", "drug"),
+    ("metformin ช่วยคุมน้ำตาลได้ครับ", "drug"),
+    ("กินยา 500 mg วันละ 2 ครั้ง", "dosage"),
+    ("ค่านี้อันตรายมากครับ", "alarm"),
+]
+
+# คำตอบที่ไม่ผิดกฎ: ไม่ควรติดธง
+SAFE_ANSWERS = [
+    "ค่า HbA1c 6.1% มีแนวโน้มอยู่ในช่วงเสี่ยง ควรปรึกษาแพทย์ครับ",
+    "คุณมีภาวะเสี่ยงต่อโรคไต ควรตรวจติดตามครับ",
+    "ควรนอนหลับให้เพียงพอและออกกำลังกายสม่ำเสมอครับ",
+    "พยาบาลจะช่วยนัดตรวจให้ครับ ไม่ยากเลย",
+]
+
+
+@pytest.mark.parametrize("text,category", UNSAFE_ANSWERS)
+def test_prescreen_flags_unsafe_answers(text, category):
+    hits = output_safety.prescreen(text)
+    assert any(hit.startswith(f"{category}:") for hit in hits), hits
+    assert output_safety.needs_llm_review(text, hits)
+
+
+@pytest.mark.parametrize("text", SAFE_ANSWERS)
+def test_prescreen_passes_safe_answers(text):
+    assert output_safety.prescreen(text) == []
+
+
+def test_disease_or_medication_mentions_reviewed_only_when_enabled(monkeypatch):
+    text = "ค่า HbA1c 6.1% มีแนวโน้มอยู่ในช่วงเสี่ยงเบาหวาน ควรปรึกษาแพทย์ครับ"
+    assert output_safety.prescreen(text) == []
+    assert not output_safety.needs_llm_review(text, [])
+
+    monkeypatch.setattr(output_safety, "OUTPUT_TOPIC_REVIEW", True)
+    assert output_safety.needs_llm_review(text, [])
+
+
+def test_small_talk_skips_llm(monkeypatch):
+    monkeypatch.setattr(output_safety, "OUTPUT_TOPIC_REVIEW", True)
+    text = "ยินดีครับ ถ้ามีคำถามเพิ่มเติมถามได้เลยครับ"
+    assert not output_safety.needs_llm_review(text, output_safety.prescreen(text))
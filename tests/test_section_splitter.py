@@ -0,0 +1,58 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("langchain_chroma")
+pytest.importorskip("langchain_text_splitters")
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+# สคริปต์ build อยู่ใน data/ (ไม่ใช่ package) จึงโหลดจาก path
+_spec = importlib.util.spec_from_file_location("MarkdownHeaderTextSplitter", DATA_DIR / "MarkdownHeaderTextSplitter.py")
+splitter = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(splitter)
+
+SAMPLE = (
+    "\ufeff# สารบัญ\n\n12\n\n"
+    "# เบาหวาน\n\n\n\n"
+    "ข้อความ<br>ต่อ ![รูป](a.png) <mark>สำคัญ</mark> H<sup>2</sup>\n\n"
+    "## การรักษา\n- ควบคุมอาหาร\n- ออกกำลังกาย\n\n\n"
+    "### ยา\n| ยา | ขนาด |\n|---|---|\n| metformin | 500 mg |\n"
+    "```\n# ไม่ใช่หัวข้อ\n```\n\n"
+    "#### ข้อควรระวัง\nติดตามค่า eGFR  \n\n   \n"
+)
+
+
+def legacy_clean(text: str) -> str:
+    return splitter.demote_headers(splitter.remove_low_value_lines(splitter.clean_markdown(text)))
+
+
+def assert_same_as_legacy(path: Path, tmp_path: Path) -> None:
+    output_path = tmp_path / "out.md"
+    legacy_output, legacy_chunks = splitter.legacy_preprocess(path, "เบาหวาน", "test")
+    chunks = splitter.preprocess_file(path, output_path, "เบาหวาน", "test")
+
+    assert output_path.read_text(encoding="utf-8") == legacy_output
+    # legacy ไม่ได้ตัด chunk ที่ซ้ำกัน ส่วน chunk_lines เก็บตาม content-hash id
+    assert [doc.page_content for doc in chunks.values()] == list(dict.fromkeys(doc.page_content for doc in legacy_chunks))
+    for doc in chunks.values():
+        assert doc.metadata["SourceFile"] == "out.md"
+        assert doc.metadata["Tokens"] > 0
+
+
+def test_streaming_cleaner_matches_whole_text_cleaning():
+    lines = SAMPLE.splitlines(keepends=True)
+    assert "\n".join(splitter.iter_clean_lines(lines)) == legacy_clean(SAMPLE)
+
+
+def test_sample_chunks_match_legacy_preprocess(tmp_path):
+    path = tmp_path / "sample.md"
+    path.write_text(SAMPLE, encoding="utf-8")
+    assert_same_as_legacy(path, tmp_path)
+
+
+@pytest.mark.parametrize("path", sorted((DATA_DIR / "processed_markdown").glob("*.md")), ids=lambda path: path.name)
+def test_guideline_chunks_match_legacy_preprocess(path, tmp_path):
+    assert_same_as_legacy(path, tmp_path)